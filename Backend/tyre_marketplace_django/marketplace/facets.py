@@ -0,0 +1,178 @@
+"""
+Cached tire size facets for the size dropdowns, and facet counts for
+listing search results.
+
+The cache holds a snapshot of every (width, aspect_ratio, diameter), speed
+rating and load index in use by an active listing, built with one query.
+Snapshots are stored under a generation token. Listing saves and deletes
+replace the token once their transaction commits (see signals.py), so the
+next read rebuilds the snapshot from the committed rows. A snapshot built
+from rows read before the commit is stored under the old token and never
+served. Processes only see each other's invalidations when the cache is
+shared between them (see CACHES in settings.py).
+"""
+import hashlib
+import json
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import TireListing
+
+FACETS_CACHE_KEY = 'tire_size_facets'
+FACETS_GENERATION_KEY = 'tire_size_facets_generation'
+
+
+def _etag(snapshot):
+    digest = hashlib.sha1(repr((
+        snapshot['sizes'],
+        snapshot['speed_ratings'],
+        snapshot['load_indices'],
+    )).encode()).hexdigest()
+    return digest[:16]
+
+
+def build_snapshot():
+    rows = TireListing.objects.filter(is_active=True).order_by().values_list(
+        'width', 'aspect_ratio', 'diameter', 'speed_rating', 'load_index'
+    ).distinct()
+    sizes, speed_ratings, load_indices = set(), set(), set()
+    for width, aspect_ratio, diameter, speed_rating, load_index in rows:
+        sizes.add((width, aspect_ratio, diameter))
+        if speed_rating:
+            speed_ratings.add(speed_rating)
+        if load_index is not None:
+            load_indices.add(load_index)
+    snapshot = {
+        'sizes': sorted(sizes),
+        'speed_ratings': sorted(speed_ratings),
+        'load_indices': sorted(load_indices),
+        'last_modified': timezone.now(),
+    }
+    snapshot['etag'] = _etag(snapshot)
+    return snapshot
+
+
+def _generation():
+    return cache.get_or_set(FACETS_GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+def get_snapshot():
+    key = f'{FACETS_CACHE_KEY}:{_generation()}'
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = build_snapshot()
+        cache.set(key, snapshot, getattr(settings, 'FACETS_CACHE_TIMEOUT', 3600))
+    return snapshot
+
+
+def invalidate():
+    """Rebuild the tire size facets on the next read once the transaction commits"""
+    transaction.on_commit(lambda: cache.set(FACETS_GENERATION_KEY, uuid.uuid4().hex, None))
+
+
+def facets_etag(request, *args, **kwargs):
+    return f'"{get_snapshot()["etag"]}"'
+
+
+def facets_last_modified(request, *args, **kwargs):
+    return get_snapshot()['last_modified']
+
+
+def widths():
+    return sorted({width for width, _, _ in get_snapshot()['sizes']})
+
+
+def aspect_ratios(width):
+    return sorted({aspect for w, aspect, _ in get_snapshot()['sizes'] if w == width})
+
+
+def diameters(width, aspect_ratio):
+    return sorted({
+        diameter for w, aspect, diameter in get_snapshot()['sizes']
+        if w == width and aspect == aspect_ratio
+    })
+
+
+def speed_ratings():
+    return get_snapshot()['speed_ratings']
+
+
+def load_indices():
+    return get_snapshot()['load_indices']
+
+
+def size_tree():
+    """Nested width -> aspect ratio -> diameters lists for one-call dropdowns"""
+    tree = {}
+    for width, aspect_ratio, diameter in get_snapshot()['sizes']:
+        tree.setdefault(width, {}).setdefault(aspect_ratio, []).append(diameter)
+    return [
+        {
+            'width': width,
+            'aspect_ratios': [
+                {'aspect_ratio': aspect_ratio, 'diameters': sorted(tree[width][aspect_ratio])}
+                for aspect_ratio in sorted(tree[width])
+            ],
+        }
+        for width in sorted(tree)
+    ]
+
+
+# Listing fields clients may request counts for with ?facets=
+LISTING_FACETS = ('condition', 'brand', 'vehicle_type', 'tire_type', 'speed_rating', 'load_index')
+
+# Query parameters that do not change which listings match
+NON_FILTER_PARAMS = {'page', 'page_size', 'cursor', 'sort_by', 'facets'}
+
+
+def requested_facets(values):
+    """Accept both ?facets=brand,condition and ?facets=brand&facets=condition"""
+    names = {name.strip() for value in values for name in value.split(',')}
+    return [name for name in LISTING_FACETS if name in names]
+
+
+def _facet_counts_cache_key(params, names):
+    filters = sorted(
+        (key, sorted(params.getlist(key)))
+        for key in params.keys()
+        if key not in NON_FILTER_PARAMS
+    )
+    raw = json.dumps([filters, names], separators=(',', ':'))
+    return 'listing_facet_counts:' + hashlib.sha1(raw.encode()).hexdigest()
+
+
+def facet_counts(queryset, facet_filters, names, params):
+    """Count matching listings per value of each requested facet.
+
+    ``queryset`` has every filter applied except the facet filters in
+    ``facet_filters``. Each facet is counted with one grouped query that
+    applies all the other facet filters but not its own, so the options of a
+    multi-select filter keep their counts after one of them is picked.
+    Results are cached for FACET_COUNTS_CACHE_TIMEOUT seconds per
+    normalised set of filter parameters.
+    """
+    cache_key = _facet_counts_cache_key(params, names)
+    counts = cache.get(cache_key)
+    if counts is not None:
+        return counts
+
+    counts = {}
+    for name in names:
+        facet_queryset = queryset
+        for field, values in facet_filters.items():
+            if field != name:
+                facet_queryset = facet_queryset.filter(**{f'{field}__in': values})
+        rows = facet_queryset.order_by().values_list(name).annotate(count=Count('id')).order_by('-count', name)
+        counts[name] = [
+            {'value': value, 'count': count}
+            for value, count in rows
+            if value not in (None, '')
+        ]
+
+    cache.set(cache_key, counts, getattr(settings, 'FACET_COUNTS_CACHE_TIMEOUT', 60))
+    return counts
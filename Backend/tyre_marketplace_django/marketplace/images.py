@@ -0,0 +1,395 @@
+"""
+Background processing of listing image uploads.
+
+An upload is stored untouched as the image's ``original`` and its
+ListingImage row is created with status "pending", so the request returns
+straight away; ``image`` points at the original until the resized copy is
+ready. Pending rows are the job queue. They are picked up by a small
+in-process thread pool once the upload commits (IMAGE_PROCESSING_THREADS,
+0 to disable) and by the ``process_images`` management command, which can
+run as a dedicated worker. A job is claimed by flipping its row to
+"processing" with a conditional UPDATE, so no image is processed twice.
+
+Besides the 1200px image and 300px thumbnail, every upload gets responsive
+variants: one file per LISTING_IMAGE_VARIANT_WIDTHS entry and
+LISTING_IMAGE_VARIANT_FORMATS format, recorded in ListingImage.variants so
+clients can pick the smallest file that fits.
+
+Uploads are stored content-addressed under images/, named by the SHA-256
+of their bytes, with one ImageContent row per distinct file. The storage
+spreads them over hash-prefixed directories (see storage.py). Re-uploading
+the same photo, e.g. for another listing, adds a reference to the existing
+row and reuses its resized copies instead of storing and processing it
+again, and the files are deleted along with the last ListingImage using
+them. File names never change meaning, so their URLs can be cached forever.
+
+Profile images go through the same decoding, resized to PROFILE_IMAGE_SIZE
+when uploaded, with square avatar crops at AVATAR_SIZES for the places that
+show them small (listing cards, conversations, reviews).
+"""
+import hashlib
+import logging
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.db.models import F
+from PIL import Image, ImageOps
+
+from .imaging import encode, open_scaled
+from .media import delete_on_commit, media_name
+from .models import ImageContent, ListingImage
+
+logger = logging.getLogger(__name__)
+
+MAX_SIZE = (1200, 1200)
+THUMBNAIL_SIZE = (300, 300)
+JPEG_QUALITY = 85  # Good balance between size and quality
+PROFILE_IMAGE_SIZE = (512, 512)
+AVATAR_SIZES = (64, 128)
+
+# Encoder settings for the responsive variants, keyed by the names used in
+# LISTING_IMAGE_VARIANT_FORMATS
+VARIANT_ENCODERS = {
+    'avif': ('AVIF', 'avif', {'quality': 60}),
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': JPEG_QUALITY, 'optimize': True, 'progressive': True}),
+}
+
+
+def content_name(sha256, suffix):
+    # The storage shards it into directories (see storage.py)
+    return f'images/{sha256}{suffix}'
+
+
+def save_once(name, data):
+    """Save ``data`` as ``name`` unless it is already stored.
+
+    Content-addressed names always hold the same bytes, so an existing file
+    can be used as is.
+    """
+    name = default_storage.generate_filename(name)
+    if default_storage.exists(name):
+        return name
+    return default_storage.save(name, data)
+
+
+def hash_upload(upload):
+    digest = hashlib.sha256()
+    for chunk in upload.chunks():
+        digest.update(chunk)
+    upload.seek(0)
+    return digest.hexdigest()
+
+
+def acquire_content(upload):
+    """Return the ImageContent for the upload's bytes with one more reference, storing it if new"""
+    sha256 = hash_upload(upload)
+    with transaction.atomic():
+        content, created = ImageContent.objects.select_for_update().get_or_create(
+            sha256=sha256,
+            defaults={'ext': upload.name.split('.')[-1].lower(), 'size': upload.size, 'ref_count': 1},
+        )
+        if created:
+            content.original.name = save_once(content_name(sha256, f'.{content.ext}'), upload)
+            content.save(update_fields=['original'])
+        else:
+            ImageContent.objects.filter(pk=sha256).update(ref_count=F('ref_count') + 1)
+    return content
+
+
+def release_content(sha256):
+    """Drop one reference, deleting the content and its files once unused"""
+    with transaction.atomic():
+        ImageContent.objects.filter(pk=sha256, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        content = ImageContent.objects.select_for_update().filter(pk=sha256, ref_count=0).first()
+        if content is None:
+            return
+        names = file_names(content)
+        content.delete()
+    delete_on_commit(names)
+
+
+def file_names(obj):
+    """Every stored file of a ListingImage or ImageContent"""
+    names = [obj.original.name, obj.image.name, obj.thumbnail.name]
+    return [name for name in names if name] + [variant['path'] for variant in obj.variants]
+
+
+def release_files(listing_image):
+    """Delete a removed ListingImage's files, or its reference to shared ones"""
+    if listing_image.content_id:
+        release_content(listing_image.content_id)
+    else:
+        delete_on_commit(file_names(listing_image))
+
+
+def store_upload(listing, upload, **fields):
+    """Store an upload content-addressed and queue it for processing.
+
+    If the same bytes were uploaded and processed before, the image is ready
+    straight away with the existing resized copies.
+    """
+    content = acquire_content(upload)
+    listing_image = ListingImage(listing=listing, content=content, **fields)
+    listing_image.original.name = content.original.name
+    if content.image:
+        listing_image.status = ListingImage.STATUS_READY
+        listing_image.image.name = content.image.name
+        listing_image.thumbnail.name = content.thumbnail.name
+        listing_image.variants = content.variants
+        listing_image.save()
+        return listing_image
+
+    listing_image.status = ListingImage.STATUS_PENDING
+    listing_image.image.name = content.original.name
+    listing_image.save()
+    enqueue([listing_image.id])
+    return listing_image
+
+
+def variant_widths():
+    return sorted(getattr(settings, 'LISTING_IMAGE_VARIANT_WIDTHS', (160, 320, 640, 1200)), reverse=True)
+
+
+def variant_formats():
+    """The configured variant formats this Pillow build can encode"""
+    Image.init()
+    return [
+        name for name in getattr(settings, 'LISTING_IMAGE_VARIANT_FORMATS', ('webp', 'jpeg'))
+        if VARIANT_ENCODERS[name][0] in Image.SAVE
+    ]
+
+
+def derive_variants(img):
+    """Encode ``img`` at every configured width (never upscaled) and format.
+
+    Returns a list of (width, height, format name, extension, bytes), widest
+    first. Each width is resized from the previous one, which is cheaper than
+    going back to the full image every time.
+    """
+    widths = [width for width in variant_widths() if width < img.width]
+    if len(widths) < len(variant_widths()):
+        # The image is narrower than some sizes; its own width stands in for them
+        widths.insert(0, img.width)
+
+    variants = []
+    current = img
+    for width in widths:
+        if width < current.width:
+            current = current.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        for name in variant_formats():
+            save_format, ext, options = VARIANT_ENCODERS[name]
+            variants.append((current.width, current.height, name, ext, encode(current, save_format, **options)))
+    return variants
+
+
+def derive(original, ext):
+    """Return the encoded (resized image, thumbnail, variants) for an original file.
+
+    The original is decoded once, already scaled down to MAX_SIZE (see
+    imaging.py); every other size is resized from that.
+    """
+    img = open_scaled(original, MAX_SIZE)
+    thumb = img.copy()
+    thumb.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+    return encode_as(img, ext), encode_as(thumb, ext), derive_variants(img)
+
+
+def encode_as(img, ext):
+    """Encode ``img`` in the format of the upload it came from: JPEG or PNG"""
+    if ext in ['jpg', 'jpeg']:
+        return encode(img, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return encode(img, 'PNG', optimize=True)
+
+
+def derive_avatars(user, img, ext):
+    """Save square crops of ``img`` at AVATAR_SIZES; returns {"<size>": url}.
+
+    File names start with the user's id, so collect_media can tell whose
+    they are.
+    """
+    key = uuid.uuid4().hex
+    variants = {}
+    for size in AVATAR_SIZES:
+        avatar = ImageOps.fit(img, (size, size), Image.LANCZOS)
+        name = default_storage.save(
+            f'profile_images/{user.id}/{user.id}_{size}_{key}.{ext}', ContentFile(encode_as(avatar, ext))
+        )
+        variants[str(size)] = settings.MEDIA_URL + name
+    return variants
+
+
+def store_profile_image(user, upload):
+    """Orient and resize an uploaded profile image and save it with its avatars.
+
+    Sets the user's profile_image_url and profile_image_variants; saving the
+    user is up to the caller.
+    """
+    ext = upload.name.split('.')[-1].lower()
+    img = open_scaled(upload, PROFILE_IMAGE_SIZE)
+    name = default_storage.save(f'profile_images/{user.id}/{uuid.uuid4()}.{ext}', ContentFile(encode_as(img, ext)))
+    user.profile_image_url = settings.MEDIA_URL + name
+    user.profile_image_variants = derive_avatars(user, img, ext)
+
+
+def backfill_avatars(user):
+    """Make the avatars of a profile image stored before they existed"""
+    name = media_name(user.profile_image_url)
+    with default_storage.open(name) as f:
+        img = open_scaled(f, (max(AVATAR_SIZES),) * 2)
+    user.profile_image_variants = derive_avatars(user, img, name.split('.')[-1].lower())
+
+
+def profile_image_files(user):
+    """The stored files of a user's profile image and avatars"""
+    urls = [user.profile_image_url, *user.profile_image_variants.values()]
+    return [name for name in map(media_name, urls) if name]
+
+
+def claim(image_ids):
+    """Move pending images to "processing" and return the ones this worker got"""
+    claimed = [
+        image_id for image_id in image_ids
+        if ListingImage.objects.filter(id=image_id, status=ListingImage.STATUS_PENDING).update(
+            status=ListingImage.STATUS_PROCESSING
+        )
+    ]
+    return list(ListingImage.objects.filter(id__in=claimed).select_related('content'))
+
+
+def derive_and_store(listing_image):
+    """Decode, resize and encode one image and save the results to storage.
+
+    Touches only the file storage, never the database, so it can run on any
+    thread. Returns the fields to update on the ListingImage (and its
+    ImageContent). Copies already made for the same content are reused.
+    """
+    content = listing_image.content
+    if content is not None and content.image and content.variants:
+        return {'image': content.image.name, 'thumbnail': content.thumbnail.name, 'variants': content.variants}
+
+    ext = listing_image.original.name.split('.')[-1].lower()
+    if content is None:
+        # Uploaded before content-addressed storage
+        upload_dir = f'listings/{listing_image.listing_id}'
+        filename = f'{uuid.uuid4()}.{ext}'
+        image_name = f'{upload_dir}/{filename}'
+        thumb_name = f'{upload_dir}/thumbnails/thumb_{filename}'
+        variant_name = f'{upload_dir}/variants/{listing_image.id}_{{width}}w.{{ext}}'
+        save = default_storage.save
+    else:
+        image_name = content_name(content.sha256, f'_large.{ext}')
+        thumb_name = content_name(content.sha256, f'_thumb.{ext}')
+        variant_name = content_name(content.sha256, '_{width}w.{ext}')
+        save = save_once
+
+    with default_storage.open(listing_image.original.name, 'rb') as original:
+        image_bytes, thumb_bytes, variants = derive(original, ext)
+    return {
+        'image': save(image_name, ContentFile(image_bytes)),
+        'thumbnail': save(thumb_name, ContentFile(thumb_bytes)),
+        'variants': [
+            {
+                'width': width,
+                'height': height,
+                'format': name,
+                'size': len(data),
+                'path': save(variant_name.format(width=width, ext=variant_ext), ContentFile(data)),
+            }
+            for width, height, name, variant_ext, data in variants
+        ],
+    }
+
+
+def process_images(image_ids, workers=1):
+    """Process pending uploads, deriving up to ``workers`` images at a time.
+
+    Pillow releases the GIL while decoding, resampling and encoding, so a
+    thread pool spreads the work across cores. Database updates stay on the
+    calling thread. Images with the same content are derived once. A
+    failure only affects its own content's images, which are marked failed.
+    Returns {image_id: error message or None} for the images this call
+    processed; images claimed by another worker are left out.
+    """
+    groups = defaultdict(list)
+    for listing_image in claim(image_ids):
+        groups[listing_image.content_id or listing_image.id].append(listing_image)
+    results = {}
+
+    def finish(group, fields, error):
+        ids = [listing_image.id for listing_image in group]
+        if error is None:
+            ListingImage.objects.filter(id__in=ids).update(status=ListingImage.STATUS_READY, **fields)
+            if group[0].content_id:
+                ImageContent.objects.filter(pk=group[0].content_id).update(**fields)
+        else:
+            logger.error("Error processing images %s: %s", ids, error, exc_info=error)
+            ListingImage.objects.filter(id__in=ids).update(status=ListingImage.STATUS_FAILED)
+        results.update((image_id, None if error is None else str(error)) for image_id in ids)
+
+    if workers <= 1 or len(groups) <= 1:
+        for group in groups.values():
+            try:
+                fields = derive_and_store(group[0])
+            except Exception as e:
+                finish(group, None, e)
+            else:
+                finish(group, fields, None)
+        return results
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-derivation') as pool:
+        futures = {pool.submit(derive_and_store, group[0]): group for group in groups.values()}
+        for future in as_completed(futures):
+            error = future.exception()
+            finish(futures[future], None if error else future.result(), error)
+    return results
+
+
+def process_image(image_id):
+    """Process one pending upload. Returns False if another worker claimed it."""
+    return bool(process_images([image_id]))
+
+
+def pending_image_ids(limit=None):
+    image_ids = ListingImage.objects.filter(status=ListingImage.STATUS_PENDING).order_by(
+        'created_at'
+    ).values_list('id', flat=True)
+    return list(image_ids[:limit] if limit else image_ids)
+
+
+def process_pending(limit=None, workers=1):
+    """Process queued uploads, oldest first. Returns {image_id: error or None}."""
+    return process_images(pending_image_ids(limit), workers)
+
+
+_executor = None
+
+
+def _run_in_background(image_id):
+    try:
+        process_image(image_id)
+    except Exception:
+        logger.exception("Error processing image %s", image_id)
+    finally:
+        # Worker threads outlive requests, so do not hold connections open
+        connections.close_all()
+
+
+def enqueue(image_ids):
+    """Start processing the images in this process once the transaction commits"""
+    global _executor
+    threads = getattr(settings, 'IMAGE_PROCESSING_THREADS', 2)
+    if not threads:
+        return
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='image-processing')
+
+    def submit():
+        for image_id in image_ids:
+            _executor.submit(_run_in_background, image_id)
+    transaction.on_commit(submit)
@@ -0,0 +1,74 @@
+"""
+Image decoding and resizing shared by the upload pipelines.
+
+Phone photos are 12MP or more but we never serve anything over 1200px, so
+``open_scaled`` avoids decoding pixels that would be thrown away:
+
+- JPEGs are decoded at 1/2, 1/4 or 1/8 scale straight from the DCT
+  coefficients with ``Image.draft()``, picking the smallest scale that is
+  still at least as large as the target.
+- Anything still more than twice the target is shrunk with ``reduce()``, a
+  cheap box filter, before the final LANCZOS resize.
+- EXIF orientation is applied last, to the small image, with a lossless
+  transpose.
+
+Callers decode an upload once and derive every other size from the result.
+"""
+import io
+
+from PIL import Image
+
+ORIENTATION_TAG = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Resize from at least this multiple of the target with LANCZOS, so the box
+# filtering of draft()/reduce() never shows in the result
+REDUCING_GAP = 2
+
+
+def fit(size, box):
+    """Scale ``size`` down (never up) to fit inside ``box``, keeping the aspect ratio"""
+    width, height = size
+    scale = min(box[0] / width, box[1] / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def open_scaled(fp, box):
+    """Decode an image file oriented upright and resized to fit inside ``box``"""
+    img = Image.open(fp)
+    orientation = img.getexif().get(ORIENTATION_TAG)
+    if orientation in (5, 6, 7, 8):
+        # The stored pixels are rotated a quarter turn from how they display
+        box = (box[1], box[0])
+    target = fit(img.size, box)
+
+    # JPEG only: decode at the smallest DCT scale that covers the target
+    img.draft(None, target)
+    img.load()
+
+    factor = min(img.width // (target[0] * REDUCING_GAP), img.height // (target[1] * REDUCING_GAP))
+    if factor >= 2:
+        img = img.reduce(factor)
+    if img.size != target:
+        img = img.resize(target, Image.LANCZOS)
+
+    if orientation in ORIENTATION_TRANSPOSE:
+        img = img.transpose(ORIENTATION_TRANSPOSE[orientation])
+    return img
+
+
+def encode(img, save_format, **options):
+    """Encode ``img``, dropping transparency for formats without it"""
+    if save_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, format=save_format, **options)
+    return buffer.getvalue()
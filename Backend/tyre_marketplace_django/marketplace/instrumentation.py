@@ -0,0 +1,108 @@
+import logging
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter:
+    """Database execute wrapper that counts queries and the time spent in them"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+class RequestInstrumentationMiddleware:
+    """Log a query-count and timing summary for a sample of requests.
+
+    Sampling is controlled by REQUEST_INSTRUMENTATION_SAMPLE_RATE (0.0 to
+    1.0). At the default of 0 a request only pays for one comparison; no
+    wrapper is installed and nothing is logged.
+
+    Under ASGI the middleware runs async so that async views (the unread
+    long poll) do not tie up a thread while they wait. Queries then run
+    through sync_to_async on the request's thread-sensitive worker thread,
+    not the event loop's, so the execute wrapper is installed on that
+    thread's connection instead.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'REQUEST_INSTRUMENTATION_SAMPLE_RATE', 0.0)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.sampled():
+            return self.get_response(request)
+
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        self.log(request, response, time.perf_counter() - start, counter)
+        return response
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+
+        counter = QueryCounter()
+        start = time.perf_counter()
+        # The wrapper has to stay installed across awaits, so it is added and
+        # removed by hand rather than with connection.execute_wrapper()
+        await sync_to_async(self.add_wrapper)(counter)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(self.remove_wrapper)(counter)
+        self.log(request, response, time.perf_counter() - start, counter)
+        return response
+
+    @staticmethod
+    def add_wrapper(counter):
+        connection.execute_wrappers.append(counter)
+
+    @staticmethod
+    def remove_wrapper(counter):
+        connection.execute_wrappers.remove(counter)
+
+    def log(self, request, response, elapsed, counter):
+        extra = {
+            'method': request.method,
+            'path': request.path,
+            'status_code': response.status_code,
+            'duration_ms': round(elapsed * 1000, 1),
+            'query_count': counter.count,
+            'query_ms': round(counter.duration * 1000, 1),
+        }
+        logger.info(
+            "%s %s status=%s duration_ms=%.1f queries=%d query_ms=%.1f",
+            request.method,
+            request.path,
+            response.status_code,
+            elapsed * 1000,
+            counter.count,
+            counter.duration * 1000,
+            extra=extra,
+        )
@@ -0,0 +1,357 @@
+import asyncio
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from PIL import Image, ImageFilter
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken
+
+from marketplace import views
+from marketplace.images import process_images, store_upload
+from marketplace.models import User, TireListing, Message
+from marketplace.realtime import MESSAGES_WEBSOCKET_PATH, get_broker, websocket_application
+from marketplace.search import IContainsSearchBackend, get_search_backend
+
+BRANDS = ['Michelin', 'Bridgestone', 'Goodyear', 'Continental', 'Pirelli', 'Dunlop', 'Yokohama', 'Hankook', 'Toyo', 'Falken']
+MODELS = ['Pilot Sport', 'Potenza', 'Eagle F1', 'PremiumContact', 'P Zero', 'SP Sport', 'Advan', 'Ventus', 'Proxes', 'Azenis']
+ADJECTIVES = ['Premium', 'Nearly new', 'Used', 'Grippy', 'Quiet', 'Budget', 'Performance', 'Winter', 'Durable', 'Cheap']
+SEARCH_QUERIES = ['michelin', 'pilot sport', 'winter tyres', 'continental premiumcontact', 'zzznomatch']
+
+DEFAULT_SIZES = {
+    'search': [100000, 1000000],
+    'conversations': [100, 1000, 10000],
+    'websockets': [1000, 10000],
+    'images': [10],
+    'decode': [12, 24],
+}
+
+# Run in a fresh interpreter per method so that peak RSS is its own (Linux
+# only). Prints the median milliseconds per image and the peak RSS growth in MiB.
+DECODE_SCRIPT = '''
+import json, statistics, sys, time
+from PIL import Image
+from marketplace import imaging
+
+path, method, repeat = sys.argv[1], sys.argv[2], int(sys.argv[3])
+
+def peak_rss_kib():
+    # VmHWM, unlike ru_maxrss, starts afresh at exec instead of inheriting
+    # the high-water mark of the parent process
+    with open('/proc/self/status') as status:
+        return next(int(line.split()[1]) for line in status if line.startswith('VmHWM:'))
+
+def full():
+    # Decode every pixel, then shrink (the approach before imaging.py)
+    img = Image.open(path)
+    img.load()
+    img.thumbnail((1200, 1200), Image.LANCZOS)
+    img.copy().thumbnail((300, 300), Image.LANCZOS)
+
+def scaled():
+    img = imaging.open_scaled(path, (1200, 1200))
+    img.copy().thumbnail((300, 300), Image.LANCZOS)
+
+baseline = peak_rss_kib()
+timings = []
+for _ in range(repeat):
+    start = time.perf_counter()
+    {'full': full, 'scaled': scaled}[method]()
+    timings.append((time.perf_counter() - start) * 1000)
+peak = peak_rss_kib()
+print(json.dumps([statistics.median(timings), (peak - baseline) / 1024]))
+'''
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark hot paths against synthetic data. Everything runs inside a '
+        'transaction that is rolled back, so the database is left untouched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'target',
+            choices=list(DEFAULT_SIZES),
+            help='What to benchmark'
+        )
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            help='Listings (search), conversation partners (conversations), open connections (websockets), '
+                 'images per upload (images) or photo megapixels (decode) to benchmark at '
+                 '(default depends on the target)'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Parallel image workers to compare with serial processing (default: number of CPUs)'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Timed runs per measurement; the median is reported (default: 5)'
+        )
+
+    def handle(self, *args, **options):
+        options['sizes'] = options['sizes'] or DEFAULT_SIZES[options['target']]
+        try:
+            with transaction.atomic():
+                getattr(self, f'benchmark_{options["target"]}')(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def time_it(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+    def create_sellers(self, count=50):
+        return User.objects.bulk_create([
+            User(username=f'bench_{uuid.uuid4().hex[:12]}', email=f'{uuid.uuid4().hex[:12]}@bench.local')
+            for _ in range(count)
+        ])
+
+    def create_listings(self, sellers, count, batch_size=5000):
+        created = 0
+        while created < count:
+            batch = []
+            for _ in range(min(batch_size, count - created)):
+                brand = random.choice(BRANDS)
+                model = random.choice(MODELS)
+                batch.append(TireListing(
+                    seller=random.choice(sellers),
+                    title=f'{random.choice(ADJECTIVES)} {brand} {model}',
+                    description=f'{random.choice(ADJECTIVES)} set of {brand} tyres in good condition',
+                    price=Decimal(random.randint(20, 500)),
+                    condition=random.choice(['new', 'used']),
+                    tire_type=random.choice([choice[0] for choice in TireListing.TIRE_TYPE_CHOICES]),
+                    width=random.choice([185, 195, 205, 215, 225, 235, 245]),
+                    aspect_ratio=random.choice([40, 45, 50, 55, 60, 65]),
+                    diameter=random.choice([15, 16, 17, 18, 19]),
+                    load_index=random.randint(80, 110),
+                    speed_rating=random.choice(['H', 'V', 'W', 'Y']),
+                    tread_depth=Decimal('7.50'),
+                    brand=brand,
+                    model=model,
+                    quantity=random.choice([1, 2, 4]),
+                ))
+            TireListing.objects.bulk_create(batch)
+            created += len(batch)
+
+    def benchmark_search(self, options):
+        backends = [('icontains', IContainsSearchBackend()), ('fulltext', get_search_backend())]
+        sellers = self.create_sellers()
+        existing = 0
+        for size in sorted(options['sizes']):
+            self.stdout.write(f'Seeding {size - existing} listings...')
+            self.create_listings(sellers, size - existing)
+            existing = size
+            # bulk_create skips signals, so build the index in one pass
+            get_search_backend().rebuild()
+
+            self.stdout.write(f'\n{size} listings (median of {options["repeat"]} runs, COUNT + first page of 12)')
+            for query in SEARCH_QUERIES:
+                row = [f'  {query!r:32}']
+                for name, backend in backends:
+                    def run():
+                        listings = backend.search(TireListing.objects.filter(is_active=True), query)
+                        listings.count()
+                        list(listings.order_by('search_rank', '-created_at')[:12])
+                    row.append(f'{name}: {self.time_it(run, options["repeat"]):9.1f} ms')
+                self.stdout.write('  '.join(row))
+
+    def benchmark_conversations(self, options):
+        factory = APIRequestFactory()
+        user = self.create_sellers(1)[0]
+        existing = 0
+        for size in sorted(options['sizes']):
+            self.stdout.write(f'Seeding {size - existing} conversation partners...')
+            partners = self.create_sellers(size - existing)
+            Message.objects.bulk_create([
+                Message(sender=partner, receiver=user, content=f'Message {i}', is_read=bool(i % 2))
+                for partner in partners
+                for i in range(5)
+            ] + [Message(sender=user, receiver=partner, content='Reply') for partner in partners])
+            existing = size
+
+            self.stdout.write(f'\n{size} partners (median of {options["repeat"]} runs)')
+            for label, params in (('full list', {}), ('first page of 20', {'page_size': 20})):
+                def run():
+                    request = factory.get('/api/messages/conversations/', params)
+                    force_authenticate(request, user=user)
+                    views.get_conversations(request)
+                with CaptureQueriesContext(connection) as queries:
+                    run()
+                self.stdout.write(
+                    f'  {label:18} queries: {len(queries.captured_queries):3}  '
+                    f'{self.time_it(run, options["repeat"]):9.1f} ms'
+                )
+
+    def benchmark_websockets(self, options):
+        for size in sorted(options['sizes']):
+            asyncio.run(self.hold_websockets(size))
+
+    async def hold_websockets(self, count):
+        """Open ``count`` idle connections against the ASGI app in memory and push one event to each"""
+        delivered = asyncio.Event()
+        received = 0
+
+        async def client(user_id):
+            nonlocal received
+            incoming = asyncio.Queue()
+            token = AccessToken()
+            token['user_id'] = user_id
+
+            async def send(message):
+                nonlocal received
+                if message['type'] == 'websocket.send':
+                    received += 1
+                    if received == count:
+                        delivered.set()
+
+            await incoming.put({'type': 'websocket.connect'})
+            scope = {
+                'type': 'websocket',
+                'path': MESSAGES_WEBSOCKET_PATH,
+                'query_string': f'token={token}'.encode(),
+                'headers': [],
+            }
+            return incoming, asyncio.ensure_future(websocket_application(scope, incoming.get, send))
+
+        user_ids = [str(uuid.uuid4()) for _ in range(count)]
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        clients = [await client(user_id) for user_id in user_ids]
+        # Let every connection reach its idle wait
+        await asyncio.sleep(0)
+        while any(incoming.qsize() for incoming, _ in clients):
+            await asyncio.sleep(0.01)
+        connect_ms = (time.perf_counter() - start) * 1000
+        per_connection = (tracemalloc.get_traced_memory()[0] - baseline) / count
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        broker = get_broker()
+        for user_id in user_ids:
+            broker.publish(user_id, {'type': 'message.new', 'message': {'content': 'Benchmark'}})
+        await asyncio.wait_for(delivered.wait(), timeout=60)
+        fanout_ms = (time.perf_counter() - start) * 1000
+
+        for incoming, _ in clients:
+            await incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.gather(*(task for _, task in clients))
+
+        self.stdout.write(
+            f'{count} idle connections: opened in {connect_ms:.0f} ms, '
+            f'{per_connection / 1024:.1f} KiB each '
+            f'(~{int(2 ** 30 / per_connection)} per GiB), '
+            f'one event to each delivered in {fanout_ms:.0f} ms'
+        )
+
+    def phone_photo(self, max_bytes=5 * 1024 * 1024, size=(4000, 3000)):
+        """A noisy JPEG (12MP by default) just under the upload size limit, like a phone photo"""
+        noise = Image.effect_noise(size, 60).filter(ImageFilter.GaussianBlur(0.7))
+        photo = Image.merge('RGB', (noise, noise.rotate(180), noise.transpose(Image.FLIP_LEFT_RIGHT)))
+        for quality in range(95, 50, -5):
+            buffer = io.BytesIO()
+            photo.save(buffer, 'JPEG', quality=quality)
+            if buffer.tell() <= max_bytes:
+                return buffer.getvalue()
+        return buffer.getvalue()
+
+    def benchmark_images(self, options):
+        media_root = tempfile.mkdtemp()
+        try:
+            with override_settings(MEDIA_ROOT=media_root, IMAGE_PROCESSING_THREADS=0):
+                self.run_image_benchmark(options)
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+    def run_image_benchmark(self, options):
+        listing = TireListing.objects.create(
+            seller=self.create_sellers(1)[0], title='Benchmark', price=Decimal(100), condition='new',
+            tire_type='summer', width=225, aspect_ratio=45, diameter=17, load_index=94, speed_rating='V',
+            tread_depth=Decimal('8.00'), brand='Michelin', quantity=4,
+        )
+        photo = self.phone_photo()
+        for count in options['sizes']:
+            self.stdout.write(
+                f'\n{count} x {len(photo) / 2 ** 20:.1f} MiB 4000x3000 JPEGs per upload '
+                f'(median of {options["repeat"]} runs)'
+            )
+
+            def upload(unique=True):
+                # Bytes after the end of the JPEG are ignored by decoders but
+                # make each upload distinct, so nothing is deduplicated
+                return [
+                    store_upload(listing, SimpleUploadedFile(
+                        f'{i}.jpg', photo + (uuid.uuid4().bytes if unique else b''), 'image/jpeg'
+                    )).id
+                    for i in range(count)
+                ]
+            self.stdout.write(f'  upload request (store originals)  {self.time_it(upload, options["repeat"]):9.1f} ms')
+
+            for label, workers in (('serial', 1), (f'{options["workers"]} workers', options['workers'])):
+                timings = []
+                for _ in range(options['repeat']):
+                    image_ids = upload()
+                    start = time.perf_counter()
+                    results = process_images(image_ids, workers)
+                    timings.append((time.perf_counter() - start) * 1000)
+                    failed = [error for error in results.values() if error]
+                    if failed:
+                        self.stderr.write(f'  {len(failed)} images failed: {failed[0]}')
+                self.stdout.write(f'  derivation, {label:23} {statistics.median(timings):9.1f} ms')
+
+            # Seed the content store, then time re-uploads of the same photo
+            process_images(upload(unique=False)[:1])
+            self.stdout.write(
+                f'  duplicate upload (reuse derivatives) {self.time_it(lambda: upload(unique=False), options["repeat"]):6.1f} ms'
+            )
+
+    def benchmark_decode(self, options):
+        for megapixels in options['sizes']:
+            width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+            size = (width, width * 3 // 4)
+            with tempfile.NamedTemporaryFile(suffix='.jpg') as photo:
+                photo.write(self.phone_photo(max_bytes=megapixels * 2 ** 20, size=size))
+                photo.flush()
+                self.stdout.write(
+                    f'\n{size[0]}x{size[1]} JPEG ({os.path.getsize(photo.name) / 2 ** 20:.1f} MiB) '
+                    f'to 1200px + 300px thumbnail (median of {options["repeat"]} runs)'
+                )
+                for method in ('full', 'scaled'):
+                    result = subprocess.run(
+                        [sys.executable, '-c', DECODE_SCRIPT, photo.name, method, str(options['repeat'])],
+                        cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+                    )
+                    ms, peak_mib = json.loads(result.stdout)
+                    self.stdout.write(f'  {method:7} {ms:8.1f} ms per image   peak RSS +{peak_mib:6.1f} MiB')
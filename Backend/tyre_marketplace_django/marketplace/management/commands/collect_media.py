@@ -0,0 +1,171 @@
+import os
+import re
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries
+from django.db.models import Q
+
+from marketplace.media import media_name
+from marketplace.models import ImageContent, ListingImage, User
+
+# The MEDIA_ROOT directories uploads are stored in; nothing else is touched
+UPLOAD_DIRS = ['images', 'listings', 'tire_images', 'profile_images']
+
+UUID = r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+LEGACY_VARIANT_NAME = re.compile(rf'^({UUID})_\d+w\.')
+# <user id>_<size>_<key>.<ext>, see images.derive_avatars
+AVATAR_NAME = re.compile(rf'^({UUID})_\d+_')
+
+
+def walk_files(root, top):
+    """Yield (name, mtime, size) for every file under ``top``, relative to ``root``.
+
+    Directories are read lazily with scandir, so memory does not grow with
+    the number of files.
+    """
+    stack = [top]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, directory)) as entries:
+                for entry in entries:
+                    name = f'{directory}/{entry.name}'
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(name)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        yield name, stat.st_mtime, stat.st_size
+        except FileNotFoundError:
+            continue
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def referenced(names):
+    """The subset of ``names`` that a ListingImage, ImageContent or User uses"""
+    names = set(names)
+    found = set()
+    for model in (ListingImage, ImageContent):
+        found.update(*model.objects.filter(
+            Q(image__in=names) | Q(thumbnail__in=names) | Q(original__in=names)
+        ).values_list('image', 'thumbnail', 'original'))
+
+    # Variants are only listed in JSON, so look at the rows their file names
+    # point to: <sha256>_<width>w.<ext> under images/ and
+    # <image id>_<width>w.<ext> for uploads from before content addressing
+    basenames = [name.rsplit('/', 1)[-1] for name in names]
+    owners = [
+        ImageContent.objects.filter(sha256__in={basename[:64] for basename in basenames}),
+        ListingImage.objects.filter(id__in={
+            match[1] for match in map(LEGACY_VARIANT_NAME.match, basenames) if match
+        }),
+    ]
+    for queryset in owners:
+        for variants in queryset.values_list('variants', flat=True):
+            found.update(variant['path'] for variant in variants)
+
+    urls = [settings.MEDIA_URL + name for name in names if name.startswith('profile_images/')]
+    found.update(map(media_name, User.objects.filter(profile_image_url__in=urls).values_list(
+        'profile_image_url', flat=True
+    )))
+    avatar_owners = {match[1] for match in map(AVATAR_NAME.match, basenames) if match}
+    for variants in User.objects.filter(id__in=avatar_owners).values_list('profile_image_variants', flat=True):
+        found.update(map(media_name, variants.values()))
+    return found & names
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete uploaded files that no listing image or user refers to any more, '
+        'and report rows whose files are missing. Files are normally deleted along '
+        'with their rows; this sweeps up what that missed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would be deleted without deleting anything'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Files checked against the database per query batch (default: 500)'
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=3600,
+            help='Leave files younger than this many seconds alone, as uploads in progress '
+                 'save their files before their rows commit (default: 3600)'
+        )
+        parser.add_argument(
+            '--skip-missing',
+            action='store_true',
+            help='Do not check the database rows for missing files'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            root = default_storage.path('')
+        except NotImplementedError:
+            raise CommandError('collect_media only supports file storage on the local filesystem')
+
+        cutoff = time.time() - options['min_age']
+        files = (
+            entry for top in UPLOAD_DIRS for entry in walk_files(root, top)
+            if entry[1] < cutoff
+        )
+        scanned = orphaned = freed = 0
+        for batch in batches(files, options['batch_size']):
+            scanned += len(batch)
+            in_use = referenced(name for name, _, _ in batch)
+            reset_queries()  # Keep DEBUG's query log from growing with the tree
+            for name, _, size in batch:
+                if name in in_use:
+                    continue
+                orphaned += 1
+                freed += size
+                if options['verbosity'] >= 2:
+                    self.stdout.write(f'  {name}')
+                if not options['dry_run']:
+                    default_storage.delete(name)
+
+        action = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {orphaned} of {scanned} files ({freed / 2 ** 20:.1f} MiB)'
+        ))
+
+        if not options['skip_missing']:
+            self.report_missing(options['batch_size'])
+
+    def report_missing(self, batch_size):
+        images = ListingImage.objects.values_list('id', 'image', 'thumbnail', 'original', 'variants')
+        missing_images = 0
+        for image_id, *names, variants in images.iterator(chunk_size=batch_size):
+            names += [variant['path'] for variant in variants]
+            if any(name and not default_storage.exists(name) for name in names):
+                missing_images += 1
+                self.stdout.write(f'  Listing image {image_id} has missing files', self.style.WARNING)
+
+        users = User.objects.exclude(profile_image_url__isnull=True).exclude(profile_image_url='')
+        missing_avatars = 0
+        rows = users.values_list('id', 'profile_image_url', 'profile_image_variants')
+        for user_id, url, variants in rows.iterator(chunk_size=batch_size):
+            names = map(media_name, [url, *variants.values()])
+            if any(name and not default_storage.exists(name) for name in names):
+                missing_avatars += 1
+                self.stdout.write(f'  User {user_id} has a missing profile image', self.style.WARNING)
+
+        self.stdout.write(
+            f'{missing_images} listing images and {missing_avatars} users refer to missing files'
+        )
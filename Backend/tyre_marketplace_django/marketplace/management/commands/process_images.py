@@ -0,0 +1,104 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+
+from marketplace.images import backfill_avatars, process_pending
+from marketplace.models import ListingImage, User
+
+
+class Command(BaseCommand):
+    help = (
+        'Resize uploaded listing images that are waiting in the processing queue. '
+        'Runs as a long-lived worker unless --once is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the queue and exit instead of polling for new uploads'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50,
+            help='Images claimed per pass over the queue (default: 50)'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Images resized in parallel (default: number of CPUs)'
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=2.0,
+            help='Seconds to wait when the queue is empty (default: 2)'
+        )
+        parser.add_argument(
+            '--backfill-variants',
+            action='store_true',
+            help='Queue ready images that have no responsive variants yet, e.g. uploads from before '
+                 'variants existed. Images without a stored original are reprocessed from their resized copy.'
+        )
+        parser.add_argument(
+            '--backfill-avatars',
+            action='store_true',
+            help='Make the avatar sizes of profile images uploaded before they existed'
+        )
+        parser.add_argument(
+            '--requeue',
+            action='store_true',
+            help='Put images left in "processing" by a crashed worker back in the queue first. '
+                 'Only use this while no other worker is running.'
+        )
+
+    def handle(self, *args, **options):
+        if options['requeue']:
+            requeued = ListingImage.objects.filter(status=ListingImage.STATUS_PROCESSING).update(
+                status=ListingImage.STATUS_PENDING
+            )
+            self.stdout.write(f'Requeued {requeued} images')
+
+        if options['backfill_variants']:
+            missing = ListingImage.objects.filter(status=ListingImage.STATUS_READY, variants=[]).exclude(image='')
+            missing.filter(Q(original__isnull=True) | Q(original='')).update(original=F('image'))
+            queued = missing.update(status=ListingImage.STATUS_PENDING)
+            self.stdout.write(f'Queued {queued} images for variants')
+
+        if options['backfill_avatars']:
+            self.backfill_avatars()
+
+        total = 0
+        while True:
+            results = process_pending(options['batch_size'], options['workers'])
+            total += len(results)
+            for image_id, error in results.items():
+                if error:
+                    self.stderr.write(f'Image {image_id} failed: {error}')
+            if results:
+                self.stdout.write(f'Processed {len(results)} images')
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {total} images'))
+
+    def backfill_avatars(self):
+        users = User.objects.filter(profile_image_variants={}).exclude(profile_image_url__isnull=True).exclude(
+            profile_image_url=''
+        )
+        done = 0
+        for user in users.iterator():
+            try:
+                backfill_avatars(user)
+            except (OSError, SyntaxError, ValueError) as e:
+                self.stderr.write(f'User {user.id} profile image failed: {e}')
+                continue
+            user.save(update_fields=['profile_image_variants'])
+            done += 1
+        self.stdout.write(f'Made avatars for {done} users')
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+from marketplace.models import User, Review
+
+
+class Command(BaseCommand):
+    help = 'Recompute every user\'s rating_sum, rating_count and rating from their received reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of users updated per transaction (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        received = Review.objects.filter(reviewed_user=OuterRef('pk')).order_by().values('reviewed_user')
+        rating_sum = Subquery(received.annotate(total=Sum('rating')).values('total'))
+        rating_count = Subquery(received.annotate(total=Count('id')).values('total'))
+
+        user_ids = User.objects.order_by('pk').values_list('pk', flat=True)
+        batch = []
+        updated = 0
+        for user_id in user_ids.iterator(chunk_size=batch_size):
+            batch.append(user_id)
+            if len(batch) >= batch_size:
+                updated += self.rebuild(batch, rating_sum, rating_count)
+                batch = []
+        if batch:
+            updated += self.rebuild(batch, rating_sum, rating_count)
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt rating aggregates for {updated} users'))
+
+    def rebuild(self, user_ids, rating_sum, rating_count):
+        users = User.objects.filter(pk__in=user_ids)
+        with transaction.atomic():
+            users.update(
+                rating_sum=Coalesce(rating_sum, 0),
+                rating_count=Coalesce(rating_count, 0),
+            )
+            users.update(
+                rating=Cast(
+                    Coalesce(Cast(F('rating_sum'), models.FloatField()) / NullIf(F('rating_count'), 0), 0.0),
+                    models.DecimalField(max_digits=3, decimal_places=2),
+                )
+            )
+        return len(user_ids)
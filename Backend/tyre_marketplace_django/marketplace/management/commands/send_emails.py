@@ -0,0 +1,76 @@
+import time
+from datetime import timedelta
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from marketplace.outbox import BATCH_SIZE, purge_sent, send_pending
+
+PURGE_INTERVAL = 3600
+
+
+class Command(BaseCommand):
+    help = (
+        'Send queued emails (see marketplace/outbox.py), retrying failed ones with backoff. '
+        'Runs as a long-lived worker unless --once is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Send the emails that are due and exit instead of polling for new ones'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=BATCH_SIZE,
+            help=f'Emails claimed per pass over the queue (default: {BATCH_SIZE})'
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=2.0,
+            help='Seconds to wait when no email is due (default: 2)'
+        )
+        parser.add_argument(
+            '--keep-days',
+            type=float,
+            default=7,
+            help='Delete sent emails after this many days (default: 7)'
+        )
+
+    def handle(self, *args, **options):
+        keep = timedelta(days=options['keep_days'])
+        purged_at = None
+        sent = failed = 0
+        # One connection for as long as there are emails to send; it is
+        # closed while the queue is empty rather than left to time out
+        connection = get_connection()
+        try:
+            while True:
+                if purged_at is None or time.monotonic() - purged_at >= PURGE_INTERVAL:
+                    purged = purge_sent(keep)
+                    purged_at = time.monotonic()
+                    if purged:
+                        self.stdout.write(f'Deleted {purged} sent emails')
+
+                results = send_pending(options['batch_size'], connection)
+                for email_id, error in results.items():
+                    if error:
+                        self.stderr.write(f'Email {email_id} failed: {error}')
+                batch_failed = sum(1 for error in results.values() if error)
+                sent += len(results) - batch_failed
+                failed += batch_failed
+                if results:
+                    self.stdout.write(f'Sent {len(results) - batch_failed} of {len(results)} emails')
+                    continue
+
+                connection.close()
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+        finally:
+            connection.close()
+
+        self.stdout.write(self.style.SUCCESS(f'Sent {sent} emails, {failed} failed'))
@@ -0,0 +1,149 @@
+import os
+import posixpath
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries
+
+from marketplace.media import media_name
+from marketplace.models import ImageContent, ListingImage, User
+from marketplace.storage import shard_name
+
+
+class Command(BaseCommand):
+    help = (
+        'Move media stored before the sharded layout (see marketplace/storage.py) into it '
+        'and rewrite the paths stored in the database. Each file is moved before its row '
+        'is updated, so the command can be interrupted and run again at any point.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rows read and updated per batch (default: 500)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count what would be moved without changing anything'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            default_storage.path('')
+        except NotImplementedError:
+            raise CommandError('shard_media only supports file storage on the local filesystem')
+        self.dry_run = options['dry_run']
+        self.moved = 0
+
+        # Shared content first: the listing images using it then find their
+        # files already moved and only need their paths rewritten
+        updated = self.shard_rows(ImageContent.objects.all(), self.shard_files, options['batch_size'])
+        updated += self.shard_rows(ListingImage.objects.all(), self.shard_files, options['batch_size'])
+        updated += self.shard_rows(
+            User.objects.exclude(profile_image_url__isnull=True).exclude(profile_image_url=''),
+            self.shard_profile_image, options['batch_size']
+        )
+
+        if self.dry_run:
+            self.stdout.write(self.style.SUCCESS(f'Would move {self.moved} files and update {updated} rows'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Moved {self.moved} files and updated {updated} rows'))
+
+    def shard_rows(self, queryset, shard_row, batch_size):
+        """Run ``shard_row`` over the rows in primary key order, saving the changed ones"""
+        updated = 0
+        last_pk = None
+        while True:
+            batch = queryset.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if not batch:
+                return updated
+            last_pk = batch[-1].pk
+
+            changed_fields = set()
+            changed = []
+            for row in batch:
+                fields = shard_row(row)
+                if fields:
+                    changed.append(row)
+                    changed_fields.update(fields)
+            if changed and not self.dry_run:
+                queryset.model.objects.bulk_update(changed, sorted(changed_fields))
+            updated += len(changed)
+            reset_queries()
+
+    def shard_files(self, row):
+        """Move a ListingImage's or ImageContent's files; return the changed fields"""
+        # Files of shared content were counted with their ImageContent
+        count = getattr(row, 'content_id', None) is None
+        changed = []
+        for field in ('original', 'image', 'thumbnail'):
+            name = getattr(row, field).name
+            new_name = self.move(name, count) if name else name
+            if new_name != name:
+                setattr(row, field, new_name)
+                changed.append(field)
+        for variant in row.variants:
+            new_name = self.move(variant['path'], count)
+            if new_name != variant['path']:
+                variant['path'] = new_name
+                if 'variants' not in changed:
+                    changed.append('variants')
+        return changed
+
+    def shard_profile_image(self, user):
+        changed = []
+        name = media_name(user.profile_image_url)
+        new_name = self.move(name) if name else name
+        if new_name != name:
+            user.profile_image_url = settings.MEDIA_URL + new_name
+            changed.append('profile_image_url')
+        for size, url in user.profile_image_variants.items():
+            name = media_name(url)
+            new_name = self.move(name) if name else name
+            if new_name != name:
+                user.profile_image_variants[size] = settings.MEDIA_URL + new_name
+                if 'profile_image_variants' not in changed:
+                    changed.append('profile_image_variants')
+        return changed
+
+    def move(self, name, count=True):
+        """Move a file to its sharded name and return that, or ``name`` if it stays put.
+
+        A file that is already at the sharded name (moved by an earlier run, or
+        shared with a row handled before) just gets the new name.
+        """
+        new_name = shard_name(name)
+        if new_name == name:
+            return name
+        source, target = default_storage.path(name), default_storage.path(new_name)
+        if os.path.exists(target):
+            if os.path.exists(source):
+                self.stderr.write(f'Not moving {name}: {new_name} already exists')
+                return name
+            return new_name
+        if not os.path.exists(source):
+            self.stderr.write(f'Not moving {name}: the file is missing')
+            return name
+
+        self.moved += count
+        if not self.dry_run:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(source, target)
+            self.remove_empty_directories(posixpath.dirname(name))
+        return new_name
+
+    def remove_empty_directories(self, directory):
+        """Remove ``directory`` and its parents once emptied, keeping the top-level one"""
+        while '/' in directory:
+            try:
+                os.rmdir(default_storage.path(directory))
+            except OSError:
+                return
+            directory = posixpath.dirname(directory)
@@ -0,0 +1,168 @@
+"""
+Serving uploaded media with HTTP caching, and deleting it when unused.
+
+Every media response carries a strong ETag and Last-Modified, so repeat
+requests are answered with 304 Not Modified. Files that are never rewritten
+under the same name are sent with a one-year ``immutable`` Cache-Control,
+so browsers and proxies do not even revalidate them:
+
+- content-addressed uploads under images/ (see images.py)
+- versioned names containing a UUID, e.g. listings/<id>/<uuid>.jpg or
+  profile_images/<user id>/<uuid>.png
+
+Anything else must be revalidated on every use. Single byte ranges are
+supported for partial and resumed downloads.
+
+In production the file transfer can be handed to the front-end server by
+setting MEDIA_SENDFILE_HEADER: with "X-Sendfile" (Apache mod_xsendfile,
+lighttpd) the header carries the absolute file path; with
+"X-Accel-Redirect" (nginx) it carries MEDIA_ACCEL_REDIRECT_PREFIX plus the
+media path, which should map to an ``internal`` location aliased to
+MEDIA_ROOT. Caching headers are still set here; the server handles ranges.
+
+Files are deleted after commit when the rows using them are deleted (see
+signals.py). The ``collect_media`` command sweeps up whatever that misses.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote, unquote, urlsplit
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotAllowed
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+
+IMMUTABLE_PATH = re.compile(
+    r'^images/'
+    r'|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}[^/]*$'
+)
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def media_name(url):
+    """The storage name behind a MEDIA_URL link, or None for anything else"""
+    if not url:
+        return None
+    path = urlsplit(url).path
+    if not path.startswith(settings.MEDIA_URL):
+        return None
+    return unquote(path[len(settings.MEDIA_URL):]) or None
+
+
+def delete_on_commit(names):
+    """Delete stored files once the current transaction commits"""
+    names = {name for name in names if name}
+    if not names:
+        return
+
+    def delete():
+        for name in names:
+            default_storage.delete(name)
+    transaction.on_commit(delete)
+
+
+def is_immutable(path):
+    """Whether the file at ``path`` (relative to MEDIA_ROOT) never changes"""
+    return bool(IMMUTABLE_PATH.search(path))
+
+
+def file_etag(stat):
+    # The same validator nginx uses; the file changes name, size or mtime
+    # whenever its bytes change
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(header, size):
+    """Return (start, end) inclusive for a single-range header.
+
+    None means serve the whole file (no header, or one we do not handle such
+    as multiple ranges); ValueError means the range cannot be satisfied.
+    """
+    match = BYTE_RANGE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start > end:
+            raise ValueError(header)
+    else:
+        # A suffix range: the last N bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError(header)
+        start, end = max(size - int(last), 0), size - 1
+    return start, end
+
+
+def serve_media(request, path):
+    """Serve a file from MEDIA_ROOT with caching headers and Range support"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404('File not found')
+    if not os.path.isfile(full_path):
+        raise Http404('File not found')
+
+    etag = file_etag(stat)
+    last_modified = int(stat.st_mtime)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if is_immutable(path) else REVALIDATE_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+    }
+
+    def with_headers(response):
+        for header, value in headers.items():
+            response.headers[header] = value
+        return response
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return with_headers(not_modified)
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    sendfile_header = getattr(settings, 'MEDIA_SENDFILE_HEADER', None)
+    if sendfile_header:
+        response = HttpResponse(content_type=content_type)
+        if sendfile_header.lower() == 'x-accel-redirect':
+            prefix = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+            response.headers[sendfile_header] = quote(prefix + path)
+        else:
+            response.headers[sendfile_header] = full_path
+        return with_headers(response)
+
+    # Honour Range only while the client's copy is still current (If-Range)
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if 'Range' in request.headers and (
+        if_range is None or if_range == etag or parse_http_date_safe(if_range) == last_modified
+    ):
+        try:
+            byte_range = parse_range(request.headers['Range'], stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416, content_type=content_type)
+            response.headers['Content-Range'] = f'bytes */{stat.st_size}'
+            return with_headers(response)
+
+    if byte_range is None:
+        return with_headers(FileResponse(open(full_path, 'rb'), content_type=content_type))
+
+    start, end = byte_range
+    with open(full_path, 'rb') as f:
+        f.seek(start)
+        response = HttpResponse(f.read(end - start + 1), status=206, content_type=content_type)
+    response.headers['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    return with_headers(response)
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.6 on 2026-10-17 22:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0012_add_is_active_to_listing'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tirelisting',
+            index=models.Index(fields=['is_active', '-is_promoted', '-created_at', '-id'], name='marketplace_is_acti_571879_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.6 on 2026-10-17 22:28
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    User = apps.get_model('marketplace', 'User')
+    Review = apps.get_model('marketplace', 'Review')
+    received = Review.objects.filter(reviewed_user=OuterRef('pk')).order_by().values('reviewed_user')
+    User.objects.update(
+        rating_sum=Coalesce(Subquery(received.annotate(total=Sum('rating')).values('total')), 0),
+        rating_count=Coalesce(Subquery(received.annotate(total=Count('id')).values('total')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0013_tirelisting_feed_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.1.6 on 2026-10-17 22:30
+
+from django.db import migrations
+
+# The schema as of this migration; marketplace/search.py maintains the rows
+SEARCH_MAP_TABLE = 'marketplace_listing_search'
+SEARCH_FTS_TABLE = 'marketplace_listing_fts'
+
+
+def sqlite_statements(listing_table, user_table):
+    return [
+        f'CREATE TABLE IF NOT EXISTS {SEARCH_MAP_TABLE} '
+        f'(rowid INTEGER PRIMARY KEY, listing_id char(32) NOT NULL UNIQUE)',
+        f'CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_FTS_TABLE} USING fts5('
+        f'title, description, brand, model, tire_type, seller_username, size, '
+        f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        f'INSERT OR IGNORE INTO {SEARCH_MAP_TABLE} (listing_id) SELECT l.id FROM {listing_table} l',
+        f'INSERT INTO {SEARCH_FTS_TABLE} '
+        f'(rowid, title, description, brand, model, tire_type, seller_username, size) '
+        f"SELECT m.rowid, l.title, COALESCE(l.description, ''), l.brand, COALESCE(l.model, ''), "
+        f"l.tire_type, u.username, l.width || ' ' || l.aspect_ratio || ' ' || l.diameter "
+        f'FROM {listing_table} l '
+        f'JOIN {SEARCH_MAP_TABLE} m ON m.listing_id = l.id '
+        f'JOIN {user_table} u ON u.id = l.seller_id',
+    ]
+
+
+def postgresql_statements(listing_table, user_table):
+    return [
+        f'CREATE TABLE IF NOT EXISTS {SEARCH_MAP_TABLE} ('
+        f'listing_id uuid PRIMARY KEY REFERENCES {listing_table} (id) ON DELETE CASCADE, '
+        f'document tsvector NOT NULL)',
+        f'CREATE INDEX IF NOT EXISTS {SEARCH_MAP_TABLE}_document_idx '
+        f'ON {SEARCH_MAP_TABLE} USING GIN (document)',
+        f'INSERT INTO {SEARCH_MAP_TABLE} (listing_id, document) '
+        f"SELECT l.id, setweight(to_tsvector('simple', l.title), 'A') || "
+        f"setweight(to_tsvector('simple', l.brand || ' ' || COALESCE(l.model, '')), 'B') || "
+        f"setweight(to_tsvector('simple', l.tire_type || ' ' || u.username || ' ' || "
+        f"l.width || ' ' || l.aspect_ratio || ' ' || l.diameter), 'C') || "
+        f"setweight(to_tsvector('simple', COALESCE(l.description, '')), 'D') "
+        f'FROM {listing_table} l JOIN {user_table} u ON u.id = l.seller_id '
+        f'ON CONFLICT (listing_id) DO UPDATE SET document = EXCLUDED.document',
+    ]
+
+
+STATEMENTS = {
+    'sqlite': sqlite_statements,
+    'postgresql': postgresql_statements,
+}
+
+
+def create_search_index(apps, schema_editor):
+    statements = STATEMENTS.get(schema_editor.connection.vendor)
+    if statements is None:
+        return  # Searched with icontains, no index
+    listing_table = apps.get_model('marketplace', 'TireListing')._meta.db_table
+    user_table = apps.get_model('marketplace', 'User')._meta.db_table
+    for sql in statements(listing_table, user_table):
+        schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in STATEMENTS:
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SEARCH_FTS_TABLE}')
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SEARCH_MAP_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0014_user_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
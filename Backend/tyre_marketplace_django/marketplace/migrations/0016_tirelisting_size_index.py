@@ -0,0 +1,17 @@
+# Generated by Django 5.1.6 on 2026-10-17 22:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0015_listing_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tirelisting',
+            index=models.Index(fields=['width', 'aspect_ratio', 'diameter'], name='marketplace_width_15b39a_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.6 on 2026-10-17 22:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0016_tirelisting_size_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'sender', 'created_at'], name='marketplace_receive_2d1e41_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.6 on 2026-10-17 22:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0017_message_receiver_sender_created_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='marketplace_sender__f8f7ad_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', 'created_at'], name='marketplace_sender__077017_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.6 on 2026-10-17 22:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0018_message_sender_receiver_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listingimage',
+            name='original',
+            field=models.ImageField(blank=True, null=True, upload_to='tire_images/originals/'),
+        ),
+        migrations.AddField(
+            model_name='listingimage',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='listingimage',
+            index=models.Index(fields=['status', 'created_at'], name='marketplace_status_837e5d_idx'),
+        ),
+    ]
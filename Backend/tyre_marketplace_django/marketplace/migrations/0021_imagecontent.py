@@ -0,0 +1,33 @@
+# Generated by Django 5.1.6 on 2026-10-17 22:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0020_listingimage_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageContent',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('ext', models.CharField(max_length=10)),
+                ('size', models.PositiveIntegerField()),
+                ('original', models.ImageField(max_length=255, upload_to='')),
+                ('image', models.ImageField(blank=True, max_length=255, null=True, upload_to='')),
+                ('thumbnail', models.ImageField(blank=True, max_length=255, null=True, upload_to='')),
+                ('variants', models.JSONField(blank=True, default=list)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='listingimage',
+            name='content',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='listing_images', to='marketplace.imagecontent'),
+        ),
+    ]
@@ -1,13 +1,23 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Cast, Coalesce, NullIf
 from django.contrib.auth.models import AbstractUser
 import uuid
-from PIL import Image
 from django.core.validators import FileExtensionValidator
 from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.utils.translation import gettext_lazy as _
-from django.conf import settings
+from django.utils import timezone
 import os
 from django.core.exceptions import ValidationError
+import logging
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from .imaging import encode, open_scaled
+
+logger = logging.getLogger(__name__)
 
 
 class CaseSensitiveUsernameValidator(UnicodeUsernameValidator):
@@ -22,6 +32,12 @@ class CaseSensitiveUsernameValidator(UnicodeUsernameValidator):
                 code='invalid',
             )
 
+def avatar_url(profile_image_url, variants, size):
+    """The smallest avatar of at least ``size`` pixels, or the full profile image"""
+    fitting = [(int(width), url) for width, url in (variants or {}).items() if int(width) >= size]
+    return min(fitting)[1] if fitting else profile_image_url
+
+
 class User(AbstractUser):
     # Override the username field to use case-sensitive validation
     username = models.CharField(
@@ -39,16 +55,64 @@ class User(AbstractUser):
     is_business = models.BooleanField(default=False)
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.0)
     profile_image_url = models.CharField(max_length=255, null=True, blank=True)
+    # Square avatar crops of the profile image: {"64": url, "128": url}
+    profile_image_variants = models.JSONField(default=dict, blank=True)
     is_suspended = models.BooleanField(default=False)
     suspended_at = models.DateTimeField(null=True, blank=True)
     is_banned = models.BooleanField(default=False)
     banned_at = models.DateTimeField(null=True, blank=True)
 
+    # Running totals of received review ratings, kept in step with Review
+    # writes so the average and count can be read without touching reviews
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    # Only ever written by UPDATEs (adjust_rating_aggregates and the
+    # rebuild_rating_aggregates command), never by saving a User
+    RATING_FIELDS = ('rating', 'rating_sum', 'rating_count')
+
+    def save(self, *args, **kwargs):
+        # A full save would write back the totals as they were when this user
+        # was loaded, undoing reviews added since
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.RATING_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        # The username is part of the seller's listings' search documents;
+        # remembering it lets saves that leave it alone skip reindexing
+        user._loaded_username = user.__dict__.get('username')
+        return user
+
+    def avatar_url(self, size):
+        return avatar_url(self.profile_image_url, self.profile_image_variants, size)
+
     def get_average_rating(self):
-        reviews = self.reviews_received.all()
-        if not reviews:
+        if not self.rating_count:
             return 0
-        return sum(review.rating for review in reviews) / len(reviews)
+        return self.rating_sum / self.rating_count
+
+    @classmethod
+    def adjust_rating_aggregates(cls, user_id, rating_delta, count_delta):
+        """Apply a review change to a user's rating totals in a single UPDATE.
+
+        ``rating`` is recomputed from the new totals in the same statement so
+        concurrent review writes can never leave it out of step.
+        """
+        new_sum = F('rating_sum') + rating_delta
+        new_count = F('rating_count') + count_delta
+        cls.objects.filter(pk=user_id).update(
+            rating_sum=new_sum,
+            rating_count=new_count,
+            rating=Cast(
+                Coalesce(Cast(new_sum, models.FloatField()) / NullIf(new_count, 0), 0.0),
+                models.DecimalField(max_digits=3, decimal_places=2),
+            ),
+        )
 
     class Meta:
         indexes = [
@@ -120,43 +184,87 @@ class TireListing(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Serves the promoted-first listings feed and its keyset cursors
+            models.Index(fields=['is_active', '-is_promoted', '-created_at', '-id']),
+            # Exact tire size lookups from size searches and the size dropdowns
+            models.Index(fields=['width', 'aspect_ratio', 'diameter']),
+        ]
+
+class ImageContent(models.Model):
+    """An uploaded image file, stored once under the SHA-256 of its bytes.
+
+    Listing images uploaded with identical bytes share the original and its
+    resized copies (see images.py). ``ref_count`` is the number of
+    ListingImage rows using them; the files go when it drops to zero.
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    ext = models.CharField(max_length=10)
+    size = models.PositiveIntegerField()
+    original = models.ImageField(max_length=255)
+    # Empty until the first upload of these bytes has been processed
+    image = models.ImageField(max_length=255, null=True, blank=True)
+    thumbnail = models.ImageField(max_length=255, null=True, blank=True)
+    variants = models.JSONField(default=list, blank=True)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256
+
 
 class ListingImage(models.Model):
+    # Uploads are stored as-is and resized by a background worker
+    # (see images.py); until then ``image`` points at the original.
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     listing = models.ForeignKey(TireListing, related_name='images', on_delete=models.CASCADE)
     image = models.ImageField(upload_to='tire_images/', null=True, blank=True)
     thumbnail = models.ImageField(upload_to='tire_images/thumbnails/', null=True, blank=True)
+    original = models.ImageField(upload_to='tire_images/originals/', null=True, blank=True)
+    # Set for uploads stored content-addressed; older rows have their own files
+    content = models.ForeignKey(
+        ImageContent, related_name='listing_images', on_delete=models.PROTECT, null=True, blank=True
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_READY)
+    # Responsive copies: [{"width", "height", "format", "size", "path"}, ...]
+    variants = models.JSONField(default=list, blank=True)
     position = models.PositiveIntegerField(default=0)
     is_primary = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def save(self, *args, **kwargs):
-        if not self.thumbnail and self.image:
+        if not self.thumbnail and self.image and self.status == self.STATUS_READY:
             try:
-                # Create necessary directories
-                thumbnail_dir = os.path.join(settings.MEDIA_ROOT, 'tire_images/thumbnails')
-                os.makedirs(thumbnail_dir, exist_ok=True)
-                
-                # Create thumbnail
-                img = Image.open(self.image)
-                img.thumbnail((300, 300))  # Adjust size as needed
-                thumb_name = f'thumb_{os.path.basename(self.image.name)}'
-                thumb_path = os.path.join(thumbnail_dir, thumb_name)
+                # Create thumbnail, decoding the image at reduced scale
+                img = open_scaled(self.image, (300, 300))  # Adjust size as needed
+                thumb_name = f'tire_images/thumbnails/thumb_{os.path.basename(self.image.name)}'
+                save_format = Image.registered_extensions().get(os.path.splitext(thumb_name)[1].lower(), 'JPEG')
                 
-                # Save thumbnail
-                img.save(thumb_path)
-                
-                # Update thumbnail field relative to MEDIA_ROOT
-                rel_path = os.path.join('tire_images/thumbnails', thumb_name)
-                self.thumbnail = rel_path
-            except Exception as e:
-                print(f"Error creating thumbnail: {e}")
+                # Save thumbnail through the storage, which picks its directory
+                self.thumbnail.name = default_storage.save(thumb_name, ContentFile(encode(img, save_format)))
+            except Exception:
+                logger.warning("Error creating thumbnail for %s", self.image.name, exc_info=True)
                 # Continue saving even if thumbnail creation fails
                 
         super().save(*args, **kwargs)
 
     class Meta:
-        indexes = [models.Index(fields=['listing'])]
+        indexes = [
+            models.Index(fields=['listing']),
+            # The image processing queue
+            models.Index(fields=['status', 'created_at']),
+        ]
         ordering = ['position']
 
 class Review(models.Model):
@@ -167,6 +275,21 @@ class Review(models.Model):
     comment = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    def save(self, *args, **kwargs):
+        # Keep the reviewed user's rating totals in the same transaction as
+        # the review itself. Deletes are handled by a post_delete signal so
+        # that cascades are covered too.
+        with transaction.atomic():
+            previous = None
+            if not self._state.adding:
+                previous = Review.objects.select_for_update().filter(pk=self.pk).values_list(
+                    'reviewed_user_id', 'rating'
+                ).first()
+            super().save(*args, **kwargs)
+            if previous:
+                User.adjust_rating_aggregates(previous[0], -previous[1], -1)
+            User.adjust_rating_aggregates(self.reviewed_user_id, self.rating, 1)
+
     class Meta:
         indexes = [
             models.Index(fields=['reviewed_user']),
@@ -182,7 +305,10 @@ class Message(models.Model):
 
     class Meta:
         indexes = [
-            models.Index(fields=['sender', 'receiver']),
+            # Chat history between two users, newest first
+            models.Index(fields=['sender', 'receiver', 'created_at']),
+            # Conversation list: unread counts and latest message per partner
+            models.Index(fields=['receiver', 'sender', 'created_at']),
         ]
 
 class OTPVerification(models.Model):
@@ -205,4 +331,37 @@ class PasswordReset(models.Model):
     class Meta:
         indexes = [
             models.Index(fields=['user', 'token']),
-        ]
\ No newline at end of file
+        ]
+
+
+class OutboundEmail(models.Model):
+    # Emails are queued here inside the request's transaction and sent by a
+    # background worker (see outbox.py). Pending rows are the job queue.
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # When the email is next due: its retry time while pending, and when the
+    # claim of a worker that may have died runs out while sending
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
@@ -0,0 +1,178 @@
+"""
+Outgoing email, sent off the request path.
+
+queue_email() only inserts an OutboundEmail row. The email commits or rolls
+back with the rest of the request, and the response never waits on the
+mail server. Pending rows are the job queue. Once the transaction commits
+they are sent by a background thread in the same process
+(EMAIL_OUTBOX_THREADS, 0 to disable), and by the ``send_emails``
+management command, which can run as a dedicated worker and also retries
+failures.
+
+A worker claims a batch with conditional UPDATEs, so no email goes to two
+workers, and sends the batch over one connection to the mail server. The
+connection is kept open for as long as there are batches to send. Each
+claim counts as an attempt. A failed email is retried after RETRY_DELAY,
+doubled after every attempt, and marked failed after MAX_ATTEMPTS. A claim
+runs out after CLAIM_TIMEOUT, so emails held by a worker that died are sent
+again. That worker may have sent them already, so an email can arrive
+twice but is never lost.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 6
+RETRY_DELAY = timedelta(seconds=30)
+MAX_RETRY_DELAY = timedelta(hours=1)
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def queue_email(recipient, subject, body, from_email=None):
+    """Queue an email to be sent once the current transaction commits"""
+    email = OutboundEmail.objects.create(recipient=recipient, subject=subject, body=body, from_email=from_email)
+    enqueue()
+    return email
+
+
+def retry_delay(attempts):
+    """How long to wait before retrying an email that has failed ``attempts`` times"""
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def due(now):
+    """Pending emails whose time has come, and emails whose claim ran out"""
+    return OutboundEmail.objects.filter(
+        status__in=[OutboundEmail.STATUS_PENDING, OutboundEmail.STATUS_SENDING],
+        next_attempt_at__lte=now,
+    )
+
+
+def claim(limit):
+    """Claim up to ``limit`` due emails, oldest first, and return the ones this worker got"""
+    now = timezone.now()
+    # Emails whose last attempt was cut short by a dying worker
+    due(now).filter(attempts__gte=MAX_ATTEMPTS).update(
+        status=OutboundEmail.STATUS_FAILED, last_error='The worker sending it stopped'
+    )
+    candidates = due(now).order_by('next_attempt_at', 'id').values_list('id', 'next_attempt_at')[:limit]
+    claimed = [
+        email_id for email_id, next_attempt_at in candidates
+        # Matching the old time too means no other worker claimed it since
+        if due(now).filter(id=email_id, next_attempt_at=next_attempt_at).update(
+            status=OutboundEmail.STATUS_SENDING,
+            next_attempt_at=now + CLAIM_TIMEOUT,
+            attempts=F('attempts') + 1,
+        )
+    ]
+    return list(OutboundEmail.objects.filter(id__in=claimed).order_by('id'))
+
+
+def deliver(emails, connection):
+    """Send emails over one connection. Returns {email id: exception or None}.
+
+    Touches only the mail server, never the database. The connection is
+    opened if needed and left open for the next batch. It is reopened after
+    a failure, which may have broken it.
+    """
+    results = {}
+    try:
+        connection.open()
+        for email in emails:
+            message = EmailMessage(
+                email.subject, email.body, email.from_email, [email.recipient], connection=connection
+            )
+            try:
+                message.send()
+            except Exception as e:
+                results[email.id] = e
+                connection.close()
+                connection.open()
+            else:
+                results[email.id] = None
+    except Exception as e:
+        # No connection to the server: the rest of the batch waits for a retry
+        connection.close()
+        for email in emails:
+            results.setdefault(email.id, e)
+    return results
+
+
+def send_pending(limit=BATCH_SIZE, connection=None):
+    """Send a batch of due emails. Returns {email id: error message or None}.
+
+    Pass a ``connection`` to reuse it across batches; closing it is then up
+    to the caller.
+    """
+    emails = claim(limit)
+    if not emails:
+        return {}
+    if connection is None:
+        connection = get_connection()
+        try:
+            results = deliver(emails, connection)
+        finally:
+            connection.close()
+    else:
+        results = deliver(emails, connection)
+
+    now = timezone.now()
+    sent = [email_id for email_id, error in results.items() if error is None]
+    OutboundEmail.objects.filter(id__in=sent).update(status=OutboundEmail.STATUS_SENT, sent_at=now, last_error='')
+    for email in emails:
+        error = results[email.id]
+        if error is None:
+            continue
+        logger.warning("Error sending email %s (attempt %s): %s", email.id, email.attempts, error)
+        if email.attempts >= MAX_ATTEMPTS:
+            fields = {'status': OutboundEmail.STATUS_FAILED}
+        else:
+            fields = {'status': OutboundEmail.STATUS_PENDING, 'next_attempt_at': now + retry_delay(email.attempts)}
+        OutboundEmail.objects.filter(id=email.id).update(last_error=str(error), **fields)
+    return {email_id: None if error is None else str(error) for email_id, error in results.items()}
+
+
+def purge_sent(older_than):
+    """Delete emails sent more than ``older_than`` ago; they hold one-time codes"""
+    deleted, _ = OutboundEmail.objects.filter(
+        status=OutboundEmail.STATUS_SENT, sent_at__lt=timezone.now() - older_than
+    ).delete()
+    return deleted
+
+
+_executor = None
+
+
+def _drain():
+    connection = get_connection()
+    try:
+        while send_pending(connection=connection):
+            pass
+    except Exception:
+        logger.exception("Error sending queued emails")
+    finally:
+        connection.close()
+        # Worker threads outlive requests, so do not hold connections open
+        connections.close_all()
+
+
+def enqueue():
+    """Start sending queued emails in this process once the transaction commits"""
+    global _executor
+    threads = getattr(settings, 'EMAIL_OUTBOX_THREADS', 1)
+    if not threads:
+        return
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='email-outbox')
+    transaction.on_commit(lambda: _executor.submit(_drain))
@@ -0,0 +1,161 @@
+import base64
+import json
+from datetime import datetime
+from decimal import Decimal
+from uuid import UUID
+
+from django.db.models import F, Q
+
+
+# Largest page any endpoint returns, however large a page_size is asked for
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class InvalidPage(ValueError):
+    pass
+
+
+def page_params(params, default_page_size):
+    """Read ``page`` and ``page_size`` from query parameters.
+
+    Values below 1 are raised to 1 and page_size is capped at MAX_PAGE_SIZE.
+    Raises InvalidPage if either is not an integer.
+    """
+    try:
+        page = int(params.get('page', 1))
+        page_size = int(params.get('page_size', default_page_size))
+    except (TypeError, ValueError):
+        raise InvalidPage('page and page_size must be integers')
+    return max(page, 1), min(max(page_size, 1), MAX_PAGE_SIZE)
+
+
+def page_size_param(params, default_page_size):
+    """Read ``page_size`` alone, for cursor pagination. Kept within 1..MAX_PAGE_SIZE."""
+    try:
+        page_size = int(params.get('page_size', default_page_size))
+    except (TypeError, ValueError):
+        raise InvalidPage('page_size must be an integer')
+    return min(max(page_size, 1), MAX_PAGE_SIZE)
+
+
+def _to_json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (Decimal, UUID)):
+        return str(value)
+    return value
+
+
+def _get_value(obj, field_path):
+    # Follow "seller__rating" style paths through select_related objects
+    for attr in field_path.split('__'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def encode_cursor(obj, ordering):
+    """Build an opaque cursor pointing just after ``obj`` for the given ordering"""
+    payload = {
+        'o': list(ordering),
+        'v': [_to_json_value(_get_value(obj, field.lstrip('-'))) for field in ordering],
+    }
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, ordering):
+    """Return the sort key values stored in ``cursor``.
+
+    Raises InvalidCursor if the token is malformed or was issued for a
+    different ordering.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        values = payload['v']
+        cursor_ordering = payload['o']
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor('Invalid cursor')
+
+    if cursor_ordering != list(ordering) or len(values) != len(ordering):
+        raise InvalidCursor('Cursor does not match the requested sort order')
+    return values
+
+
+def is_nullable(model, field_path):
+    """Whether a "seller__rating" style path can be NULL"""
+    for name in field_path.split('__'):
+        field = model._meta.get_field(name)
+        if field.null:
+            return True
+        model = field.related_model
+    return False
+
+
+def ordering_expressions(model, ordering):
+    """``ordering`` for order_by(), with NULLs of nullable columns sorted last.
+
+    Databases disagree on where NULLs go by default; pinning them down is
+    what lets keyset_filter() step over them.
+    """
+    expressions = []
+    for field in ordering:
+        name = field.lstrip('-')
+        if not is_nullable(model, name):
+            expressions.append(field)
+        elif field.startswith('-'):
+            expressions.append(F(name).desc(nulls_last=True))
+        else:
+            expressions.append(F(name).asc(nulls_last=True))
+    return expressions
+
+
+def keyset_filter(model, ordering, values):
+    """Build the Q object selecting rows that sort strictly after ``values``.
+
+    For an ordering (a, -b, c) this is:
+        a > va OR (a = va AND b < vb) OR (a = va AND b = vb AND c > vc)
+
+    NULLs sort last (see ordering_expressions), so after a non-NULL value
+    of a nullable column come the greater values and then the NULLs, and
+    nothing comes after a NULL except through the columns that follow it.
+    """
+    query = Q()
+    equal_so_far = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        if value is None:
+            equal_so_far &= Q(**{f'{name}__isnull': True})
+            continue
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        after = Q(**{f'{name}__{lookup}': value})
+        if is_nullable(model, name):
+            after |= Q(**{f'{name}__isnull': True})
+        query |= equal_so_far & after
+        equal_so_far &= Q(**{name: value})
+    return query
+
+
+def paginate_by_cursor(queryset, ordering, cursor, page_size):
+    """Return one keyset page of ``queryset`` and the cursor for the next page.
+
+    ``ordering`` must be total (end with a unique column) so that no row is
+    skipped or repeated between pages. An empty ``cursor`` starts from the
+    first row. The next cursor is None on the last page.
+    """
+    model = queryset.model
+    queryset = queryset.order_by(*ordering_expressions(model, ordering))
+    if cursor:
+        queryset = queryset.filter(keyset_filter(model, ordering, decode_cursor(cursor, ordering)))
+
+    # Fetch one extra row to find out whether there is a next page
+    rows = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1], ordering)
+    return rows, next_cursor
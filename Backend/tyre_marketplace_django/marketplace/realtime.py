@@ -0,0 +1,271 @@
+"""
+Real-time message delivery over WebSockets.
+
+Clients connect to ``/ws/messages/?token=<access token>`` on the ASGI
+application and receive JSON events as they happen instead of polling:
+
+- ``{"type": "message.new", "message": {...}}`` when a message is sent to or
+  by the user (the payload matches MessageSerializer)
+- ``{"type": "message.read", "reader": "<user id>", "message_ids": [...]}``
+  when messages the user sent or received are marked read
+
+Sending ``ping`` gets ``{"type": "pong"}`` back, for keep-alives. The socket
+is closed with code 4401 when the access token expires; the client should
+reconnect with a fresh one.
+
+Events are fanned out by the broker named in the MESSAGE_BROKER setting. The
+default InProcessBroker only reaches connections held by the same process,
+so run a single ASGI worker or plug in a broker backed by a shared pub/sub
+service. Anything with the same subscribe/unsubscribe/publish methods works,
+which is also how tests swap in a local stand-in.
+
+The same events bump the per-user counters of ``unread_notifier``, which
+long-polling requests for the unread badge wait on.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_WEBSOCKET_PATH = '/ws/messages/'
+
+# Close codes in the 4000-4999 range reserved for applications
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_NOT_FOUND = 4404
+
+
+class Subscription:
+    """Events published to one user, delivered on the subscriber's event loop"""
+
+    def __init__(self, user_id, maxsize):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.warning("Dropping realtime event for slow subscriber %s", self.user_id)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class InProcessBroker:
+    """Fan events out to the subscriptions held by this process.
+
+    ``publish`` may be called from any thread (sync views run in a thread
+    pool under ASGI); events are handed to each subscriber's event loop.
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, user_id):
+        subscription = Subscription(str(user_id), self.queue_size)
+        with self._lock:
+            self._subscriptions[subscription.user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, user_id, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(str(user_id), ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # The subscriber's loop has shut down
+                self.unsubscribe(subscription)
+
+
+class UnreadNotifier:
+    """Per-user change counters that long-polling requests can wait on.
+
+    A version is only meaningful to the process that issued it: the epoch
+    prefix changes on restart, so a stale version never matches.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._versions = defaultdict(int)
+        self._waiters = defaultdict(set)
+
+    def version(self, user_id):
+        with self._lock:
+            return f'{self.epoch}.{self._versions.get(str(user_id), 0)}'
+
+    def changed(self, user_id):
+        """Wake everyone waiting on ``user_id``. Safe to call from any thread."""
+        user_id = str(user_id)
+        with self._lock:
+            self._versions[user_id] += 1
+            waiters = list(self._waiters.get(user_id, ()))
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass
+
+    async def wait(self, user_id, version, timeout):
+        """Wait until the version of ``user_id`` differs from ``version`` or ``timeout`` expires.
+
+        Returns the current version.
+        """
+        user_id = str(user_id)
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._waiters[user_id].add(waiter)
+        try:
+            if self.version(user_id) == version:
+                await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                self._waiters[user_id].discard(waiter)
+                if not self._waiters[user_id]:
+                    del self._waiters[user_id]
+        return self.version(user_id)
+
+
+unread_notifier = UnreadNotifier()
+
+_broker = None
+
+
+def get_broker():
+    """Return the process-wide broker named by MESSAGE_BROKER"""
+    global _broker
+    if _broker is None:
+        _broker = import_string(getattr(settings, 'MESSAGE_BROKER', 'marketplace.realtime.InProcessBroker'))()
+    return _broker
+
+
+@receiver(setting_changed)
+def reset_broker(setting, **kwargs):
+    global _broker
+    if setting == 'MESSAGE_BROKER':
+        _broker = None
+
+
+def _publish_on_commit(user_ids, event):
+    def publish():
+        broker = get_broker()
+        for user_id in user_ids:
+            broker.publish(user_id, event)
+    transaction.on_commit(publish)
+
+
+def message_created(message, data):
+    """Push a new message to both participants. ``data`` is its serialized form."""
+    _publish_on_commit(
+        {message.sender_id, message.receiver_id},
+        {'type': 'message.new', 'message': data},
+    )
+    transaction.on_commit(lambda: unread_notifier.changed(message.receiver_id))
+
+
+def messages_read(reader_id, sender_id, message_ids):
+    """Push a read receipt to the sender and to the reader's other sessions"""
+    if not message_ids:
+        return
+    _publish_on_commit(
+        {reader_id, sender_id},
+        {
+            'type': 'message.read',
+            'reader': str(reader_id),
+            'message_ids': [str(message_id) for message_id in message_ids],
+        },
+    )
+    transaction.on_commit(lambda: unread_notifier.changed(reader_id))
+
+
+def access_token(raw_token=None, authorization=None):
+    """Validate a JWT given directly or as an Authorization header value.
+
+    Only the signature and expiry are checked, without loading the user, so
+    long-lived connections cost no database queries. Returns None if invalid.
+    """
+    if raw_token is None and authorization:
+        parts = authorization.split()
+        if len(parts) == 2 and parts[0] in jwt_settings.AUTH_HEADER_TYPES:
+            raw_token = parts[1]
+    if not raw_token:
+        return None
+    try:
+        return AccessToken(raw_token)
+    except TokenError:
+        return None
+
+
+def _access_token(scope):
+    """Read the JWT from ?token= (browsers cannot set headers) or the Authorization header"""
+    raw_token = parse_qs(scope.get('query_string', b'').decode()).get('token', [None])[0]
+    authorization = dict(scope.get('headers', [])).get(b'authorization', b'').decode()
+    return access_token(raw_token, authorization)
+
+
+async def _push_events(subscription, send, expires_at):
+    while True:
+        try:
+            event = await asyncio.wait_for(subscription.get(), timeout=max(expires_at - time.time(), 0))
+        except asyncio.TimeoutError:
+            await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+            return
+        await send({'type': 'websocket.send', 'text': json.dumps(event, cls=DjangoJSONEncoder)})
+
+
+async def websocket_application(scope, receive, send):
+    """ASGI application for WebSocket connections"""
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    if scope['path'] != MESSAGES_WEBSOCKET_PATH:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+    token = _access_token(scope)
+    if token is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+
+    await send({'type': 'websocket.accept'})
+    broker = get_broker()
+    subscription = broker.subscribe(token[jwt_settings.USER_ID_CLAIM])
+    pusher = asyncio.ensure_future(_push_events(subscription, send, token['exp']))
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            if message.get('text') == 'ping':
+                await send({'type': 'websocket.send', 'text': json.dumps({'type': 'pong'})})
+    finally:
+        pusher.cancel()
+        broker.unsubscribe(subscription)
@@ -0,0 +1,240 @@
+"""
+Full-text search over tire listings.
+
+Every backend exposes the same small interface: ``search()`` filters a
+TireListing queryset and annotates it with ``search_rank`` (lower is more
+relevant; a query without any words leaves the queryset unfiltered, with
+every rank 0), and the ``index_*``/``remove_*``/``rebuild`` methods keep the
+index in step with the listings (see signals.py). The index tables are
+created by migration 0015_listing_search_index.
+
+- SQLite uses an FTS5 virtual table. FTS5 rows are keyed by an integer rowid,
+  so a small map table ties each rowid to a listing UUID.
+- PostgreSQL stores a weighted ``tsvector`` per listing with a GIN index.
+- Any other database falls back to the original ``icontains`` OR-chains.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q, Value
+
+from .models import TireListing, User
+
+SEARCH_MAP_TABLE = 'marketplace_listing_search'
+SEARCH_FTS_TABLE = 'marketplace_listing_fts'
+
+LISTING_TABLE = TireListing._meta.db_table
+USER_TABLE = User._meta.db_table
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def search_terms(query):
+    return TERM_RE.findall(query or '')
+
+
+def _listing_pks(listing_ids):
+    pk_field = TireListing._meta.pk
+    return [pk_field.get_db_prep_value(listing_id, connection) for listing_id in listing_ids]
+
+
+def _placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+
+def _unranked(queryset):
+    return queryset.annotate(search_rank=Value(0))
+
+
+class IContainsSearchBackend:
+    """The original LIKE-based search, kept for databases without a full-text index"""
+
+    def search(self, queryset, query):
+        search_query = Q()
+        for term in search_terms(query):
+            search_query |= (
+                Q(title__icontains=term) |
+                Q(description__icontains=term) |
+                Q(brand__icontains=term) |
+                Q(model__icontains=term) |
+                Q(tire_type__icontains=term) |
+                Q(seller__username__icontains=term)
+            )
+        if not search_query:
+            return _unranked(queryset)
+        return queryset.filter(search_query).extra(select={'search_rank': '0'})
+
+    def index_listings(self, listing_ids):
+        pass
+
+    def index_seller(self, seller_id):
+        pass
+
+    def remove_listings(self, listing_ids):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class SQLiteSearchBackend:
+    # bm25() weights, in column order: title, description, brand, model,
+    # tire_type, seller_username, size
+    WEIGHTS = '10.0, 1.0, 5.0, 5.0, 2.0, 2.0, 3.0'
+
+    def search(self, queryset, query):
+        terms = search_terms(query)
+        if not terms:
+            return _unranked(queryset)
+        # Prefix match every term and OR them together, like the icontains search
+        match = ' OR '.join(f'"{term}"*' for term in terms)
+        return queryset.extra(
+            select={'search_rank': f'bm25({SEARCH_FTS_TABLE}, {self.WEIGHTS})'},
+            tables=[SEARCH_MAP_TABLE, SEARCH_FTS_TABLE],
+            where=[
+                f'{SEARCH_MAP_TABLE}.listing_id = {LISTING_TABLE}.id',
+                f'{SEARCH_FTS_TABLE}.rowid = {SEARCH_MAP_TABLE}.rowid',
+                f'{SEARCH_FTS_TABLE} MATCH %s',
+            ],
+            params=[match],
+        )
+
+    def _insert_documents(self, cursor, where='', params=()):
+        cursor.execute(
+            f'INSERT OR IGNORE INTO {SEARCH_MAP_TABLE} (listing_id) '
+            f'SELECT l.id FROM {LISTING_TABLE} l {where}',
+            params,
+        )
+        cursor.execute(
+            f'INSERT INTO {SEARCH_FTS_TABLE} '
+            f'(rowid, title, description, brand, model, tire_type, seller_username, size) '
+            f"SELECT m.rowid, l.title, COALESCE(l.description, ''), l.brand, COALESCE(l.model, ''), "
+            f"l.tire_type, u.username, l.width || ' ' || l.aspect_ratio || ' ' || l.diameter "
+            f'FROM {LISTING_TABLE} l '
+            f'JOIN {SEARCH_MAP_TABLE} m ON m.listing_id = l.id '
+            f'JOIN {USER_TABLE} u ON u.id = l.seller_id {where}',
+            params,
+        )
+
+    def _delete_documents(self, cursor, where, params):
+        cursor.execute(
+            f'DELETE FROM {SEARCH_FTS_TABLE} WHERE rowid IN '
+            f'(SELECT m.rowid FROM {SEARCH_MAP_TABLE} m WHERE m.listing_id IN '
+            f'(SELECT l.id FROM {LISTING_TABLE} l {where}))',
+            params,
+        )
+
+    def index_listings(self, listing_ids):
+        pks = _listing_pks(listing_ids)
+        if not pks:
+            return
+        where = f'WHERE l.id IN ({_placeholders(pks)})'
+        with connection.cursor() as cursor:
+            self._delete_documents(cursor, where, pks)
+            self._insert_documents(cursor, where, pks)
+
+    def index_seller(self, seller_id):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {SEARCH_FTS_TABLE} SET seller_username = '
+                f'(SELECT username FROM {USER_TABLE} WHERE id = %s) '
+                f'WHERE rowid IN (SELECT m.rowid FROM {SEARCH_MAP_TABLE} m '
+                f'JOIN {LISTING_TABLE} l ON l.id = m.listing_id WHERE l.seller_id = %s)',
+                [User._meta.pk.get_db_prep_value(seller_id, connection)] * 2,
+            )
+
+    def remove_listings(self, listing_ids):
+        pks = _listing_pks(listing_ids)
+        if not pks:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {SEARCH_FTS_TABLE} WHERE rowid IN '
+                f'(SELECT rowid FROM {SEARCH_MAP_TABLE} WHERE listing_id IN ({_placeholders(pks)}))',
+                pks,
+            )
+            cursor.execute(
+                f'DELETE FROM {SEARCH_MAP_TABLE} WHERE listing_id IN ({_placeholders(pks)})',
+                pks,
+            )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_FTS_TABLE}')
+            cursor.execute(f'DELETE FROM {SEARCH_MAP_TABLE}')
+            self._insert_documents(cursor)
+
+
+class PostgresSearchBackend:
+    CONFIG = 'simple'
+
+    DOCUMENT_SQL = (
+        "setweight(to_tsvector('simple', l.title), 'A') || "
+        "setweight(to_tsvector('simple', l.brand || ' ' || COALESCE(l.model, '')), 'B') || "
+        "setweight(to_tsvector('simple', l.tire_type || ' ' || u.username || ' ' || "
+        "l.width || ' ' || l.aspect_ratio || ' ' || l.diameter), 'C') || "
+        "setweight(to_tsvector('simple', COALESCE(l.description, '')), 'D')"
+    )
+
+    def search(self, queryset, query):
+        terms = search_terms(query)
+        if not terms:
+            return _unranked(queryset)
+        # Prefix match every term and OR them together, like the icontains search
+        tsquery = ' | '.join(f'{term}:*' for term in terms)
+        return queryset.extra(
+            select={'search_rank': f"-ts_rank({SEARCH_MAP_TABLE}.document, to_tsquery('{self.CONFIG}', %s))"},
+            select_params=[tsquery],
+            tables=[SEARCH_MAP_TABLE],
+            where=[
+                f'{SEARCH_MAP_TABLE}.listing_id = {LISTING_TABLE}.id',
+                f"{SEARCH_MAP_TABLE}.document @@ to_tsquery('{self.CONFIG}', %s)",
+            ],
+            params=[tsquery],
+        )
+
+    def _upsert_documents(self, cursor, where='', params=()):
+        cursor.execute(
+            f'INSERT INTO {SEARCH_MAP_TABLE} (listing_id, document) '
+            f'SELECT l.id, {self.DOCUMENT_SQL} FROM {LISTING_TABLE} l '
+            f'JOIN {USER_TABLE} u ON u.id = l.seller_id {where} '
+            f'ON CONFLICT (listing_id) DO UPDATE SET document = EXCLUDED.document',
+            params,
+        )
+
+    def index_listings(self, listing_ids):
+        pks = _listing_pks(listing_ids)
+        if not pks:
+            return
+        with connection.cursor() as cursor:
+            self._upsert_documents(cursor, f'WHERE l.id IN ({_placeholders(pks)})', pks)
+
+    def index_seller(self, seller_id):
+        with connection.cursor() as cursor:
+            self._upsert_documents(cursor, 'WHERE l.seller_id = %s', [seller_id])
+
+    def remove_listings(self, listing_ids):
+        pks = _listing_pks(listing_ids)
+        if not pks:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {SEARCH_MAP_TABLE} WHERE listing_id IN ({_placeholders(pks)})',
+                pks,
+            )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {SEARCH_MAP_TABLE}')
+            self._upsert_documents(cursor)
+
+
+SEARCH_BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend():
+    """Return the search backend matching the default database"""
+    return SEARCH_BACKENDS.get(connection.vendor, IContainsSearchBackend)()
@@ -1,14 +1,8 @@
 from rest_framework import serializers
 from .models import User, BusinessProfile, TireListing, ListingImage, Review, Message
-import uuid
+from .images import store_upload
 from django.core.files.storage import default_storage
-from PIL import Image
-import io
-from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.validators import FileExtensionValidator
-import os
-from django.core.files.base import ContentFile
-from django.conf import settings
 
 class UserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
@@ -19,12 +13,13 @@ class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'username', 'email', 'password', 'confirm_password', 
-                 'phone', 'is_business', 'is_superuser', 'rating', 'profile_image_url', 'is_verified',
-                 'last_login')
+                 'phone', 'is_business', 'is_superuser', 'rating', 'profile_image_url', 'profile_image_variants',
+                 'is_verified', 'last_login')
         extra_kwargs = {
             'password': {'write_only': True},
             'email': {'required': True},
             'last_login': {'read_only': True},
+            'profile_image_variants': {'read_only': True},
             'is_superuser': {'read_only': True},
             'is_business': {'required': False, 'default': False}
         }
@@ -67,11 +62,12 @@ class ListingImageSerializer(serializers.ModelSerializer):
     )
     image_url = serializers.SerializerMethodField()
     thumbnail_url = serializers.SerializerMethodField()
+    variants = serializers.SerializerMethodField()
     
     class Meta:
         model = ListingImage
-        fields = ['id', 'image', 'image_url', 'thumbnail', 'thumbnail_url', 'position', 'is_primary', 'listing']
-        read_only_fields = ['thumbnail', 'image_url', 'thumbnail_url']
+        fields = ['id', 'image', 'image_url', 'thumbnail', 'thumbnail_url', 'variants', 'status', 'position', 'is_primary', 'listing']
+        read_only_fields = ['thumbnail', 'image_url', 'thumbnail_url', 'variants', 'status']
 
     def get_image_url(self, obj):
         if obj.image:
@@ -89,6 +85,23 @@ class ListingImageSerializer(serializers.ModelSerializer):
             return obj.thumbnail.url
         return None
 
+    def get_variants(self, obj):
+        return self.variants_for(obj, self.context.get('request'))
+
+    @staticmethod
+    def variants_for(obj, request=None):
+        """Responsive copies grouped by format, widest first: {"webp": [{"width", "height", "size", "url"}]}"""
+        variants = {}
+        for variant in sorted(obj.variants, key=lambda variant: -variant['width']):
+            url = default_storage.url(variant['path'])
+            variants.setdefault(variant['format'], []).append({
+                'width': variant['width'],
+                'height': variant['height'],
+                'size': variant['size'],
+                'url': request.build_absolute_uri(url) if request else url,
+            })
+        return variants
+
     def validate_image(self, image):
         if image.size > 5 * 1024 * 1024:  # 5MB limit
             raise serializers.ValidationError("Image size cannot exceed 5MB")
@@ -96,109 +109,18 @@ class ListingImageSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         image = validated_data.pop('image')
-        ext = image.name.split('.')[-1].lower()
-        
-        # Generate unique filenames with subdirectory based on listing ID
-        listing_id = str(validated_data['listing'].id)
-        upload_dir = f'listings/{listing_id}'
-        
-        # Create directories if they don't exist
-        os.makedirs(os.path.join(settings.MEDIA_ROOT, upload_dir), exist_ok=True)
-        os.makedirs(os.path.join(settings.MEDIA_ROOT, f'{upload_dir}/thumbnails'), exist_ok=True)
-        
-        filename = f"{uuid.uuid4()}.{ext}"
-        thumb_filename = f"thumb_{filename}"
-        
-        try:
-            # Create thumbnail
-            img = Image.open(image)
-            
-            # Preserve EXIF orientation data for JPEGs
-            if hasattr(img, '_getexif') and img._getexif():
-                from PIL import ExifTags
-                for orientation in ExifTags.TAGS.keys():
-                    if ExifTags.TAGS[orientation] == 'Orientation':
-                        exif = dict(img._getexif().items())
-                        if orientation in exif:
-                            if exif[orientation] == 3:
-                                img = img.rotate(180, expand=True)
-                            elif exif[orientation] == 6:
-                                img = img.rotate(270, expand=True)
-                            elif exif[orientation] == 8:
-                                img = img.rotate(90, expand=True)
-                        break
-            
-            # Resize large images to max dimensions while maintaining aspect ratio
-            max_size = (1200, 1200)
-            if img.width > max_size[0] or img.height > max_size[1]:
-                img.thumbnail(max_size, Image.LANCZOS)
-                
-            # Create thumbnail
-            thumb = img.copy()
-            thumb.thumbnail((300, 300), Image.LANCZOS)
-            
-            # Save both images to IO objects
-            img_io = io.BytesIO()
-            thumb_io = io.BytesIO()
-            
-            save_format = 'JPEG' if ext.lower() in ['jpg', 'jpeg'] else 'PNG'
-            quality = 85  # Good balance between size and quality
-            
-            # Convert to RGB mode if it's RGBA (has transparency) and we're saving as JPEG
-            if img.mode == 'RGBA' and save_format == 'JPEG':
-                img = img.convert('RGB')
-                thumb = thumb.convert('RGB')
-            
-            # Save full image
-            if save_format == 'JPEG':
-                img.save(img_io, format=save_format, quality=quality, optimize=True)
-            else:
-                img.save(img_io, format=save_format, optimize=True)
-            img_io.seek(0)
-            
-            # Save thumbnail
-            if save_format == 'JPEG':
-                thumb.save(thumb_io, format=save_format, quality=quality, optimize=True)
-            else:
-                thumb.save(thumb_io, format=save_format, optimize=True)
-            thumb_io.seek(0)
-            
-            # Save to storage
-            path = default_storage.save(
-                f'{upload_dir}/{filename}', 
-                ContentFile(img_io.getvalue())
-            )
-            
-            thumb_path = default_storage.save(
-                f'{upload_dir}/thumbnails/{thumb_filename}', 
-                ContentFile(thumb_io.getvalue())
-            )
+        listing = validated_data.pop('listing')
 
-            # Create ListingImage instance with file paths
-            listing_image = ListingImage(
-                **validated_data
-            )
-            
-            # Assign image and thumbnail fields
-            listing_image.image.name = path
-            listing_image.thumbnail.name = thumb_path
-            listing_image.save()
-            
-            # Set as primary if it's the first image for this listing
-            if not ListingImage.objects.filter(listing=listing_image.listing).exclude(id=listing_image.id).exists():
-                listing_image.is_primary = True
-                listing_image.save()
-                
-            return listing_image
-            
-        except Exception as e:
-            # Delete any saved files if there was an error
-            try:
-                default_storage.delete(f'{upload_dir}/{filename}')
-                default_storage.delete(f'{upload_dir}/thumbnails/{thumb_filename}')
-            except:
-                pass
-            raise serializers.ValidationError(f"Image processing error: {str(e)}")
+        # Store the original and return straight away; the resized image
+        # and thumbnail are produced in the background (see images.py)
+        listing_image = store_upload(listing, image, **validated_data)
+
+        # Set as primary if it's the first image for this listing
+        if not ListingImage.objects.filter(listing=listing).exclude(id=listing_image.id).exists():
+            listing_image.is_primary = True
+            listing_image.save(update_fields=['is_primary'])
+
+        return listing_image
             
     def update(self, instance, validated_data):
         """Allow updating position and primary status only"""
@@ -224,36 +146,50 @@ class TireListingSerializer(serializers.ModelSerializer):
     seller = serializers.SerializerMethodField()
     primary_image = serializers.SerializerMethodField()
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Load everything the serializer needs in a fixed number of queries.
+
+        The seller is joined (its rating totals are stored on the user row)
+        and images are prefetched, so the number of queries does not grow
+        with the number of listings.
+        """
+        return queryset.select_related('seller').prefetch_related('images')
+
     def get_seller_rating(self, obj):
         return obj.seller.get_average_rating()
 
     def get_seller_review_count(self, obj):
-        return Review.objects.filter(reviewed_user=obj.seller).count()
+        return obj.seller.rating_count
 
     def get_seller(self, obj):
         return {
             'id': str(obj.seller.id),
             'username': obj.seller.username,
-            'profile_image_url': obj.seller.profile_image_url,
+            'profile_image_url': obj.seller.avatar_url(128),
             'date_joined': obj.seller.date_joined.isoformat() if obj.seller.date_joined else None,
             'is_business': obj.seller.is_business,
             'rating': float(obj.seller.rating)
         }
         
     def get_primary_image(self, obj):
+        # Pick from obj.images.all() so a prefetch_related('images') cache is used
+        images = list(obj.images.all())
+
         # Get the primary image or the first image if no primary is set
-        primary_image = obj.images.filter(is_primary=True).first()
+        primary_image = next((image for image in images if image.is_primary), None)
         
         # If no primary image is set but there are images, get the first one
-        if not primary_image:
-            primary_image = obj.images.first()
+        if not primary_image and images:
+            primary_image = images[0]
             
         if primary_image:
             request = self.context.get('request')
             return {
                 'id': str(primary_image.id),
                 'image_url': request.build_absolute_uri(primary_image.image.url) if request and primary_image.image else (primary_image.image.url if primary_image.image else None),
-                'thumbnail_url': request.build_absolute_uri(primary_image.thumbnail.url) if request and primary_image.thumbnail else (primary_image.thumbnail.url if primary_image.thumbnail else None)
+                'thumbnail_url': request.build_absolute_uri(primary_image.thumbnail.url) if request and primary_image.thumbnail else (primary_image.thumbnail.url if primary_image.thumbnail else None),
+                'variants': ListingImageSerializer.variants_for(primary_image, request)
             }
         return None
         
@@ -310,9 +246,9 @@ class ReviewSerializer(serializers.ModelSerializer):
 
 class MessageSerializer(serializers.ModelSerializer):
     sender_name = serializers.CharField(source='sender.username', read_only=True)
-    sender_image = serializers.CharField(source='sender.profile_image_url', read_only=True)
+    sender_image = serializers.SerializerMethodField()
     receiver_name = serializers.CharField(source='receiver.username', read_only=True)
-    receiver_image = serializers.CharField(source='receiver.profile_image_url', read_only=True)
+    receiver_image = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
@@ -321,4 +257,10 @@ class MessageSerializer(serializers.ModelSerializer):
             'sender', 'sender_name', 'sender_image',
             'receiver', 'receiver_name', 'receiver_image'
         ]
-        read_only_fields = ['sender', 'created_at', 'is_read']
\ No newline at end of file
+        read_only_fields = ['sender', 'created_at', 'is_read']
+
+    def get_sender_image(self, obj):
+        return obj.sender.avatar_url(64)
+
+    def get_receiver_image(self, obj):
+        return obj.receiver.avatar_url(64)
\ No newline at end of file
@@ -1,10 +1,58 @@
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
-from .models import TireListing
+from .models import TireListing, ListingImage, Review, User
+from .images import profile_image_files, release_files
+from .media import delete_on_commit
+from .search import get_search_backend
+from . import facets
 
 @receiver(pre_save, sender=TireListing)
 def update_listing_timestamp(sender, instance, **kwargs):
     """Update the updated_at timestamp when a TireListing is modified"""
     if instance.pk:  # Only update timestamp if this is an existing instance
-        instance.updated_at = timezone.now() 
\ No newline at end of file
+        instance.updated_at = timezone.now()
+
+@receiver(post_delete, sender=Review)
+def remove_review_from_rating_aggregates(sender, instance, **kwargs):
+    """Take a deleted review out of the reviewed user's rating totals"""
+    User.adjust_rating_aggregates(instance.reviewed_user_id, -instance.rating, -1)
+
+@receiver(post_save, sender=TireListing)
+def index_listing_for_search(sender, instance, raw=False, **kwargs):
+    """Refresh the listing's full-text search document"""
+    if not raw:
+        get_search_backend().index_listings([instance.pk])
+
+@receiver(post_delete, sender=TireListing)
+def remove_listing_from_search(sender, instance, **kwargs):
+    """Drop the listing's full-text search document"""
+    get_search_backend().remove_listings([instance.pk])
+
+@receiver(post_save, sender=User)
+def reindex_seller_for_search(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    """Seller usernames are searchable, so refresh their listings when it changed"""
+    if created or raw:
+        return
+    if update_fields is not None and 'username' not in update_fields:
+        return
+    if instance.username == getattr(instance, '_loaded_username', None):
+        return
+    get_search_backend().index_seller(instance.pk)
+    instance._loaded_username = instance.username
+
+@receiver(post_save, sender=TireListing)
+@receiver(post_delete, sender=TireListing)
+def invalidate_listing_facets(sender, instance, **kwargs):
+    """Rebuild the cached tire size facets after a listing is saved or deleted"""
+    facets.invalidate()
+
+@receiver(post_delete, sender=ListingImage)
+def delete_listing_image_files(sender, instance, **kwargs):
+    """Delete the deleted image's files (shared content only once unused)"""
+    release_files(instance)
+
+@receiver(post_delete, sender=User)
+def delete_profile_image(sender, instance, **kwargs):
+    """Delete a deleted user's uploaded profile image and avatars"""
+    delete_on_commit(profile_image_files(instance))
\ No newline at end of file
@@ -0,0 +1,40 @@
+"""
+Media storage with a sharded directory layout.
+
+Uploads used to pile up in a few flat directories (every legacy thumbnail
+in tire_images/thumbnails/) or in one directory per listing, so directory
+lookups, backups and inode use all grew with the catalogue.
+ShardedFileSystemStorage keeps the top-level directory of each name and
+files everything else under two levels of hash prefixes:
+
+    listings/<listing id>/thumbnails/thumb_<uuid>.jpg
+    -> listings/3f/a2/thumb_<uuid>.jpg
+
+The prefixes come from a hash of the file name, so 65,536 directories per
+top-level directory stay evenly filled. Upload file names are unique (UUIDs
+or content hashes), so nothing else in the path is needed to tell them
+apart. Names already in that layout map to themselves, and the
+``shard_media`` command moves files stored before it.
+"""
+import hashlib
+import posixpath
+
+from django.core.files.storage import FileSystemStorage
+
+
+def shard_name(name):
+    """The sharded form of a storage name"""
+    directory, basename = posixpath.split(name)
+    top = directory.split('/')[0]
+    digest = hashlib.md5(basename.encode(), usedforsecurity=False).hexdigest()
+    return posixpath.join(top, digest[:2], digest[2:4], basename)
+
+
+class ShardedFileSystemStorage(FileSystemStorage):
+    """FileSystemStorage that saves every file under its shard_name()"""
+
+    def generate_filename(self, filename):
+        return super().generate_filename(shard_name(filename))
+
+    def get_available_name(self, name, max_length=None):
+        return super().get_available_name(shard_name(name), max_length=max_length)
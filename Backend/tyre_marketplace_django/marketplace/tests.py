@@ -1,3 +1,1149 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.conf import settings
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import User, TireListing, ImageContent, ListingImage, Review, Message, OutboundEmail
+from . import facets
+from .images import process_images, store_upload
+from .serializers import MessageSerializer, TireListingSerializer
+from .imaging import ORIENTATION_TAG, open_scaled
+from .media import media_name
+from .outbox import MAX_ATTEMPTS, RETRY_DELAY, queue_email, send_pending
+from .pagination import MAX_PAGE_SIZE
+from .storage import shard_name
+from .uploads import sniff_image
+from .realtime import websocket_application
+from .search import PostgresSearchBackend, get_search_backend
+from .tire_sizes import TireSize, extract_tire_sizes
+
+
+def create_listing(seller, **kwargs):
+    data = {
+        'seller': seller,
+        'title': 'Michelin Pilot Sport 4',
+        'price': Decimal('120.00'),
+        'condition': 'new',
+        'tire_type': 'summer',
+        'width': 225,
+        'aspect_ratio': 45,
+        'diameter': 17,
+        'load_index': 94,
+        'speed_rating': 'V',
+        'tread_depth': Decimal('8.00'),
+        'brand': 'Michelin',
+        'quantity': 4,
+    }
+    data.update(kwargs)
+    return TireListing.objects.create(**data)
+
+
+class ListingQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        reviewer = User.objects.create_user(username='reviewer', email='reviewer@example.com', password='pass')
+        for i in range(4):
+            seller = User.objects.create_user(username=f'seller{i}', email=f'seller{i}@example.com', password='pass')
+            Review.objects.create(reviewer=reviewer, reviewed_user=seller, rating=4)
+            for j in range(4):
+                listing = create_listing(seller, title=f'Listing {i}-{j}')
+                for position in range(2):
+                    ListingImage.objects.create(
+                        listing=listing,
+                        image=f'tire_images/{i}-{j}-{position}.jpg',
+                        thumbnail=f'tire_images/thumbnails/{i}-{j}-{position}.jpg',
+                        position=position,
+                        is_primary=position == 1,
+                    )
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_listings_query_count_does_not_depend_on_page_size(self):
+        small, _ = self.count_queries('/api/listings/?page_size=2')
+        large, response = self.count_queries('/api/listings/?page_size=16')
+        self.assertEqual(len(response.data['results']), 16)
+        self.assertEqual(small, large)
+
+    def test_serializer_uses_annotations_and_prefetched_images(self):
+        _, response = self.count_queries('/api/listings/?page_size=1')
+        listing = response.data['results'][0]
+        self.assertEqual(listing['seller_rating'], 4)
+        self.assertEqual(listing['seller_review_count'], 1)
+        self.assertTrue(listing['primary_image']['image_url'].endswith('-1.jpg'))
+
+
+class ListingPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        for i in range(5):
+            create_listing(seller, title=f'Listing {i}', is_promoted=i == 1)
+
+    def titles(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [listing['title'] for listing in response.data['results']]
+
+    def test_pages_are_sliced_in_the_database(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/listings/', {'page': 2, 'page_size': 2})
+        self.assertEqual(self.titles(response), ['Listing 3', 'Listing 2'])
+        self.assertEqual(response.data['count'], 5)
+        self.assertIn('page=3', response.data['next'])
+        self.assertIn('page=1', response.data['previous'])
+        self.assertTrue(any('LIMIT 2 OFFSET 2' in query['sql'] for query in ctx.captured_queries))
+
+        first = self.client.get('/api/listings/', {'page_size': 2})
+        self.assertEqual(self.titles(first), ['Listing 1', 'Listing 4'])  # Promoted first
+        self.assertIsNone(first.data['previous'])
+
+    def test_out_of_range_and_invalid_pages(self):
+        for page in ('0', '-3'):
+            response = self.client.get('/api/listings/', {'page': page, 'page_size': 2})
+            self.assertEqual(self.titles(response), ['Listing 1', 'Listing 4'])
+        self.assertEqual(self.titles(self.client.get('/api/listings/', {'page_size': 0})), ['Listing 1'])
+        self.assertEqual(self.titles(self.client.get('/api/listings/', {'page': 9})), [])
+        for params in ({'page': 'abc'}, {'page_size': '2.5'}):
+            self.assertEqual(self.client.get('/api/listings/', params).status_code, 400)
+
+    def test_page_size_is_capped(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/listings/', {'page_size': 1000000})
+        self.assertEqual(len(self.titles(response)), 5)
+        self.assertTrue(any(f'LIMIT {MAX_PAGE_SIZE}' in query['sql'] for query in ctx.captured_queries))
+
+
+class ListingCursorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        for i, mileage in enumerate([None, 500, None, 100, 500, 300, None]):
+            create_listing(seller, title=f'Listing {i}', mileage=mileage, is_promoted=i == 2)
+
+    def walk(self, **params):
+        """Follow next_cursor from the first page to the last; returns the titles seen"""
+        titles, cursor = [], ''
+        while True:
+            response = self.client.get('/api/listings/', {**params, 'page_size': 2, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            titles += [listing['title'] for listing in response.data['results']]
+            cursor = response.data['next_cursor']
+            if cursor is None:
+                return titles
+
+    def test_cursor_pages_match_the_full_ordering(self):
+        for sort_by in ('newest', 'price_low', 'mileage', '-mileage'):
+            everything = self.client.get('/api/listings/', {'sort_by': sort_by, 'page_size': 50}).data['results']
+            self.assertEqual(self.walk(sort_by=sort_by), [listing['title'] for listing in everything], sort_by)
+
+    def test_empty_values_sort_last_and_can_be_paged_through(self):
+        self.assertEqual(self.walk(sort_by='mileage'), [
+            'Listing 2', 'Listing 3', 'Listing 5', 'Listing 4', 'Listing 1', 'Listing 6', 'Listing 0',
+        ])
+
+    def test_invalid_sorts_and_cursors_are_rejected(self):
+        for sort_by in ('password', 'seller__password', '?'):
+            self.assertEqual(self.client.get('/api/listings/', {'sort_by': sort_by}).status_code, 400)
+        cursor = self.client.get('/api/listings/', {'page_size': 2, 'cursor': ''}).data['next_cursor']
+        response = self.client.get('/api/listings/', {'sort_by': 'mileage', 'cursor': cursor})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/listings/', {'cursor': 'garbage'}).status_code, 400)
+
+    def test_admin_list_pages_like_the_feed(self):
+        admin = User.objects.create_user(username='admin', email='admin@example.com', password='pass', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(admin)
+        titles, url = [], '/api/admin/listings/?page_size=3&cursor='
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(set(response.data), {'next', 'next_cursor', 'results'})
+            titles += [listing['title'] for listing in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(titles, [f'Listing {i}' for i in range(6, -1, -1)])
+
+
+class RatingAggregateTests(TestCase):
+    def setUp(self):
+        self.seller, self.other_seller, self.buyer, self.other_buyer = [
+            User.objects.create_user(username=name, email=f'{name}@example.com', password='pass')
+            for name in ('seller', 'other_seller', 'buyer', 'other_buyer')
+        ]
+
+    def totals(self, user):
+        user = User.objects.get(id=user.id)
+        return user.rating_sum, user.rating_count, user.rating
+
+    def test_review_writes_adjust_the_totals(self):
+        review = Review.objects.create(reviewer=self.buyer, reviewed_user=self.seller, rating=4)
+        Review.objects.create(reviewer=self.other_buyer, reviewed_user=self.seller, rating=5)
+        self.assertEqual(self.totals(self.seller), (9, 2, Decimal('4.5')))
+
+        review.rating = 2
+        review.save()
+        self.assertEqual(self.totals(self.seller), (7, 2, Decimal('3.5')))
+
+        review.reviewed_user = self.other_seller
+        review.save()
+        self.assertEqual(self.totals(self.seller), (5, 1, Decimal('5')))
+        self.assertEqual(self.totals(self.other_seller), (2, 1, Decimal('2')))
+
+        review.delete()
+        self.assertEqual(self.totals(self.other_seller), (0, 0, Decimal('0')))
+        self.other_buyer.delete()  # Cascades to their review
+        self.assertEqual(self.totals(self.seller), (0, 0, Decimal('0')))
+
+    def test_saving_a_user_loaded_earlier_keeps_the_totals(self):
+        stale = User.objects.get(id=self.seller.id)
+        Review.objects.create(reviewer=self.buyer, reviewed_user=self.seller, rating=4)
+        stale.phone = '555'
+        stale.save()
+
+        client = APIClient()
+        client.force_authenticate(stale)
+        Review.objects.create(reviewer=self.other_buyer, reviewed_user=self.seller, rating=2)
+        self.assertEqual(client.put('/api/profile/', {'phone': '556'}, format='json').status_code, 200)
+        self.assertEqual(self.totals(self.seller), (6, 2, Decimal('3')))
+        self.assertEqual(User.objects.get(id=self.seller.id).phone, '556')
+
+    def test_rebuild_rating_aggregates(self):
+        Review.objects.create(reviewer=self.buyer, reviewed_user=self.seller, rating=4)
+        Review.objects.create(reviewer=self.other_buyer, reviewed_user=self.seller, rating=3)
+        User.objects.update(rating_sum=1, rating_count=9, rating=Decimal('1'))
+
+        out = io.StringIO()
+        call_command('rebuild_rating_aggregates', '--batch-size', '3', stdout=out)
+        self.assertIn('Rebuilt rating aggregates for 4 users', out.getvalue())
+        self.assertEqual(self.totals(self.seller), (7, 2, Decimal('3.5')))
+        self.assertEqual(self.totals(self.buyer), (0, 0, Decimal('0')))
+
+
+class ListingSearchTests(TestCase):
+    """Runs on the test database's backend: FTS5 on SQLite, tsvector on PostgreSQL"""
+
+    def setUp(self):
+        self.seller = User.objects.create_user(username='tyrehouse', email='seller@example.com', password='pass')
+        self.summer = create_listing(self.seller, title='Michelin Pilot Sport 4', description='Summer tyre')
+        self.winter = create_listing(
+            self.seller, title='Nokian Hakkapeliitta R5', brand='Nokian', description='Fits Michelin rims too'
+        )
+
+    def search(self, query):
+        listings = get_search_backend().search(TireListing.objects.all(), query)
+        return list(listings.order_by('search_rank', '-created_at').values_list('title', flat=True))
+
+    def test_matches_are_ranked_by_relevance(self):
+        self.assertEqual(self.search('michelin'), ['Michelin Pilot Sport 4', 'Nokian Hakkapeliitta R5'])
+        self.assertEqual(self.search('hakka'), ['Nokian Hakkapeliitta R5'])
+        self.assertEqual(len(self.search('tyrehouse')), 2)
+        self.assertEqual(self.search('bridgestone'), [])
+
+    def test_feed_ranks_searches_in_the_default_sort(self):
+        # The app always sends sort_by=newest along with the search
+        for sort_by in (None, 'newest', '-created_at'):
+            params = {'search': 'michelin', 'page': 1, 'page_size': 100}
+            if sort_by:
+                params['sort_by'] = sort_by
+            response = self.client.get('/api/listings/', params)
+            titles = [listing['title'] for listing in response.data['results']]
+            self.assertEqual(titles, ['Michelin Pilot Sport 4', 'Nokian Hakkapeliitta R5'], sort_by)
+        # Any other sort is kept as asked
+        self.summer.price = Decimal('50.00')
+        self.summer.save()
+        response = self.client.get('/api/listings/', {'search': 'michelin', 'sort_by': 'price_high'})
+        self.assertEqual(response.data['results'][0]['title'], 'Nokian Hakkapeliitta R5')
+
+    def test_queries_without_words_leave_listings_unranked(self):
+        self.assertEqual(len(self.search('!!')), 2)
+        response = self.client.get('/api/listings/', {'search': '!!'})
+        self.assertEqual((response.status_code, response.data['count']), (200, 2))
+        response = self.client.get('/api/listings/search/', {'q': '!!'})
+        self.assertEqual((response.status_code, response.data['count']), (200, 2))
+
+    def test_index_follows_listing_and_seller_changes(self):
+        self.summer.title = 'Continental EcoContact 6'
+        self.summer.save()
+        self.assertEqual(self.search('ecocontact'), ['Continental EcoContact 6'])
+        self.assertEqual(self.search('pilot'), [])
+
+        seller = User.objects.get(id=self.seller.id)
+        with CaptureQueriesContext(connection) as ctx:
+            seller.is_verified = True
+            seller.save()
+        self.assertFalse(any('marketplace_listing_search' in query['sql'] for query in ctx.captured_queries))
+
+        seller.username = 'wheelbarn'
+        seller.save()
+        self.assertEqual(len(self.search('wheelbarn')), 2)
+        self.assertEqual(self.search('tyrehouse'), [])
+
+        self.winter.delete()
+        self.assertEqual(self.search('nokian'), [])
+
+
+class PostgresSearchQueryTests(SimpleTestCase):
+    def test_terms_become_a_prefix_tsquery(self):
+        listings = PostgresSearchBackend().search(TireListing.objects.all(), 'pilot sport-4!')
+        sql, params = listings.query.sql_with_params()
+        self.assertIn("ts_rank(marketplace_listing_search.document, to_tsquery('simple', %s))", sql)
+        self.assertIn("marketplace_listing_search.document @@ to_tsquery('simple', %s)", sql)
+        self.assertEqual(params.count('pilot:* | sport:* | 4:*'), 2)
+
+
+@override_settings(REQUEST_INSTRUMENTATION_SAMPLE_RATE=1.0)
+class RequestInstrumentationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='pass')
+        create_listing(cls.user)
+
+    def assertLogged(self, logs, query_count):
+        [record] = logs.records
+        self.assertEqual(record.query_count, query_count)
+        self.assertGreaterEqual(record.duration_ms, record.query_ms)
+        self.assertGreater(record.query_ms, 0)
+
+    def test_sync_requests_report_their_queries(self):
+        with CaptureQueriesContext(connection) as ctx, self.assertLogs('marketplace.instrumentation', 'INFO') as logs:
+            self.assertEqual(self.client.get('/api/listings/').status_code, 200)
+        self.assertLogged(logs, len(ctx.captured_queries))
+
+    async def test_async_requests_report_their_queries(self):
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        with self.assertLogs('marketplace.instrumentation', 'INFO') as logs:
+            response = await self.async_client.get('/api/messages/unread/wait/', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertLogged(logs, 1)  # The unread count
+
+
+class TireSizeParserTests(SimpleTestCase):
+    def assertSize(self, text, size):
+        self.assertEqual(extract_tire_sizes(text), ([size], ''), text)
+
+    def test_metric_notations(self):
+        for text in ['225/45R17', 'P225/45ZR17', '225/45-17', '225 45 17', '225/45 R 17']:
+            self.assertSize(text, TireSize(225, 45, 17))
+
+    def test_lt_with_load_and_speed(self):
+        self.assertSize('LT265/75R16 (123 S)', TireSize(265, 75, 16, 123, 'S'))
+        self.assertSize('225/45R17 94V', TireSize(225, 45, 17, 94, 'V'))
+
+    def test_flotation_is_converted_to_metric(self):
+        self.assertSize('31x10.50R15', TireSize(265, 75, 15))
+
+    def test_sizes_are_split_from_text(self):
+        sizes, text = extract_tire_sizes('michelin 205/55 R16 91H pilot')
+        self.assertEqual(sizes, [TireSize(205, 55, 16, 91, 'H')])
+        self.assertEqual(text, 'michelin pilot')
+
+    def test_non_sizes_are_left_alone(self):
+        self.assertEqual(extract_tire_sizes('pilot sport 4'), ([], 'pilot sport 4'))
+        self.assertEqual(extract_tire_sizes('999/99R99'), ([], '999/99R99'))
+
+
+class TireSizeFacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.seller = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        self.listing = create_listing(self.seller)
+        create_listing(self.seller, diameter=18, speed_rating='W', load_index=95)
+        create_listing(self.seller, width=205, aspect_ratio=55, diameter=16, speed_rating='H', load_index=91)
+        create_listing(self.seller, width=195, aspect_ratio=65, diameter=15, speed_rating='T', load_index=88, is_active=False)
+
+    def widths(self):
+        return self.client.get('/api/tire-sizes/widths/').data['widths']
+
+    def test_tree_lists_the_sizes_of_active_listings(self):
+        response = self.client.get('/api/tire-sizes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {
+            'sizes': [
+                {'width': 205, 'aspect_ratios': [{'aspect_ratio': 55, 'diameters': [16]}]},
+                {'width': 225, 'aspect_ratios': [{'aspect_ratio': 45, 'diameters': [17, 18]}]},
+            ],
+            'speed_ratings': ['H', 'V', 'W'],
+            'load_indices': [91, 94, 95],
+        })
+        self.assertEqual(self.widths(), [205, 225])
+        response = self.client.get('/api/tire-sizes/aspect-ratios/', {'width': 225})
+        self.assertEqual(response.data['aspect_ratios'], [45])
+        response = self.client.get('/api/tire-sizes/diameters/', {'width': 225, 'aspect_ratio': 45})
+        self.assertEqual(response.data['diameters'], [17, 18])
+        self.assertEqual(self.client.get('/api/tire-sizes/aspect-ratios/', {'width': 'abc'}).status_code, 400)
+
+    def test_unchanged_facets_revalidate_with_304(self):
+        response = self.client.get('/api/tire-sizes/')
+        self.assertIn('Last-Modified', response)
+        for url in ('/api/tire-sizes/', '/api/tire-sizes/widths/', '/api/tire-sizes/speed-ratings/'):
+            cached = self.client.get(url, headers={'If-None-Match': response['ETag']})
+            self.assertEqual(cached.status_code, 304, url)
+
+    def test_committed_saves_and_deletes_rebuild_the_facets(self):
+        etag = self.client.get('/api/tire-sizes/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            added = create_listing(self.seller, width=255, aspect_ratio=35, diameter=19)
+        self.assertEqual(self.widths(), [205, 225, 255])
+        response = self.client.get('/api/tire-sizes/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            added.delete()
+            self.listing.width = 235
+            self.listing.save()
+        self.assertEqual(self.widths(), [205, 225, 235])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            TireListing.objects.get(width=205).delete()
+        self.assertEqual(self.widths(), [225, 235])
+
+    def test_snapshot_built_before_a_commit_is_never_served(self):
+        self.assertEqual(self.widths(), [205, 225])
+        # A reader in another process that read the rows before the commit
+        # stores its snapshot after the invalidation
+        generation = facets._generation()
+        stale = facets.build_snapshot()
+        with self.captureOnCommitCallbacks(execute=True):
+            create_listing(self.seller, width=255, aspect_ratio=35, diameter=19)
+        cache.set(f'{facets.FACETS_CACHE_KEY}:{generation}', stale)
+        self.assertEqual(self.widths(), [205, 225, 255])
+
+
+class ListingFacetCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        seller = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        create_listing(seller)
+        create_listing(seller, width=205)
+        create_listing(seller, condition='used')
+        create_listing(seller, brand='Continental', tire_type='winter')
+        create_listing(seller, brand='Pirelli', condition='used', tire_type='winter', width=205)
+        create_listing(seller, brand='Pirelli', is_active=False)
+
+    def counts(self, **params):
+        response = self.client.get('/api/listings/', {'facets': 'brand,condition', **params})
+        self.assertEqual(response.status_code, 200)
+        return {
+            name: [(row['value'], row['count']) for row in rows]
+            for name, rows in response.data['facets'].items()
+        }
+
+    def test_counts_active_listings_per_value(self):
+        self.assertEqual(self.counts(), {
+            'brand': [('Michelin', 3), ('Continental', 1), ('Pirelli', 1)],
+            'condition': [('new', 3), ('used', 2)],
+        })
+
+    def test_each_facet_ignores_its_own_filter(self):
+        self.assertEqual(self.counts(brand='Michelin'), {
+            'brand': [('Michelin', 3), ('Continental', 1), ('Pirelli', 1)],
+            'condition': [('new', 2), ('used', 1)],
+        })
+        self.assertEqual(self.counts(brand='Michelin', condition='used'), {
+            'brand': [('Michelin', 1), ('Pirelli', 1)],
+            'condition': [('new', 2), ('used', 1)],
+        })
+
+    def test_other_filters_apply_to_every_facet(self):
+        self.assertEqual(self.counts(brand='Michelin', width=205), {
+            'brand': [('Michelin', 1), ('Pirelli', 1)],
+            'condition': [('new', 1)],
+        })
+        self.assertEqual(self.counts(tire_type='winter'), {
+            'brand': [('Continental', 1), ('Pirelli', 1)],
+            'condition': [('new', 1), ('used', 1)],
+        })
+
+    def test_requested_facets(self):
+        response = self.client.get('/api/listings/?facets=brand&facets=tire_type,password')
+        self.assertEqual(list(response.data['facets']), ['brand', 'tire_type'])
+        self.assertNotIn('facets', self.client.get('/api/listings/').data)
+
+
+class ConversationListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='pass')
+        for i in range(6):
+            partner = User.objects.create_user(username=f'partner{i}', email=f'partner{i}@example.com', password='pass')
+            Message.objects.create(sender=partner, receiver=cls.user, content=f'Question {i}')
+            Message.objects.create(sender=partner, receiver=cls.user, content=f'Follow-up {i}')
+            if i % 2:
+                Message.objects.create(sender=cls.user, receiver=partner, content=f'Answer {i}')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.data
+
+    def test_last_message_and_unread_count_per_partner(self):
+        _, conversations = self.get('/api/messages/conversations/')
+        self.assertEqual([c['user']['username'] for c in conversations], [f'partner{i}' for i in range(5, -1, -1)])
+        self.assertEqual(conversations[0]['last_message']['content'], 'Answer 5')
+        self.assertEqual(conversations[1]['last_message']['content'], 'Follow-up 4')
+        self.assertTrue(all(c['unread_count'] == 2 for c in conversations))
+
+    def test_query_count_does_not_depend_on_partner_count(self):
+        small, _ = self.get('/api/messages/conversations/?page_size=1')
+        large, data = self.get('/api/messages/conversations/?page_size=6')
+        self.assertEqual(data['count'], 6)
+        self.assertEqual(len(data['results']), 6)
+        self.assertEqual(small, large)
+
+    def test_invalid_page_parameters(self):
+        for params in ('page_size=abc', 'page=x'):
+            response = self.client.get(f'/api/messages/conversations/?{params}')
+            self.assertEqual(response.status_code, 400, params)
+        _, data = self.get('/api/messages/conversations/?page=0&page_size=-1')
+        self.assertEqual([c['user']['username'] for c in data['results']], ['partner5'])
+        self.assertIsNone(data['previous'])
+
+
+class ChatHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='pass')
+        cls.other = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        cls.messages = [
+            Message.objects.create(sender=cls.other, receiver=cls.user, content=f'Message {i}')
+            for i in range(5)
+        ]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = f'/api/messages/history/{self.other.id}/'
+
+    def test_pages_backwards_and_marks_only_returned_messages_read(self):
+        first = self.client.get(self.url, {'page_size': 2}).data
+        self.assertEqual([m['content'] for m in first['results']], ['Message 3', 'Message 4'])
+        self.assertEqual(Message.objects.filter(is_read=False).count(), 3)
+
+        second = self.client.get(self.url, {'page_size': 2, 'cursor': first['next_cursor']}).data
+        self.assertEqual([m['content'] for m in second['results']], ['Message 1', 'Message 2'])
+
+    def test_since_returns_only_newer_messages(self):
+        data = self.client.get(self.url, {'since': str(self.messages[2].id), 'page_size': 1}).data
+        self.assertEqual([m['content'] for m in data['results']], ['Message 3'])
+        self.assertTrue(data['has_more'])
+        self.assertEqual(self.client.get(self.url, {'since': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'since': '2024-13-45T00:00:00'}).status_code, 400)
+
+    def test_invalid_page_size(self):
+        self.assertEqual(self.client.get(self.url, {'page_size': 'abc'}).status_code, 400)
+        data = self.client.get(self.url, {'page_size': 0}).data
+        self.assertEqual([m['content'] for m in data['results']], ['Message 4'])
+        data = self.client.get(self.url, {'since': str(self.messages[2].id), 'page_size': -5}).data
+        self.assertEqual([m['content'] for m in data['results']], ['Message 3'])
+
+    def test_page_size_is_capped(self):
+        Message.objects.bulk_create(
+            Message(sender=self.other, receiver=self.user, content=f'Extra {i}') for i in range(MAX_PAGE_SIZE)
+        )
+        data = self.client.get(self.url, {'page_size': 1000000}).data
+        self.assertEqual(len(data['results']), MAX_PAGE_SIZE)
+        self.assertIsNotNone(data['next_cursor'])
+        data = self.client.get(self.url, {'since': str(self.messages[0].id), 'page_size': 1000000}).data
+        self.assertEqual(len(data['results']), MAX_PAGE_SIZE)
+        self.assertTrue(data['has_more'])
+
+
+class WebSocketConnection:
+    """Drive the WebSocket ASGI application in memory"""
+
+    def __init__(self, path, query_string=b''):
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        scope = {'type': 'websocket', 'path': path, 'query_string': query_string, 'headers': []}
+        self.task = asyncio.ensure_future(websocket_application(scope, self.incoming.get, self.outgoing.put))
+
+    async def connect(self):
+        await self.incoming.put({'type': 'websocket.connect'})
+        return await self.receive()
+
+    async def receive(self):
+        return await asyncio.wait_for(self.outgoing.get(), timeout=1)
+
+    async def receive_json(self):
+        return json.loads((await self.receive())['text'])
+
+    async def disconnect(self):
+        await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(self.task, timeout=1)
+
+
+class RecordingBroker:
+    """Stand-in for the in-process broker that just records what is published"""
+    published = []
+
+    def subscribe(self, user_id):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        pass
+
+    def publish(self, user_id, event):
+        self.published.append((str(user_id), event))
+
+
+class RealtimeMessagingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='pass')
+        cls.other = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.other)
+
+    def post(self, url, data=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(url, data)
+
+    async def test_pushes_new_messages_and_read_receipts(self):
+        token = str(AccessToken.for_user(self.user))
+        socket = WebSocketConnection('/ws/messages/', f'token={token}'.encode())
+        self.assertEqual((await socket.connect())['type'], 'websocket.accept')
+
+        await sync_to_async(self.post)('/api/messages/send/', {'receiver': self.user.id, 'content': 'Still available?'})
+        event = await socket.receive_json()
+        self.assertEqual(event['type'], 'message.new')
+        self.assertEqual(event['message']['content'], 'Still available?')
+
+        self.client.force_authenticate(self.user)
+        await sync_to_async(self.post)(f'/api/messages/read/{self.other.id}/')
+        event = await socket.receive_json()
+        self.assertEqual(event['type'], 'message.read')
+        self.assertEqual(event['reader'], str(self.user.id))
+        self.assertEqual(len(event['message_ids']), 1)
+        await socket.disconnect()
+
+    async def test_rejects_connections_without_a_valid_token(self):
+        socket = WebSocketConnection('/ws/messages/', b'token=invalid')
+        self.assertEqual(await socket.connect(), {'type': 'websocket.close', 'code': 4401})
+
+    @override_settings(MESSAGE_BROKER='marketplace.tests.RecordingBroker')
+    def test_broker_can_be_replaced(self):
+        RecordingBroker.published.clear()
+        self.post('/api/messages/send/', {'receiver': self.user.id, 'content': 'Hello'})
+        self.assertEqual(
+            sorted(user_id for user_id, _ in RecordingBroker.published),
+            sorted([str(self.user.id), str(self.other.id)])
+        )
+
+
+class UnreadLongPollTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='pass')
+        cls.other = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        Message.objects.create(sender=cls.other, receiver=cls.user, content='Hello')
+
+    def send_message(self):
+        client = APIClient()
+        client.force_authenticate(self.other)
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post('/api/messages/send/', {'receiver': self.user.id, 'content': 'Any news?'})
+
+    async def wait(self, **params):
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        response = await self.async_client.get('/api/messages/unread/wait/', params, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    async def test_returns_count_immediately_without_a_version(self):
+        data = await self.wait()
+        self.assertEqual(data['unread_count'], 1)
+
+    async def test_wakes_up_when_a_message_arrives(self):
+        version = (await self.wait())['version']
+        waiter = asyncio.ensure_future(self.wait(version=version, timeout=5))
+        await asyncio.sleep(0.05)
+        await sync_to_async(self.send_message)()
+        data = await asyncio.wait_for(waiter, timeout=5)
+        self.assertTrue(data['changed'])
+        self.assertEqual(data['unread_count'], 2)
+
+    async def test_times_out_without_changes(self):
+        version = (await self.wait())['version']
+        self.assertEqual(await self.wait(version=version, timeout=0.05), {'changed': False, 'version': version})
+
+    async def test_requires_a_valid_token(self):
+        response = await self.async_client.get('/api/messages/unread/wait/')
+        self.assertEqual(response.status_code, 401)
+
+
+class MessageBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.shop = User.objects.create_user(username='shop', email='shop@example.com', password='pass')
+        cls.buyers = [
+            User.objects.create_user(username=f'buyer{i}', email=f'buyer{i}@example.com', password='pass')
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.shop)
+
+    def test_batch_send_saves_all_messages_or_none(self):
+        payload = {'messages': [{'receiver': str(buyer.id), 'content': 'In stock'} for buyer in self.buyers]}
+        response = self.client.post('/api/messages/send/batch/', payload, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Message.objects.filter(sender=self.shop).count(), 3)
+
+        payload['messages'].append({'receiver': str(uuid.uuid4()), 'content': 'Lost'})
+        response = self.client.post('/api/messages/send/batch/', payload, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Message.objects.filter(sender=self.shop).count(), 3)
+
+    def test_bulk_read_by_message_and_partner_ids(self):
+        messages = [Message.objects.create(sender=buyer, receiver=self.shop, content='Price?') for buyer in self.buyers]
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                '/api/messages/read/',
+                {'message_ids': [str(messages[0].id)], 'user_ids': [str(self.buyers[1].id)]},
+                format='json'
+            )
+        self.assertEqual(response.data['updated'], 2)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "marketplace_message"') for query in ctx.captured_queries), 1)
+        self.assertEqual(list(Message.objects.filter(is_read=False)), [messages[2]])
+
+
+def jpeg_upload(name='tyre.jpg', size=(2400, 1600)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (40, 40, 40)).save(buffer, 'JPEG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+
+class MediaRootMixin:
+    """Write uploads to a throwaway MEDIA_ROOT"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root, IMAGE_PROCESSING_THREADS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class ListingImageProcessingTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.seller = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        self.listing = create_listing(self.seller)
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+    def test_upload_returns_before_processing_and_worker_finishes_it(self):
+        response = self.client.post(
+            f'/api/listings/{self.listing.id}/images/',
+            {'images': [jpeg_upload(), SimpleUploadedFile('broken.jpg', b'not a jpeg')]},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['errors']), 1)
+        [uploaded] = response.data['images']
+        self.assertEqual(uploaded['status'], ListingImage.STATUS_PENDING)
+        self.assertIsNone(uploaded['thumbnail_url'])
+
+        call_command('process_images', '--once', stdout=io.StringIO())
+
+        image = ListingImage.objects.get(id=uploaded['id'])
+        self.assertEqual(image.status, ListingImage.STATUS_READY)
+        self.assertEqual(Image.open(image.image).size, (1200, 800))
+        self.assertEqual(Image.open(image.thumbnail).size, (300, 200))
+        self.assertEqual(image.original.name, shard_name(f'images/{image.content_id}.jpg'))
+
+    def test_duplicate_upload_reuses_files_until_the_last_reference_goes(self):
+        first = store_upload(self.listing, jpeg_upload())
+        process_images([first.id])
+        first.refresh_from_db()
+        other_listing = create_listing(self.seller)
+
+        with self.assertNumQueries(5):
+            duplicate = store_upload(other_listing, jpeg_upload(name='same-photo.jpg'))
+
+        self.assertEqual(duplicate.status, ListingImage.STATUS_READY)
+        self.assertEqual(duplicate.content_id, first.content_id)
+        self.assertEqual(
+            (duplicate.image.name, duplicate.thumbnail.name, duplicate.variants),
+            (first.image.name, first.thumbnail.name, first.variants),
+        )
+        self.assertEqual(ImageContent.objects.get().ref_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(ImageContent.objects.get().ref_count, 1)
+        self.assertTrue(default_storage.exists(duplicate.image.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            other_listing.delete()
+        self.assertFalse(ImageContent.objects.exists())
+        for name in [duplicate.original.name, duplicate.image.name] + [v['path'] for v in duplicate.variants]:
+            self.assertFalse(default_storage.exists(name))
+
+    @override_settings(LISTING_IMAGE_VARIANT_WIDTHS=[320, 640, 1600], LISTING_IMAGE_VARIANT_FORMATS=['webp', 'jpeg'])
+    def test_responsive_variants_are_exposed_by_format(self):
+        image = store_upload(self.listing, jpeg_upload(size=(2400, 1600)))
+        process_images([image.id])
+
+        response = self.client.get(f'/api/listings/{self.listing.id}/')
+        variants = response.data['images'][0]['variants']
+        self.assertEqual(list(variants), ['webp', 'jpeg'])
+        # Never upscaled past the 1200px image; 1600 is served by the widest copy
+        self.assertEqual([(v['width'], v['height']) for v in variants['jpeg']], [(1200, 800), (640, 427), (320, 213)])
+        self.assertTrue(all(v['size'] > 0 and v['url'].startswith('http://testserver/') for v in variants['webp']))
+        self.assertEqual(response.data['primary_image']['variants'], variants)
+
+    def test_parallel_processing_captures_errors_per_image(self):
+        good = [store_upload(self.listing, jpeg_upload()) for _ in range(3)]
+        bad = store_upload(self.listing, SimpleUploadedFile('truncated.jpg', b'\xff\xd8\xff\xe0 not really'))
+
+        results = process_images([image.id for image in good + [bad]], workers=3)
+
+        self.assertIsNotNone(results[bad.id])
+        self.assertEqual([results[image.id] for image in good], [None] * 3)
+        statuses = dict(ListingImage.objects.values_list('id', 'status'))
+        self.assertEqual(statuses[bad.id], ListingImage.STATUS_FAILED)
+        self.assertEqual({statuses[image.id] for image in good}, {ListingImage.STATUS_READY})
+
+
+class OpenScaledTests(SimpleTestCase):
+    def test_decodes_rotated_phone_photo_upright_and_fitted(self):
+        # Stored landscape with a red left half; EXIF orientation 6 displays it portrait, red on top
+        img = Image.new('RGB', (4000, 3000), (0, 0, 255))
+        img.paste((255, 0, 0), (0, 0, 2000, 3000))
+        exif = Image.Exif()
+        exif[ORIENTATION_TAG] = 6
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', exif=exif)
+        buffer.seek(0)
+
+        scaled = open_scaled(buffer, (1200, 1200))
+
+        self.assertEqual(scaled.size, (900, 1200))
+        red, _, blue = scaled.getpixel((450, 100))
+        self.assertGreater(red, 200)
+        self.assertLess(blue, 50)
+
+
+class MediaServingTests(MediaRootMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content_path = default_storage.save(f'images/ab/{"ab" * 32}_large.jpg', ContentFile(b'0123456789'))
+        self.mutable_path = default_storage.save('misc/banner.jpg', ContentFile(b'0123456789'))
+
+    def test_content_addressed_files_are_immutable_and_revalidate_with_etag(self):
+        response = self.client.get(f'/media/{self.content_path}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+
+        cached = self.client.get(f'/media/{self.content_path}', headers={'If-None-Match': response['ETag']})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+        other = self.client.get(f'/media/{self.mutable_path}')
+        self.assertEqual(other['Cache-Control'], 'public, no-cache')
+
+    def test_byte_ranges(self):
+        url = f'/media/{self.content_path}'
+        response = self.client.get(url, headers={'Range': 'bytes=2-5'})
+        self.assertEqual((response.status_code, response.content), (206, b'2345'))
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+
+        self.assertEqual(self.client.get(url, headers={'Range': 'bytes=-3'}).content, b'789')
+        self.assertEqual(self.client.get(url, headers={'Range': 'bytes=20-'}).status_code, 416)
+        # A stale If-Range gets the whole file
+        stale = self.client.get(url, headers={'Range': 'bytes=2-5', 'If-Range': '"stale"'})
+        self.assertEqual(stale.status_code, 200)
+
+    @override_settings(MEDIA_SENDFILE_HEADER='X-Accel-Redirect', MEDIA_ACCEL_REDIRECT_PREFIX='/protected/')
+    def test_transfer_can_be_offloaded_to_the_web_server(self):
+        response = self.client.get(f'/media/{self.content_path}')
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{self.content_path}')
+        self.assertEqual(response.content, b'')
+        self.assertIn('ETag', response)
+
+    def test_paths_outside_media_root_are_not_found(self):
+        self.assertEqual(self.client.get('/media/../settings.py').status_code, 404)
+        self.assertEqual(self.client.get('/media/images/missing.jpg').status_code, 404)
+
+
+class MediaCleanupTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.seller = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        self.listing = create_listing(self.seller)
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+    def age(self, name, seconds=7200):
+        path = default_storage.path(name)
+        os.utime(path, (time.time() - seconds,) * 2)
+
+    def test_deleting_an_image_or_replacing_an_avatar_deletes_the_files(self):
+        image = store_upload(self.listing, jpeg_upload())
+        process_images([image.id])
+        image.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(f'/api/listings/{self.listing.id}/images/{image.id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(default_storage.exists(image.image.name))
+        self.assertFalse(default_storage.exists(image.original.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/profile/upload-image/', {'image': jpeg_upload('me.jpg')}, format='multipart')
+        old = media_name(User.objects.get(id=self.seller.id).profile_image_url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/profile/upload-image/', {'image': jpeg_upload('me2.jpg')}, format='multipart')
+        self.assertFalse(default_storage.exists(old))
+        self.assertTrue(default_storage.exists(media_name(User.objects.get(id=self.seller.id).profile_image_url)))
+
+    def test_collect_media_deletes_only_old_unreferenced_files(self):
+        image = store_upload(self.listing, jpeg_upload())
+        process_images([image.id])
+        image.refresh_from_db()
+        kept = [image.image.name, image.original.name] + [variant['path'] for variant in image.variants]
+        orphan = default_storage.save('listings/gone/orphan.jpg', ContentFile(b'x' * 100))
+        recent = default_storage.save('listings/gone/just-uploaded.jpg', ContentFile(b'x'))
+        for name in kept + [orphan]:
+            self.age(name)
+
+        out = io.StringIO()
+        call_command('collect_media', '--dry-run', stdout=out)
+        self.assertIn('Would delete 1 of', out.getvalue())
+        self.assertTrue(default_storage.exists(orphan))
+
+        call_command('collect_media', stdout=io.StringIO())
+        self.assertFalse(default_storage.exists(orphan))
+        self.assertTrue(default_storage.exists(recent))
+        self.assertTrue(all(default_storage.exists(name) for name in kept))
+
+
+class ShardedStorageTests(MediaRootMixin, TestCase):
+    def test_files_are_saved_under_hashed_directories(self):
+        name = default_storage.save('listings/abc/thumbnails/thumb_1.jpg', ContentFile(b'x'))
+        self.assertRegex(name, r'^listings/[0-9a-f]{2}/[0-9a-f]{2}/thumb_1\.jpg$')
+        self.assertEqual(shard_name(name), name)
+
+    def test_shard_media_moves_old_files_and_rewrites_paths(self):
+        seller = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        listing = create_listing(seller)
+        flat = FileSystemStorage()  # The layout before sharding
+        old_names = {
+            field: flat.save(f'listings/{listing.id}/{field}/{uuid.uuid4()}.jpg', ContentFile(field.encode()))
+            for field in ('image', 'thumbnail', 'variant', 'avatar')
+        }
+        image = ListingImage.objects.create(
+            listing=listing, image=old_names['image'], thumbnail=old_names['thumbnail'],
+            variants=[{'width': 320, 'height': 213, 'format': 'jpeg', 'size': 7, 'path': old_names['variant']}],
+        )
+        User.objects.filter(id=seller.id).update(profile_image_url=settings.MEDIA_URL + old_names['avatar'])
+
+        out = io.StringIO()
+        call_command('shard_media', '--batch-size', '1', stdout=out)
+        self.assertIn('Moved 4 files and updated 2 rows', out.getvalue())
+
+        image.refresh_from_db()
+        new_names = [image.image.name, image.thumbnail.name, image.variants[0]['path'],
+                     media_name(User.objects.get(id=seller.id).profile_image_url)]
+        self.assertEqual(new_names, [shard_name(name) for name in old_names.values()])
+        self.assertEqual([default_storage.open(name).read() for name in new_names], [b'image', b'thumbnail', b'variant', b'avatar'])
+        self.assertFalse(os.path.exists(default_storage.path(f'listings/{listing.id}')))
+
+        out = io.StringIO()
+        call_command('shard_media', stdout=out)
+        self.assertIn('Moved 0 files and updated 0 rows', out.getvalue())
+
+
+class StreamingUploadCheckTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.seller = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        self.listing = create_listing(self.seller)
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+    @override_settings(IMAGE_UPLOAD_MAX_FILE_SIZE=100_000, IMAGE_UPLOAD_MAX_PIXELS=1_000_000)
+    def test_invalid_files_are_skipped_while_streaming(self):
+        oversized = jpeg_upload('huge.jpg', size=(800, 600))
+        oversized = SimpleUploadedFile('huge.jpg', oversized.read() + b'\0' * 200_000, 'image/jpeg')
+        response = self.client.post(
+            f'/api/listings/{self.listing.id}/images/',
+            {'images': [
+                jpeg_upload('good.jpg', size=(800, 600)),
+                oversized,
+                SimpleUploadedFile('script.jpg', b'#!/bin/sh\nrm -rf /', 'image/jpeg'),
+                jpeg_upload('bomb.jpg', size=(1200, 900)),
+            ]},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['images']), 1)
+        self.assertEqual(response.data['errors'], [
+            'Image huge.jpg exceeds 0.0954MB size limit',
+            'Image script.jpg is not a JPEG or PNG image',
+            'Image bomb.jpg is too large (1200x900 pixels)',
+        ])
+
+    @override_settings(IMAGE_UPLOAD_MAX_FILE_SIZE=10_000)
+    def test_oversized_requests_are_refused_unread(self):
+        body = jpeg_upload('me.jpg').read() + b'\0' * (2 * 1024 * 1024)
+        response = self.client.post(
+            '/api/profile/upload-image/', {'image': SimpleUploadedFile('me.jpg', body)}, format='multipart'
+        )
+        self.assertEqual(response.status_code, 413)
+        self.assertIsNone(User.objects.get(id=self.seller.id).profile_image_url)
+
+    def test_profile_image_must_be_an_image(self):
+        response = self.client.post(
+            '/api/profile/upload-image/', {'image': SimpleUploadedFile('me.png', b'GIF89a')}, format='multipart'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Image me.png is not a JPEG or PNG image')
+
+    def test_dimensions_come_from_the_header_alone(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (640, 480)).save(buffer, 'PNG')
+        self.assertEqual(sniff_image(buffer.getvalue()[:64]), ('PNG', (640, 480)))
+        self.assertIsNone(sniff_image(b'\xff\xd8\xff\xe0'))
+
+
+class ProfileImageTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.seller = User.objects.create_user(username='seller', email='seller@example.com', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+    def test_upload_is_resized_with_avatar_variants(self):
+        response = self.client.post(
+            '/api/profile/upload-image/', {'image': jpeg_upload('me.jpg', size=(1600, 1200))}, format='multipart'
+        )
+        self.assertEqual(response.status_code, 200)
+        seller = User.objects.get(id=self.seller.id)
+        with default_storage.open(media_name(seller.profile_image_url)) as f, Image.open(f) as img:
+            self.assertEqual(img.size, (512, 384))
+        self.assertEqual(sorted(seller.profile_image_variants), ['128', '64'])
+        for size, url in seller.profile_image_variants.items():
+            with default_storage.open(media_name(url)) as f, Image.open(f) as img:
+                self.assertEqual(img.size, (int(size), int(size)))
+        self.assertEqual(response.data['avatar_urls'], seller.profile_image_variants)
+
+        listing = TireListingSerializer(create_listing(seller)).data
+        self.assertEqual(listing['seller']['profile_image_url'], seller.profile_image_variants['128'])
+        message = Message.objects.create(sender=seller, receiver=seller, content='Hi')
+        self.assertEqual(MessageSerializer(message).data['sender_image'], seller.profile_image_variants['64'])
+        self.assertEqual(seller.avatar_url(256), seller.profile_image_url)
+
+        names = [media_name(seller.profile_image_url), *map(media_name, seller.profile_image_variants.values())]
+        with self.captureOnCommitCallbacks(execute=True):
+            seller.delete()
+        self.assertFalse(any(default_storage.exists(name) for name in names))
+
+    def test_backfill_avatars_for_existing_profile_images(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (300, 200)).save(buffer, 'PNG')
+        name = default_storage.save(f'profile_images/{self.seller.id}/old.png', ContentFile(buffer.getvalue()))
+        User.objects.filter(id=self.seller.id).update(profile_image_url=settings.MEDIA_URL + name)
+
+        out = io.StringIO()
+        call_command('process_images', '--once', '--backfill-avatars', stdout=out)
+        self.assertIn('Made avatars for 1 users', out.getvalue())
+        seller = User.objects.get(id=self.seller.id)
+        with default_storage.open(media_name(seller.avatar_url(64))) as f, Image.open(f) as img:
+            self.assertEqual((img.format, img.size), ('PNG', (64, 64)))
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """locmem backend that refuses mail for bounce@ addresses and counts connections"""
+    opened = 0
+
+    def open(self):
+        FlakyEmailBackend.opened += 1
+
+    def send_messages(self, messages):
+        if any('bounce@example.com' in message.to for message in messages):
+            raise ConnectionError('Mailbox unavailable')
+        return super().send_messages(messages)
+
+
+class EmailOutboxTests(TestCase):
+    def test_emails_are_queued_and_sent_by_the_worker(self):
+        User.objects.create_user(username='buyer', email='buyer@example.com', password='pass')
+        response = APIClient().post('/api/auth/request-reset/', {'email': 'buyer@example.com'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.STATUS_PENDING)
+
+        out = io.StringIO()
+        call_command('send_emails', '--once', stdout=out)
+        self.assertIn('Sent 1 emails, 0 failed', out.getvalue())
+        self.assertEqual(mail.outbox[0].to, ['buyer@example.com'])
+        self.assertIn('/reset-password/', mail.outbox[0].body)
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.STATUS_SENT)
+
+    @override_settings(EMAIL_BACKEND='marketplace.tests.FlakyEmailBackend')
+    def test_failed_emails_are_retried_with_backoff(self):
+        FlakyEmailBackend.opened = 0
+        for recipient in ('a@example.com', 'bounce@example.com', 'b@example.com'):
+            queue_email(recipient, 'Hello', 'Hi')
+        results = send_pending()
+        self.assertEqual([error is None for error in results.values()], [True, False, True])
+        self.assertEqual([message.to for message in mail.outbox], [['a@example.com'], ['b@example.com']])
+        # One connection for the batch, and a new one after the failure
+        self.assertEqual(FlakyEmailBackend.opened, 2)
+
+        bounced = OutboundEmail.objects.get(recipient='bounce@example.com')
+        self.assertEqual((bounced.status, bounced.attempts, bounced.last_error),
+                         (OutboundEmail.STATUS_PENDING, 1, 'Mailbox unavailable'))
+        self.assertGreater(bounced.next_attempt_at, timezone.now() + RETRY_DELAY - timedelta(seconds=5))
+        self.assertEqual(send_pending(), {})  # Not due yet
+
+        OutboundEmail.objects.filter(id=bounced.id).update(next_attempt_at=timezone.now(), attempts=MAX_ATTEMPTS - 1)
+        send_pending()
+        self.assertEqual(OutboundEmail.objects.get(id=bounced.id).status, OutboundEmail.STATUS_FAILED)
+
+    def test_claims_of_a_stopped_worker_run_out(self):
+        email = queue_email('a@example.com', 'Hello', 'Hi')
+        OutboundEmail.objects.filter(id=email.id).update(status=OutboundEmail.STATUS_SENDING, attempts=1)
+        send_pending()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(OutboundEmail.objects.get(id=email.id).attempts, 2)
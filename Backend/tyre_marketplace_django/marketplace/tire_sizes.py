@@ -0,0 +1,136 @@
+"""
+Parse tire sizes out of free-text search queries.
+
+Recognised notations (case-insensitive, optional load index/speed rating
+suffix such as "94V" or "(94 V)"):
+
+- Metric/P-metric/LT: 225/45R17, P225/45ZR17, LT265/75R16, 225/45-17,
+  225 45 17, 225/45 R 17
+- Flotation: 31x10.50R15, 31X10.50-15. These are converted to the nearest
+  metric equivalent (265/75R15) since listings store metric sizes.
+- Width and aspect only: 225/45
+- Rim diameter only: R17, 17", 17in
+"""
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from django.db.models import Q
+
+SPEED_RATINGS = 'LMNPQRSTUHVWYZ'
+
+LOAD_SPEED = rf'(?:\s*\(?\s*(?P<load>\d{{2,3}})\s*(?P<speed>[{SPEED_RATINGS}])\s*\)?)?'
+
+METRIC_RE = re.compile(
+    r'\b(?:P|LT|ST|T)?(?P<width>\d{3})\s*[/\s-]\s*(?P<aspect>\d{2})'
+    r'(?:\s*(?:Z?R|D|B|-|\s)\s*(?P<diameter>\d{2}(?:\.\d)?))?'
+    + LOAD_SPEED + r'(?![\w.])',
+    re.IGNORECASE,
+)
+FLOTATION_RE = re.compile(
+    r'\b(?P<overall>\d{2}(?:\.\d{1,2})?)\s*[xX]\s*(?P<section>\d{1,2}(?:\.\d{1,2})?)'
+    r'\s*(?:Z?R|D|B|-|\s)\s*(?P<diameter>\d{2}(?:\.\d)?)(?:\s*LT)?'
+    + LOAD_SPEED + r'(?![\w.])',
+    re.IGNORECASE,
+)
+DIAMETER_RE = re.compile(
+    r'(?:\bZ?R\s*(?P<r_diameter>\d{2})\b|\b(?P<in_diameter>\d{2})\s*(?:"|in\b|inch(?:es)?\b))',
+    re.IGNORECASE,
+)
+
+WIDTH_RANGE = range(100, 400)
+ASPECT_RANGE = range(20, 100)
+DIAMETER_RANGE = range(8, 31)
+LOAD_INDEX_RANGE = range(50, 171)
+
+
+@dataclass(frozen=True)
+class TireSize:
+    width: Optional[int] = None
+    aspect_ratio: Optional[int] = None
+    diameter: Optional[int] = None
+    load_index: Optional[int] = None
+    speed_rating: Optional[str] = None
+
+    def as_q(self):
+        """Exact-match predicates, served by the (width, aspect_ratio, diameter) index"""
+        filters = {
+            field: value
+            for field, value in (
+                ('width', self.width),
+                ('aspect_ratio', self.aspect_ratio),
+                ('diameter', self.diameter),
+                ('load_index', self.load_index),
+                ('speed_rating', self.speed_rating),
+            )
+            if value is not None
+        }
+        return Q(**filters)
+
+
+def _load_speed(match):
+    load, speed = match.group('load'), match.group('speed')
+    if load and int(load) in LOAD_INDEX_RANGE:
+        return int(load), speed.upper()
+    return None, None
+
+
+def _metric_size(match):
+    width, aspect = int(match.group('width')), int(match.group('aspect'))
+    diameter = match.group('diameter')
+    diameter = int(float(diameter)) if diameter else None
+    if width not in WIDTH_RANGE or aspect not in ASPECT_RANGE:
+        return None
+    if diameter is not None and diameter not in DIAMETER_RANGE:
+        return None
+    return TireSize(width, aspect, diameter, *_load_speed(match))
+
+
+def _flotation_size(match):
+    overall, section = float(match.group('overall')), float(match.group('section'))
+    diameter = int(float(match.group('diameter')))
+    if diameter not in DIAMETER_RANGE or not section or overall <= diameter:
+        return None
+    # Snap to the metric grid: widths end in 5 and step by 10mm, aspect
+    # ratios step by 5, e.g. 31x10.50R15 -> 265/75R15
+    width = int(round((section * 25.4 - 5) / 10)) * 10 + 5
+    aspect = int(round((overall - diameter) / 2 / section * 100 / 5)) * 5
+    if width not in WIDTH_RANGE or aspect not in ASPECT_RANGE:
+        return None
+    return TireSize(width, aspect, diameter, *_load_speed(match))
+
+
+def extract_tire_sizes(query):
+    """Split a search query into the tire sizes it mentions and the remaining text.
+
+    Returns ``(sizes, remaining_text)``. Text that looks like a size but is
+    out of range is left in ``remaining_text`` for the full-text search.
+    """
+    sizes = []
+    text = query or ''
+    for pattern, build in ((FLOTATION_RE, _flotation_size), (METRIC_RE, _metric_size)):
+        def replace(match):
+            size = build(match)
+            if size is None:
+                return match.group(0)
+            sizes.append(size)
+            return ' '
+        text = pattern.sub(replace, text)
+
+    def replace_diameter(match):
+        diameter = int(match.group('r_diameter') or match.group('in_diameter'))
+        if diameter not in DIAMETER_RANGE:
+            return match.group(0)
+        sizes.append(TireSize(diameter=diameter))
+        return ' '
+    text = DIAMETER_RE.sub(replace_diameter, text)
+
+    return sizes, ' '.join(text.split())
+
+
+def tire_sizes_q(sizes):
+    """OR together the predicates of several sizes"""
+    query = Q()
+    for size in sizes:
+        query |= size.as_q()
+    return query
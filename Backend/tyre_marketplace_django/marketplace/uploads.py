@@ -0,0 +1,153 @@
+"""
+Checking image uploads while they stream in.
+
+Django normally receives and buffers every file of a multipart request (in
+memory or a temporary file) before the view sees any of it, so an
+oversized or bogus upload holds a worker and temp disk for as long as the
+client takes to send it. ImageUploadHandler runs first in the upload
+handler chain and looks at each chunk as it arrives:
+
+- a request whose Content-Length is over the limit is not read at all;
+  one that goes over it while streaming (no or a false Content-Length) is
+  cut off there
+- a file goes no further than IMAGE_UPLOAD_MAX_FILE_SIZE bytes
+- the first bytes must be a JPEG or PNG signature, and the header must
+  give dimensions within IMAGE_UPLOAD_MAX_PIXELS. Only the header is
+  parsed, nothing is decoded.
+
+Rejected files are skipped and never reach request.FILES; the reasons are
+collected on the handler for the view to report. The handler only checks:
+accepted files are still received by Django's own handlers.
+"""
+import io
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+from PIL import Image
+
+# File signatures of the formats we accept, as named by Pillow
+MAGIC_BYTES = {
+    b'\xff\xd8\xff': 'JPEG',
+    b'\x89PNG\r\n\x1a\n': 'PNG',
+}
+# Give up on finding the dimensions after this much of a file; JPEG EXIF
+# segments come first and are at most 64 KiB each
+MAX_HEADER_SIZE = 256 * 1024
+# Room for the multipart boundaries and form fields around the files
+REQUEST_OVERHEAD = 1024 * 1024
+
+
+def megabytes(size):
+    return f'{size / (1024 * 1024):.3g}MB'
+
+
+def sniff_image(header):
+    """Return (format, (width, height)) from the start of an image file.
+
+    Returns None if more bytes are needed, and raises ValueError for
+    anything that is not a readable JPEG or PNG.
+    """
+    formats = [name for magic, name in MAGIC_BYTES.items() if header.startswith(magic[:len(header)])]
+    if not formats:
+        raise ValueError('is not a JPEG or PNG image')
+    if len(header) < max(map(len, MAGIC_BYTES)):
+        return None
+    try:
+        # Image.open only parses the header; pixels are decoded on load()
+        with Image.open(io.BytesIO(header), formats=formats) as img:
+            return img.format, img.size
+    except Image.DecompressionBombError:
+        raise ValueError('has too many pixels')
+    except (OSError, SyntaxError, ValueError):
+        if len(header) >= MAX_HEADER_SIZE:
+            raise ValueError('is not a valid image')
+        return None
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """Reject oversized and invalid image uploads before they are buffered"""
+
+    def __init__(self, request=None, max_files=1):
+        super().__init__(request)
+        self.max_file_size = getattr(settings, 'IMAGE_UPLOAD_MAX_FILE_SIZE', 5 * 1024 * 1024)
+        self.max_pixels = getattr(settings, 'IMAGE_UPLOAD_MAX_PIXELS', 40_000_000)
+        self.max_request_size = max_files * self.max_file_size + REQUEST_OVERHEAD
+        self.received = 0
+        self.errors = []
+        # Whether the whole request was refused for its size
+        self.aborted = False
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > self.max_request_size:
+            self.abort()
+            # Parsed as empty, without reading the body
+            return QueryDict(encoding=encoding), MultiValueDict()
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file_size = 0
+        self.header = b''
+        self.sniffed = False
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_request_size:
+            self.abort()
+            raise StopUpload(connection_reset=True)
+
+        self.file_size += len(raw_data)
+        if self.file_size > self.max_file_size:
+            self.reject(f'exceeds {megabytes(self.max_file_size)} size limit')
+
+        if not self.sniffed:
+            self.header += raw_data
+            try:
+                sniffed = sniff_image(self.header)
+            except ValueError as e:
+                self.reject(str(e))
+            if sniffed is not None:
+                self.sniffed = True
+                self.header = b''
+                width, height = sniffed[1]
+                if width * height > self.max_pixels:
+                    self.reject(f'is too large ({width}x{height} pixels)')
+        return raw_data
+
+    def file_complete(self, file_size):
+        # A file that ended before its header did is passed on; it is tiny,
+        # and fails validation in the view like any other broken image
+        return None
+
+    def reject(self, reason):
+        self.errors.append(f'Image {self.file_name} {reason}')
+        raise SkipFile()
+
+    def abort(self):
+        if not self.aborted:
+            self.aborted = True
+            self.errors.append(f'Upload exceeds {megabytes(self.max_request_size)} request size limit')
+
+
+def sniff_upload(upload):
+    """sniff_image() for a received file; None unless it is a readable JPEG or PNG"""
+    header = upload.read(MAX_HEADER_SIZE)
+    upload.seek(0)
+    try:
+        return sniff_image(header)
+    except ValueError:
+        return None
+
+
+def check_image_uploads(request, max_files=1):
+    """Check the request's file uploads as they stream in.
+
+    Must be called before request.data or request.FILES is used. Returns the
+    handler, whose ``errors`` describe the rejected files and ``aborted`` is
+    set if the request was refused as too large.
+    """
+    handler = ImageUploadHandler(request, max_files=max_files)
+    request.upload_handlers.insert(0, handler)
+    return handler
@@ -36,9 +36,12 @@ urlpatterns = [
     path('shops/services/', views.get_services_list, name='get-services-list'),
     
     path('messages/send/', views.send_message, name='send_message'),
+    path('messages/send/batch/', views.send_message_batch, name='send_message_batch'),
     path('messages/conversations/', views.get_conversations, name='get_conversations'),
     path('messages/history/<uuid:user_id>/', views.get_chat_history, name='chat_history'),
     path('messages/read/<uuid:user_id>/', views.mark_messages_read, name='mark_messages_read'),
+    path('messages/read/', views.mark_messages_read_bulk, name='mark_messages_read_bulk'),
+    path('messages/unread/wait/', views.wait_for_unread_count, name='wait_unread_count'),
     
     # User reviews
     path('users/<uuid:user_id>/reviews/', views.create_user_review, name='create-user-review'),
@@ -53,6 +56,7 @@ urlpatterns = [
     path('admin/users/<uuid:user_id>/status/', views.admin_update_user_status, name='admin-update-user-status'),
     path('admin/listings/', views.admin_listing_list, name='admin-listing-list'),
     path('admin/listings/<uuid:listing_id>/update/', views.admin_update_listing, name='admin-update-listing'),
+    path('tire-sizes/', views.get_tire_size_tree, name='tire-size-tree'),
     path('tire-sizes/widths/', views.get_tire_widths, name='tire-widths'),
     path('tire-sizes/aspect-ratios/', views.get_tire_aspect_ratios, name='tire-aspect-ratios'),
     path('tire-sizes/diameters/', views.get_tire_diameters, name='tire-diameters'),
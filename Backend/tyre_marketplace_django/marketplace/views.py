@@ -6,44 +6,52 @@ from rest_framework.response import Response
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django.contrib.auth import get_user_model
 from .serializers import UserSerializer, BusinessProfileSerializer, TireListingSerializer, ListingImageSerializer, ReviewSerializer, MessageSerializer
-from .models import BusinessProfile, TireListing, ListingImage, Review, Message, OTPVerification, PasswordReset
-from django.db import models
+from .models import BusinessProfile, TireListing, ListingImage, Review, Message, OTPVerification, PasswordReset, avatar_url
+from django.db import models, transaction
 from .services import generate_otp, send_otp_email, send_password_reset_email
+from .images import profile_image_files, store_profile_image, store_upload
+from .media import delete_on_commit
+from .uploads import check_image_uploads, sniff_upload
+from .pagination import InvalidCursor, InvalidPage, ordering_expressions, page_params, page_size_param, paginate_by_cursor
+from .search import get_search_backend
+from .tire_sizes import extract_tire_sizes, tire_sizes_q
+from . import facets, realtime
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from datetime import timedelta
 from rest_framework.parsers import MultiPartParser, FormParser
-from django.core.files.storage import default_storage
-from django.conf import settings
 import uuid
-from django.db.models import Q, Count, Avg
+import logging
+from django.db.models import Q, Count, Avg, Case, When, F, Max, OuterRef, Subquery, Window
+from django.db.models.functions import RowNumber
 from rest_framework.authtoken.models import Token
 from django.core.cache import cache
+from django.views.decorators.http import condition
+from django.http import JsonResponse
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
 import json
 from django.core.mail import send_mail
 import random
 import string
-from itertools import chain
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
+
 class RegisterView(generics.CreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
 
     def perform_create(self, serializer):
-        # Log the data before saving
-        print("Registration data:", serializer.validated_data)
-        print("is_business value:", serializer.validated_data.get('is_business', False))
-        
-        user = serializer.save()
-        
-        # Log the saved user data
-        print("Created user:", user.username)
-        print("User is_business:", user.is_business)
-        
-        otp = generate_otp()
-        OTPVerification.objects.create(user=user, otp=otp)
-        send_otp_email(user.email, otp)
+        # The verification email is queued, and only sent if the user commits
+        with transaction.atomic():
+            user = serializer.save()
+            logger.info("Registered user %s (is_business=%s)", user.username, user.is_business)
+
+            otp = generate_otp()
+            OTPVerification.objects.create(user=user, otp=otp)
+            send_otp_email(user.email, otp)
         return user
 
 class LoginView(TokenObtainPairView):
@@ -176,7 +184,7 @@ def verify_otp(request):
         
         # Also update the user's verified status
         user.is_verified = True
-        user.save()
+        user.save(update_fields=['is_verified'])
         
         return Response({'message': 'Email verified successfully'})
     except User.DoesNotExist:
@@ -201,8 +209,9 @@ def resend_otp(request):
     try:
         user = User.objects.get(email=email)
         otp = generate_otp()
-        OTPVerification.objects.create(user=user, otp=otp)
-        send_otp_email(user.email, otp)
+        with transaction.atomic():
+            OTPVerification.objects.create(user=user, otp=otp)
+            send_otp_email(user.email, otp)
         return Response({'message': 'OTP resent successfully'})
     except User.DoesNotExist:
         return Response(
@@ -215,8 +224,9 @@ def request_password_reset(request):
     email = request.data.get('email')
     try:
         user = User.objects.get(email=email)
-        reset = PasswordReset.objects.create(user=user)
-        send_password_reset_email(user.email, reset.token)
+        with transaction.atomic():
+            reset = PasswordReset.objects.create(user=user)
+            send_password_reset_email(user.email, reset.token)
         return Response({'message': 'Password reset email sent'})
     except User.DoesNotExist:
         return Response(
@@ -244,7 +254,7 @@ def reset_password(request):
         )
         user = reset.user
         user.set_password(new_password)
-        user.save()
+        user.save(update_fields=['password'])
         
         reset.is_used = True
         reset.save()
@@ -260,37 +270,85 @@ def reset_password(request):
 @permission_classes([IsAuthenticated])
 @parser_classes([MultiPartParser, FormParser])
 def upload_profile_image(request):
-    if 'image' not in request.FILES:
+    # Reject oversized and non-image files while the request streams in
+    uploads = check_image_uploads(request)
+    image = request.FILES.get('image')
+    if uploads.aborted:
         return Response(
-            {'error': 'No image file provided'}, 
+            {'error': uploads.errors[-1]},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        )
+    if image is None:
+        return Response(
+            {'error': uploads.errors[0] if uploads.errors else 'No image file provided'}, 
             status=status.HTTP_400_BAD_REQUEST
         )
 
-    image = request.FILES['image']
-    
-    # Generate unique filename
-    ext = image.name.split('.')[-1]
-    filename = f'profile_images/{request.user.id}/{uuid.uuid4()}.{ext}'
-    
-    # Save file to media directory
-    default_storage.save(filename, image)
+    ext = image.name.split('.')[-1].lower()
+    if ext not in ['jpg', 'jpeg', 'png'] or not sniff_upload(image):
+        return Response(
+            {'error': 'Only JPEG and PNG images are allowed'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
     
-    # Update user's profile_image_url
-    request.user.profile_image_url = settings.MEDIA_URL + filename
-    request.user.save()
+    # Resize, save with avatar crops and drop the image it replaces
+    replaced = profile_image_files(request.user)
+    try:
+        store_profile_image(request.user, image)
+    except (OSError, SyntaxError, ValueError):
+        logger.warning("Could not decode profile image %s", image.name, exc_info=True)
+        return Response(
+            {'error': 'The image could not be read'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    request.user.save(update_fields=['profile_image_url', 'profile_image_variants'])
+    delete_on_commit(replaced)
     
     return Response({
         'message': 'Profile image uploaded successfully',
-        'image_url': request.user.profile_image_url
+        'image_url': request.user.profile_image_url,
+        'avatar_urls': request.user.profile_image_variants
     })
 
+LISTING_SORT_FIELDS = {
+    'price_low': 'price',
+    'price_high': '-price',
+    'rating': '-seller__rating',
+    'newest': '-created_at',
+}
+# Columns sort_by may also name directly, with a leading "-" for descending
+LISTING_SORT_COLUMNS = {
+    'price', 'created_at', 'updated_at', 'title', 'brand', 'width', 'aspect_ratio', 'diameter',
+    'load_index', 'tread_depth', 'quantity', 'mileage', 'seller__rating',
+}
+
+def listing_ordering(sort_by=None):
+    """Return the ORDER BY columns for the listings feed.
+
+    Promoted listings always come first. ``created_at`` and ``id`` are
+    appended as tie-breakers so that the ordering is total and pages never
+    overlap or skip rows, which also makes it usable as a keyset. Raises
+    ValueError for a ``sort_by`` that is not a known sort or column.
+    """
+    sort_field = LISTING_SORT_FIELDS.get(sort_by, sort_by or '-created_at')
+    if sort_field.lstrip('-') not in LISTING_SORT_COLUMNS:
+        raise ValueError(f'Cannot sort by {sort_by!r}')
+    ordering = ['-is_promoted', sort_field]
+    for tie_breaker in ('-created_at', '-id'):
+        if tie_breaker.lstrip('-') != sort_field.lstrip('-'):
+            ordering.append(tie_breaker)
+    return ordering
+
 @api_view(['GET'])
 def get_listings(request):
     try:
         # Get filter and pagination parameters
-        page = int(request.GET.get('page', 1))
-        page_size = int(request.GET.get('page_size', 12))
-        sort_by = request.GET.get('sort_by', '-created_at')  # Default sort by newest
+        try:
+            page, page_size = page_params(request.GET, 12)
+            # Default sort by newest
+            ordering = listing_ordering(request.GET.get('sort_by', '-created_at'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         conditions = request.GET.getlist('condition')  # Get all condition values
         quantities = request.GET.getlist('quantity')  # Get all quantity values
         brands = request.GET.getlist('brand')  # Get all brand values
@@ -311,93 +369,35 @@ def get_listings(request):
         load_indices = request.GET.getlist('load_index')  # Get all load index values
         
         # Base queryset
-        listings = TireListing.objects.all().select_related('seller').prefetch_related('images')
+        listings = TireListingSerializer.setup_eager_loading(TireListing.objects.all())
 
-        # Debug logging
-        print("Initial queryset count:", listings.count())
-        
         # Filter to only show active listings by default
         listings = listings.filter(is_active=True)
-        print("After active filter count:", listings.count())
 
         # Filter by seller ID if provided
         if seller_id:
-            print(f"Filtering by seller ID: {seller_id}")
+            logger.debug("Filtering listings by seller %s", seller_id)
             listings = listings.filter(seller__id=seller_id)
-            print("After seller filter count:", listings.count())
 
         # Apply search filter first - this should find all matching listings regardless of seller type
+        search_text = ''
         if search and search.strip():  # Only apply search if there's a non-empty search term
-            search_terms = search.strip().split()
-            if search_terms:  # Extra check to ensure we have actual terms to search for
-                search_query = Q()
-                for term in search_terms:
-                    # Make search more flexible by looking for partial matches
-                    text_query = (
-                        Q(title__icontains=term) |
-                        Q(description__icontains=term) |
-                        Q(brand__icontains=term) |
-                        Q(model__icontains=term) |
-                        Q(tire_type__icontains=term) |
-                        Q(seller__username__icontains=term)  # Also search in seller usernames
-                    )
-                    search_query |= text_query
-                    
-                    # Try to match tire size specifications
-                    # Check if the term is a number that could be a tire dimension
-                    try:
-                        # Strip any non-numeric characters to handle cases like "16in" or "225mm"
-                        numeric_term = ''.join(filter(str.isdigit, term))
-                        if numeric_term:
-                            num_value = int(numeric_term)
-                            # Add matches for common tire dimensions with exact match
-                            size_query = (
-                                Q(width=num_value) |
-                                Q(aspect_ratio=num_value) |
-                                Q(diameter=num_value)
-                            )
-                            search_query |= size_query
-                            print(f"Added numeric search for: {num_value}")
-                            
-                            # Also add a query to check if the value is in the title
-                            # This helps catch patterns like "225/45R17" 
-                            num_in_title_query = Q(title__icontains=str(num_value))
-                            search_query |= num_in_title_query
-                    except (ValueError, TypeError) as e:
-                        print(f"Error parsing numeric value from '{term}': {str(e)}")
-                        # Not a number, so skip tire size matching for this term
-                        pass
-                
-                print(f"Applying search filter with terms: {search_terms}")
-                
-                # First check how many results we would get with this search query
-                result_count = listings.filter(search_query).count()
-                print(f"Search would return {result_count} results")
-                
-                # Apply the search if we have results
-                if result_count > 0:
-                    listings = listings.filter(search_query)
-                    print("After search filter count:", listings.count())
-                else:
-                    # If no results found, try a more relaxed search - just look for the term in the title
-                    relaxed_query = Q()
-                    for term in search_terms:
-                        relaxed_query |= Q(title__icontains=term)
-                    
-                    relaxed_count = listings.filter(relaxed_query).count()
-                    print(f"Relaxed search would return {relaxed_count} results")
-                    
-                    if relaxed_count > 0:
-                        # If relaxed search has results, use that instead
-                        listings = listings.filter(relaxed_query)
-                        print("Using relaxed search with count:", listings.count())
-                    else:
-                        # No results even with relaxed search, keep original query
-                        listings = listings.filter(search_query)
+            # Tire sizes such as "225/45R17" become exact size predicates and
+            # the rest of the query goes to the full-text index
+            sizes, search_text = extract_tire_sizes(search)
+            if sizes:
+                logger.debug("Applying tire size filter: %s", sizes)
+                listings = listings.filter(tire_sizes_q(sizes))
+            if search_text:
+                logger.debug("Applying search filter: %r", search_text)
+                listings = get_search_backend().search(listings, search_text)
 
         # Apply other filters
+        # Filters on facet fields are collected and applied together below,
+        # so facet counts can leave out each facet's own selection
+        facet_filters = {}
         if conditions:
-            listings = listings.filter(condition__in=conditions)
+            facet_filters['condition'] = conditions
         if quantities:
             quantity_map = {
                 'single': 1,
@@ -408,18 +408,18 @@ def get_listings(request):
             if quantity_numbers:
                 listings = listings.filter(quantity__in=quantity_numbers)
         if brands:
-            listings = listings.filter(brand__in=brands)
+            facet_filters['brand'] = brands
         if vehicle_types:
-            listings = listings.filter(vehicle_type__in=vehicle_types)
+            facet_filters['vehicle_type'] = vehicle_types
         if tire_types:
-            listings = listings.filter(tire_type__in=tire_types)
+            facet_filters['tire_type'] = tire_types
         if speed_ratings:
-            listings = listings.filter(speed_rating__in=speed_ratings)
+            facet_filters['speed_rating'] = speed_ratings
         if load_indices:
             # Convert string load indices to integers for filtering
             load_index_numbers = [int(li) for li in load_indices if li.isdigit()]
             if load_index_numbers:
-                listings = listings.filter(load_index__in=load_index_numbers)
+                facet_filters['load_index'] = load_index_numbers
             
         # Apply price filters
         if price_min:
@@ -430,9 +430,8 @@ def get_listings(request):
         # Only apply seller type filter if explicitly searching for a seller type
         if seller_type and not search:  # Don't apply seller type filter during search
             is_business = seller_type.lower() == 'business'
-            print(f"Applying seller_type filter: is_business={is_business}")
+            logger.debug("Applying seller_type filter: is_business=%s", is_business)
             listings = listings.filter(seller__is_business=is_business)
-            print("After seller_type filter count:", listings.count())
         
         # Apply tire size filters
         if width:
@@ -452,74 +451,36 @@ def get_listings(request):
         if rating_min:
             listings = listings.filter(seller__rating__gte=float(rating_min))
 
-        # Apply sorting
-        if sort_by:
-            # First separate promoted and non-promoted listings
-            promoted_listings = listings.filter(is_promoted=True)
-            regular_listings = listings.filter(is_promoted=False)
-            
-            # Add debugging information
-            promoted_count = promoted_listings.count()
-            regular_count = regular_listings.count()
-            print(f"Before sorting - Promoted listings: {promoted_count}, Regular listings: {regular_count}, Total: {promoted_count + regular_count}")
-            
-            # Apply the same sorting to both groups
-            if sort_by == 'price_low':
-                promoted_listings = promoted_listings.order_by('price')
-                regular_listings = regular_listings.order_by('price')
-            elif sort_by == 'price_high':
-                promoted_listings = promoted_listings.order_by('-price')
-                regular_listings = regular_listings.order_by('-price')
-            elif sort_by == 'rating':
-                promoted_listings = promoted_listings.order_by('-seller__rating')
-                regular_listings = regular_listings.order_by('-seller__rating')
-            elif sort_by == 'newest':
-                promoted_listings = promoted_listings.order_by('-created_at')
-                regular_listings = regular_listings.order_by('-created_at')
-            else:
-                promoted_listings = promoted_listings.order_by(sort_by)
-                regular_listings = regular_listings.order_by(sort_by)
-            
-            # Combine the two querysets while maintaining order
-            listings_list = list(chain(promoted_listings, regular_listings))
-            
-            # Get the total count before pagination
-            total_count = len(listings_list)
-            print(f"After combining - Total listings: {total_count}")
-            
-            # Apply pagination manually
-            start_idx = (page - 1) * page_size
-            end_idx = start_idx + page_size
-            paginated_listings = listings_list[start_idx:end_idx]
-            print(f"After pagination - Showing listings {start_idx+1} to {min(end_idx, total_count)} of {total_count}")
+        facet_base = listings
+        for field, values in facet_filters.items():
+            listings = listings.filter(**{f'{field}__in': values})
+
+        # Apply sorting - promoted listings always come first, and the whole
+        # ordering is done by the database so only one page is ever loaded
+        listings = listings.order_by(*ordering_expressions(TireListing, ordering))
+        if search_text and ordering == listing_ordering() and 'cursor' not in request.GET:
+            # Search results in the default newest-first sort (which the app
+            # always asks for) are ranked by relevance instead
+            listings = listings.order_by('-is_promoted', 'search_rank', '-created_at', '-id')
+
+        # Keyset pagination: each page is a range scan after the cursor row
+        if 'cursor' in request.GET:
+            try:
+                paginated_listings, next_cursor = paginate_by_cursor(
+                    listings, ordering, request.GET.get('cursor'), page_size
+                )
+            except InvalidCursor as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         else:
-            # If no sorting is applied, still prioritize promoted listings
-            # but use the default database ordering
-            promoted_listings = listings.filter(is_promoted=True)
-            regular_listings = listings.filter(is_promoted=False).order_by('-created_at')
-            
-            # Add debugging information
-            promoted_count = promoted_listings.count()
-            regular_count = regular_listings.count()
-            print(f"No explicit sort - Promoted listings: {promoted_count}, Regular listings: {regular_count}, Total: {promoted_count + regular_count}")
-            
-            # Combine the two querysets
-            listings_list = list(chain(promoted_listings, regular_listings))
-            
-            # Get the total count
-            total_count = len(listings_list)
-            
-            # Apply pagination manually
+            # Get the total count with a single COUNT query
+            total_count = listings.count()
+
+            # Apply pagination with LIMIT/OFFSET
             start_idx = (page - 1) * page_size
             end_idx = start_idx + page_size
-            paginated_listings = listings_list[start_idx:end_idx]
-            print(f"After pagination - Showing listings {start_idx+1} to {min(end_idx, total_count)} of {total_count}")
-        
-        # Make sure all listings have their related data preloaded
-        # for serialization efficiency
-        # Note: since we're working with a list of model instances now,
-        # we can't use select_related/prefetch_related at this point
-        
+            paginated_listings = listings[start_idx:end_idx]
+            logger.debug("Showing listings %d to %d of %d", start_idx + 1, min(end_idx, total_count), total_count)
+
         # Use serializer with proper context to handle URLs
         serializer = TireListingSerializer(paginated_listings, many=True, context={'request': request})
         serialized_data = serializer.data
@@ -543,6 +504,27 @@ def get_listings(request):
         # Construct next and previous page URLs
         base_url = request.build_absolute_uri().split('?')[0]
         query_params = request.GET.copy()
+
+        # Optional per-value counts, e.g. ?facets=brand,condition
+        facet_counts = None
+        requested_facets = facets.requested_facets(request.GET.getlist('facets'))
+        if requested_facets:
+            facet_counts = facets.facet_counts(facet_base, facet_filters, requested_facets, request.GET)
+
+        if 'cursor' in request.GET:
+            next_url = None
+            if next_cursor:
+                query_params['cursor'] = next_cursor
+                next_url = f"{base_url}?{query_params.urlencode()}"
+
+            response_data = {
+                'next': next_url,
+                'next_cursor': next_cursor,
+                'results': serialized_data
+            }
+            if facet_counts is not None:
+                response_data['facets'] = facet_counts
+            return Response(response_data)
         
         # Next page URL
         next_url = None
@@ -556,14 +538,17 @@ def get_listings(request):
             query_params['page'] = page - 1
             previous_url = f"{base_url}?{query_params.urlencode()}"
 
-        return Response({
+        response_data = {
             'count': total_count,
             'next': next_url,
             'previous': previous_url,
             'results': serialized_data
-        })
+        }
+        if facet_counts is not None:
+            response_data['facets'] = facet_counts
+        return Response(response_data)
     except Exception as e:
-        print(f"Error in get_listings: {str(e)}")  # Add error logging
+        logger.exception("Error in get_listings")
         return Response(
             {'error': str(e)},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -587,11 +572,20 @@ def create_listing(request):
                     status=status.HTTP_403_FORBIDDEN
                 )
         
+        # Reject oversized and non-image files while the request streams in
+        uploads = check_image_uploads(request, max_files=10)
+
         # Get listing data from the 'data' field
         listing_data = json.loads(request.data.get('data', '{}'))
+        if uploads.aborted:
+            return Response(
+                {'error': uploads.errors[-1]},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        for error in uploads.errors:
+            logger.info("Skipped listing image upload: %s", error)
         
-        # Log the received data for debugging
-        print('Received listing data:', listing_data)
+        logger.debug("Received listing data: %s", listing_data)
         
         serializer = TireListingSerializer(data=listing_data, context={'request': request})
         if serializer.is_valid():
@@ -600,41 +594,31 @@ def create_listing(request):
             
             # Handle image uploads
             images = request.FILES.getlist('images')
-            print(f'Received {len(images)} images')
-            
-            # Print information about all form data for debugging
-            for key in request.data.keys():
-                print(f'Form data key: {key}, Type: {type(request.data[key])}')
-            
-            for key in request.FILES.keys():
-                print(f'Files key: {key}, Count: {len(request.FILES.getlist(key))}')
+            logger.debug("Received %d images for listing %s", len(images), listing.id)
             
             # Process each image
             for i, image in enumerate(images):
-                print(f'Processing image {i+1}: {image.name}, Size: {image.size} bytes, Content type: {image.content_type}')
+                logger.debug("Processing image %d: %s, %d bytes, %s", i + 1, image.name, image.size, image.content_type)
                 
                 try:
-                    # Create a new ListingImage instance for each uploaded image
-                    list_image = ListingImage.objects.create(
-                        listing=listing,
-                        image=image
-                    )
-                    print(f'Created ListingImage with ID: {list_image.id}')
-                except Exception as e:
-                    print(f'Error creating image {i+1}: {str(e)}')
+                    # Store the upload; resizing happens in the background
+                    list_image = store_upload(listing, image)
+                    logger.debug("Created ListingImage %s", list_image.id)
+                except Exception:
+                    logger.exception("Error creating image %d for listing %s", i + 1, listing.id)
             
             # Retrieve the listing with images to return in response
-            updated_listing = TireListing.objects.get(id=listing.id)
+            updated_listing = TireListingSerializer.setup_eager_loading(TireListing.objects.all()).get(id=listing.id)
             response_serializer = TireListingSerializer(updated_listing, context={'request': request})
             return Response(response_serializer.data, status=status.HTTP_201_CREATED)
         else:
-            print('Serializer errors:', serializer.errors)
+            logger.debug("Listing serializer errors: %s", serializer.errors)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             
     except json.JSONDecodeError:
         return Response({'error': 'Invalid JSON data'}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
-        print('Error creating listing:', str(e))
+        logger.exception("Error creating listing")
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['GET', 'PUT'])
@@ -642,7 +626,7 @@ def update_listing(request, listing_id):
     try:
         # For GET requests, we don't need to check if the user is the seller
         if request.method == 'GET':
-            listing = TireListing.objects.select_related('seller').prefetch_related('images').get(id=listing_id)
+            listing = TireListingSerializer.setup_eager_loading(TireListing.objects.all()).get(id=listing_id)
             serializer = TireListingSerializer(listing, context={'request': request})
             return Response(serializer.data)
             
@@ -682,20 +666,16 @@ def delete_listing(request, listing_id):
 def search_listings(request):
     try:
         query = request.GET.get('q', '')
+        listings = TireListingSerializer.setup_eager_loading(TireListing.objects.all())
+        sizes, query = extract_tire_sizes(query)
+        if sizes:
+            listings = listings.filter(tire_sizes_q(sizes))
         if not query:
-            # Return all listings if no query provided
-            listings = TireListing.objects.all()
+            # Return all listings if no text query provided, newest first
+            listings = listings.order_by('-created_at')
         else:
-            listings = TireListing.objects.filter(
-                Q(title__icontains=query) |
-                Q(description__icontains=query) |
-                Q(brand__icontains=query) |
-                Q(model__icontains=query) |
-                Q(tire_type__icontains=query)
-            ).distinct()
-
-        # Add order by to show newest first
-        listings = listings.order_by('-created_at')
+            # Most relevant first, then newest
+            listings = get_search_backend().search(listings, query).order_by('search_rank', '-created_at')
 
         serializer = TireListingSerializer(listings, many=True)
         return Response({
@@ -716,17 +696,25 @@ def upload_listing_images(request, listing_id):
     try:
         # Get the listing and verify ownership
         listing = get_object_or_404(TireListing, id=listing_id, seller=request.user)
+        max_allowed = 10
+
+        # Reject oversized and non-image files while the request streams in
+        uploads = check_image_uploads(request, max_files=max_allowed)
         images = request.FILES.getlist('images')
-        
-        if not images:
+        if uploads.aborted:
             return Response(
-                {'error': 'No images provided'},
-                status=status.HTTP_400_BAD_REQUEST
+                {'error': uploads.errors[-1]},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
             )
 
+        if not images:
+            response_data = {'error': 'No images provided'}
+            if uploads.errors:
+                response_data['errors'] = uploads.errors
+            return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
+
         # Check max images per listing (limit to 10)
         current_image_count = listing.images.count()
-        max_allowed = 10
         if current_image_count + len(images) > max_allowed:
             return Response(
                 {'error': f'Maximum {max_allowed} images allowed per listing. You already have {current_image_count} images.'},
@@ -735,7 +723,7 @@ def upload_listing_images(request, listing_id):
 
         # Process each image
         uploaded_images = []
-        errors = []
+        errors = list(uploads.errors)
         
         for image in images:
             # Validate file size (5MB limit)
@@ -785,10 +773,7 @@ def manage_listing_image(request, listing_id, image_id):
         image = ListingImage.objects.get(id=image_id, listing=listing)
 
         if request.method == 'DELETE':
-            # Delete image files
-            default_storage.delete(image.image_url.split('/')[-1])
-            if image.thumbnail_url:
-                default_storage.delete(image.thumbnail_url.split('/')[-1])
+            # The files are deleted by the ListingImage post_delete signal
             image.delete()
             return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -860,14 +845,14 @@ def verify_token(request):
 def get_listing_details(request, listing_id):
     try:
         # Get the listing with related seller and images data for efficiency
-        listing = TireListing.objects.select_related('seller').prefetch_related('images').get(id=listing_id)
+        listing = TireListingSerializer.setup_eager_loading(TireListing.objects.all()).get(id=listing_id)
         
         # Serialize the listing data with images
         serializer = TireListingSerializer(listing)
         response_data = serializer.data
         
         # Add information about total image count
-        response_data['total_images'] = listing.images.count()
+        response_data['total_images'] = len(listing.images.all())
         
         # Ensure image URLs are properly formed
         if 'images' in response_data:
@@ -902,68 +887,182 @@ def get_listing_details(request, listing_id):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_conversations(request):
-    """Get list of users the current user has chatted with"""
+    """Get list of users the current user has chatted with, most recent first.
+
+    Runs a fixed number of queries however many partners there are: one
+    grouped query for the partners, their latest message time and unread
+    counts, and one window query for each partner's last message and user
+    fields. Pass page/page_size to get a paginated response.
+    """
     user = request.user
-    
-    # Get unique users from both sent and received messages
-    conversations = Message.objects.filter(
-        Q(sender=user) | Q(receiver=user)
-    ).values(
-        'sender', 'receiver'
-    ).distinct()
-    
-    # Get unique user IDs excluding the current user
-    user_ids = set()
-    for conv in conversations:
-        user_ids.add(conv['sender'] if conv['sender'] != user.id else conv['receiver'])
-    
-    # Get user details and last message for each conversation
+    paginate = 'page' in request.GET or 'page_size' in request.GET
+    try:
+        page, page_size = page_params(request.GET, 20)
+    except InvalidPage as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # The other participant of each message
+    partner = Case(
+        When(sender=user, then=F('receiver')),
+        default=F('sender'),
+    )
+    user_messages = Message.objects.filter(Q(sender=user) | Q(receiver=user)).annotate(partner=partner)
+
+    partners = user_messages.order_by().values('partner').annotate(
+        last_message_at=Max('created_at'),
+        unread_count=Count('id', filter=Q(receiver=user, is_read=False)),
+    ).order_by('-last_message_at', 'partner')
+
+    if paginate:
+        total_count = partners.count()
+        start_idx = (page - 1) * page_size
+        partners = list(partners[start_idx:start_idx + page_size])
+        partner_ids = [row['partner'] for row in partners]
+        user_messages = user_messages.filter(Q(sender__in=partner_ids) | Q(receiver__in=partner_ids))
+
+    # Latest message per partner, with the partner's user fields
+    partner_users = User.objects.filter(pk=OuterRef('partner'))
+    last_messages = {
+        message.partner: message
+        for message in user_messages.annotate(
+            row_number=Window(
+                RowNumber(),
+                partition_by=[F('partner')],
+                order_by=[F('created_at').desc(), F('id').desc()],
+            ),
+            partner_username=Subquery(partner_users.values('username')),
+            partner_profile_image_url=Subquery(partner_users.values('profile_image_url')),
+            partner_profile_image_variants=Subquery(partner_users.values('profile_image_variants')),
+        ).filter(row_number=1)
+    }
+
     conversation_data = []
-    for other_user_id in user_ids:
-        other_user = User.objects.get(id=other_user_id)
-        last_message = Message.objects.filter(
-            (Q(sender=user) & Q(receiver=other_user)) |
-            (Q(sender=other_user) & Q(receiver=user))
-        ).order_by('-created_at').first()
-        
-        unread_count = Message.objects.filter(
-            sender=other_user,
-            receiver=user,
-            is_read=False
-        ).count()
-        
+    for row in partners:
+        last_message = last_messages[row['partner']]
         conversation_data.append({
             'user': {
-                'id': str(other_user.id),
-                'username': other_user.username,
-                'profile_image_url': other_user.profile_image_url
+                'id': str(row['partner']),
+                'username': last_message.partner_username,
+                'profile_image_url': avatar_url(
+                    last_message.partner_profile_image_url, last_message.partner_profile_image_variants, 64
+                )
             },
             'last_message': {
                 'content': last_message.content,
                 'created_at': last_message.created_at,
                 'is_read': last_message.is_read
             },
-            'unread_count': unread_count
+            'unread_count': row['unread_count']
         })
-    
-    return Response(conversation_data)
+
+    if not paginate:
+        return Response(conversation_data)
+
+    base_url = request.build_absolute_uri().split('?')[0]
+    query_params = request.GET.copy()
+    next_url = None
+    if page * page_size < total_count:
+        query_params['page'] = page + 1
+        next_url = f"{base_url}?{query_params.urlencode()}"
+    previous_url = None
+    if page > 1:
+        query_params['page'] = page - 1
+        previous_url = f"{base_url}?{query_params.urlencode()}"
+
+    return Response({
+        'count': total_count,
+        'next': next_url,
+        'previous': previous_url,
+        'results': conversation_data
+    })
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_chat_history(request, user_id):
-    """Get chat history between current user and specified user"""
+    """Get chat history between current user and specified user.
+
+    Without parameters the whole thread is returned, oldest first. With
+    cursor/page_size it is paged backwards from the newest message: each page
+    is in chronological order and next_cursor points to older messages. With
+    since=<message id or ISO timestamp> only newer messages are returned, for
+    cheap polling. Only the unread messages in the response are marked read.
+    """
     try:
         other_user = User.objects.get(id=user_id)
         messages = Message.objects.filter(
             (Q(sender=request.user) & Q(receiver=other_user)) |
             (Q(sender=other_user) & Q(receiver=request.user))
-        ).order_by('created_at')
-        
-        # Mark messages as read
-        messages.filter(receiver=request.user, is_read=False).update(is_read=True)
-        
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        ).select_related('sender', 'receiver')
+        try:
+            page_size = page_size_param(request.GET, 50)
+        except InvalidPage as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        response_data = None
+        if 'since' in request.GET:
+            since = request.GET.get('since')
+            try:
+                since_message = messages.get(id=uuid.UUID(since))
+                messages = messages.filter(
+                    Q(created_at__gt=since_message.created_at) |
+                    Q(created_at=since_message.created_at, id__gt=since_message.id)
+                )
+            except ValueError:
+                try:
+                    since_time = parse_datetime(since)
+                except ValueError:
+                    # Well formed but out of range, e.g. month 13
+                    since_time = None
+                if since_time is None:
+                    return Response(
+                        {'error': 'since must be a message id or an ISO 8601 timestamp'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                if timezone.is_naive(since_time):
+                    since_time = timezone.make_aware(since_time)
+                messages = messages.filter(created_at__gt=since_time)
+            except Message.DoesNotExist:
+                return Response(
+                    {'error': 'Message not found'},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+
+            # Fetch one extra row to find out whether the client is caught up
+            rows = list(messages.order_by('created_at', 'id')[:page_size + 1])
+            response_data = {'has_more': len(rows) > page_size}
+            rows = rows[:page_size]
+        elif 'cursor' in request.GET or 'page_size' in request.GET:
+            try:
+                rows, next_cursor = paginate_by_cursor(
+                    messages, ['-created_at', '-id'], request.GET.get('cursor'), page_size
+                )
+            except InvalidCursor as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            rows.reverse()
+
+            next_url = None
+            if next_cursor:
+                query_params = request.GET.copy()
+                query_params['cursor'] = next_cursor
+                next_url = f"{request.build_absolute_uri().split('?')[0]}?{query_params.urlencode()}"
+            response_data = {'next': next_url, 'next_cursor': next_cursor}
+        else:
+            rows = list(messages.order_by('created_at'))
+
+        # Mark only the returned messages as read
+        unread = [message for message in rows if message.receiver_id == request.user.id and not message.is_read]
+        if unread:
+            unread_ids = [message.id for message in unread]
+            Message.objects.filter(id__in=unread_ids).update(is_read=True)
+            for message in unread:
+                message.is_read = True
+            realtime.messages_read(request.user.id, other_user.id, unread_ids)
+
+        serializer = MessageSerializer(rows, many=True)
+        if response_data is None:
+            return Response(serializer.data)
+        response_data['results'] = serializer.data
+        return Response(response_data)
     except User.DoesNotExist:
         return Response(
             {'error': 'User not found'},
@@ -985,6 +1084,7 @@ def send_message(request):
             content=content
         )
         serializer = MessageSerializer(message)
+        realtime.message_created(message, serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     except User.DoesNotExist:
         return Response(
@@ -998,11 +1098,7 @@ def mark_messages_read(request, user_id):
     """Mark all messages from a specific user as read"""
     try:
         other_user = User.objects.get(id=user_id)
-        Message.objects.filter(
-            sender=other_user,
-            receiver=request.user,
-            is_read=False
-        ).update(is_read=True)
+        mark_read(request.user, Message.objects.filter(sender=other_user))
         return Response({'status': 'Messages marked as read'})
     except User.DoesNotExist:
         return Response(
@@ -1010,6 +1106,125 @@ def mark_messages_read(request, user_id):
             status=status.HTTP_404_NOT_FOUND
         )
 
+MESSAGE_BATCH_MAX_SIZE = 100
+
+
+def parse_uuid_list(values):
+    """Return the values as UUIDs, or None if any of them is not one"""
+    try:
+        return [uuid.UUID(str(value)) for value in values]
+    except ValueError:
+        return None
+
+
+def mark_read(reader, messages):
+    """Mark the reader's unread messages among ``messages`` read with one UPDATE and send receipts"""
+    unread = list(messages.filter(receiver=reader, is_read=False).values_list('id', 'sender_id'))
+    if not unread:
+        return 0
+    Message.objects.filter(id__in=[message_id for message_id, _ in unread]).update(is_read=True)
+
+    ids_by_sender = {}
+    for message_id, sender_id in unread:
+        ids_by_sender.setdefault(sender_id, []).append(message_id)
+    for sender_id, message_ids in ids_by_sender.items():
+        realtime.messages_read(reader.id, sender_id, message_ids)
+    return len(unread)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def send_message_batch(request):
+    """Send several messages at once, e.g. a shop replying to a list of enquiries.
+
+    Expects {"messages": [{"receiver": <user id>, "content": "..."}, ...]}.
+    Either every message is saved or none are.
+    """
+    items = request.data.get('messages')
+    if not isinstance(items, list) or not items:
+        return Response({'error': 'messages must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(items) > MESSAGE_BATCH_MAX_SIZE:
+        return Response(
+            {'error': f'At most {MESSAGE_BATCH_MAX_SIZE} messages can be sent at once'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if not all(isinstance(item, dict) and item.get('content') for item in items):
+        return Response({'error': 'Every message needs a receiver and content'}, status=status.HTTP_400_BAD_REQUEST)
+    receiver_ids = parse_uuid_list(item.get('receiver') for item in items)
+    if receiver_ids is None:
+        return Response({'error': 'Every message needs a receiver and content'}, status=status.HTTP_400_BAD_REQUEST)
+
+    receivers = User.objects.in_bulk(set(receiver_ids))
+    missing = sorted({str(receiver_id) for receiver_id in receiver_ids if receiver_id not in receivers})
+    if missing:
+        return Response(
+            {'error': 'Receiver not found', 'receivers': missing},
+            status=status.HTTP_404_NOT_FOUND
+        )
+
+    messages = [
+        Message(sender=request.user, receiver=receivers[receiver_id], content=item['content'])
+        for receiver_id, item in zip(receiver_ids, items)
+    ]
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        serialized = MessageSerializer(messages, many=True).data
+        for message, data in zip(messages, serialized):
+            realtime.message_created(message, data)
+    return Response(serialized, status=status.HTTP_201_CREATED)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def mark_messages_read_bulk(request):
+    """Mark messages read by id and/or by sender in a single UPDATE.
+
+    Expects {"message_ids": [...]} and/or {"user_ids": [...]}; the latter
+    marks everything those users sent to the current user.
+    """
+    message_ids = parse_uuid_list(request.data.get('message_ids') or [])
+    user_ids = parse_uuid_list(request.data.get('user_ids') or [])
+    if message_ids is None or user_ids is None:
+        return Response({'error': 'message_ids and user_ids must be lists of ids'}, status=status.HTTP_400_BAD_REQUEST)
+    if not message_ids and not user_ids:
+        return Response({'error': 'Provide message_ids or user_ids'}, status=status.HTTP_400_BAD_REQUEST)
+
+    updated = mark_read(request.user, Message.objects.filter(Q(id__in=message_ids) | Q(sender_id__in=user_ids)))
+    return Response({'status': 'Messages marked as read', 'updated': updated})
+
+UNREAD_WAIT_DEFAULT_TIMEOUT = 25
+UNREAD_WAIT_MAX_TIMEOUT = 60
+
+
+async def wait_for_unread_count(request):
+    """Long-poll for changes to the current user's unread message count.
+
+    Without ?version=, or when it is out of date, returns the count right
+    away. Otherwise the request is held until a message is sent to the user
+    or they read some, or until ?timeout= seconds pass. Waiting costs no
+    database queries; only a changed response counts the unread messages.
+    Runs without holding a thread when served through the ASGI application.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    token = realtime.access_token(authorization=request.headers.get('Authorization'))
+    if token is None:
+        return JsonResponse({'error': 'Authentication credentials were not provided or are invalid'}, status=401)
+    user_id = token[jwt_settings.USER_ID_CLAIM]
+
+    try:
+        timeout = min(float(request.GET.get('timeout', UNREAD_WAIT_DEFAULT_TIMEOUT)), UNREAD_WAIT_MAX_TIMEOUT)
+    except ValueError:
+        return JsonResponse({'error': 'timeout must be a number of seconds'}, status=400)
+
+    client_version = request.GET.get('version')
+    version = realtime.unread_notifier.version(user_id)
+    if client_version == version:
+        version = await realtime.unread_notifier.wait(user_id, client_version, timeout)
+        if version == client_version:
+            return JsonResponse({'changed': False, 'version': version})
+
+    unread_count = await Message.objects.filter(receiver_id=user_id, is_read=False).acount()
+    return JsonResponse({'changed': True, 'version': version, 'unread_count': unread_count})
+
 # Admin Views
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsAdminUser])
@@ -1075,8 +1290,10 @@ def admin_user_list(request):
         search = request.GET.get('search', '')
         status_filter = request.GET.get('status')
         date_filter = request.GET.get('date')
-        page = int(request.GET.get('page', 1))
-        page_size = int(request.GET.get('page_size', 50))
+        try:
+            page, page_size = page_params(request.GET, 50)
+        except InvalidPage as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
         # Base queryset
         users = User.objects.all()
@@ -1178,7 +1395,7 @@ def admin_update_user_status(request, user_id):
             user.is_suspended = False
             user.suspended_at = None
         
-        user.save()
+        user.save(update_fields=['is_active', 'is_suspended', 'suspended_at', 'is_banned', 'banned_at'])
         
         return Response({
             'message': f'User {action}ed successfully',
@@ -1214,8 +1431,10 @@ def admin_listing_list(request):
         status_filter = request.GET.get('status')
         category_filter = request.GET.get('category')
         date_filter = request.GET.get('date')
-        page = int(request.GET.get('page', 1))
-        page_size = int(request.GET.get('page_size', 50))
+        try:
+            page, page_size = page_params(request.GET, 50)
+        except InvalidPage as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
         # Base queryset
         listings = TireListing.objects.select_related('seller')
@@ -1242,13 +1461,23 @@ def admin_listing_list(request):
             date_threshold = timezone.now() - timedelta(days=days)
             listings = listings.filter(created_at__gte=date_threshold)
         
-        # Calculate pagination
-        total_count = listings.count()
-        start_idx = (page - 1) * page_size
-        end_idx = start_idx + page_size
-        
-        # Get paginated results
-        paginated_listings = listings[start_idx:end_idx]
+        # Keyset pagination: newest first, with id as the tie-breaker
+        next_cursor = None
+        if 'cursor' in request.GET:
+            try:
+                paginated_listings, next_cursor = paginate_by_cursor(
+                    listings, ['-created_at', '-id'], request.GET.get('cursor'), page_size
+                )
+            except InvalidCursor as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            # Calculate pagination
+            total_count = listings.count()
+            start_idx = (page - 1) * page_size
+            end_idx = start_idx + page_size
+            
+            # Get paginated results
+            paginated_listings = listings[start_idx:end_idx]
         
         # Serialize the results
         listing_data = []
@@ -1260,7 +1489,7 @@ def admin_listing_list(request):
                     'id': str(listing.seller.id),
                     'username': listing.seller.username,
                     'email': listing.seller.email,
-                    'profile_image_url': listing.seller.profile_image_url
+                    'profile_image_url': listing.seller.avatar_url(128)
                 },
                 'price': str(listing.price),
                 'created_at': listing.created_at,
@@ -1270,6 +1499,19 @@ def admin_listing_list(request):
                 'condition': listing.condition
             })
         
+        if 'cursor' in request.GET:
+            # Same shape as the cursor mode of get_listings
+            next_url = None
+            if next_cursor:
+                query_params = request.GET.copy()
+                query_params['cursor'] = next_cursor
+                next_url = f"{request.build_absolute_uri().split('?')[0]}?{query_params.urlencode()}"
+            return Response({
+                'next': next_url,
+                'next_cursor': next_cursor,
+                'results': listing_data
+            })
+
         return Response({
             'count': total_count,
             'results': listing_data
@@ -1322,12 +1564,28 @@ def admin_update_listing(request, listing_id):
 
 # Add a middleware to update last_login on each authenticated request
 class UpdateLastActivityMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         response = self.get_response(request)
-        
+        self.update_last_login(request)
+        return response
+
+    async def __acall__(self, request):
+        # Async views (long polls) stay off the sync thread while they wait
+        response = await self.get_response(request)
+        await sync_to_async(self.update_last_login)(request)
+        return response
+
+    def update_last_login(self, request):
         # Update last_login if user is authenticated
         if request.user.is_authenticated:
             # Use cache to prevent too frequent updates
@@ -1339,8 +1597,6 @@ class UpdateLastActivityMiddleware:
                 request.user.last_login = timezone.now()
                 request.user.save(update_fields=['last_login'])
                 cache.set(cache_key, True, 300)  # Cache for 5 minutes
-                
-        return response
 
 @api_view(['POST', 'GET'])
 @permission_classes([IsAuthenticated])
@@ -1366,7 +1622,7 @@ def create_user_review(request, user_id):
                 'reviewer': {
                     'id': str(review.reviewer.id),
                     'username': review.reviewer.username,
-                    'profile_image_url': review.reviewer.profile_image_url if review.reviewer.profile_image_url else None
+                    'profile_image_url': review.reviewer.avatar_url(64) or None
                 }
             } for review in reviews]
             
@@ -1408,10 +1664,6 @@ def create_user_review(request, user_id):
                 comment=request.data.get('comment', '')
             )
             
-            # Update user's average rating
-            reviewed_user.rating = reviewed_user.get_average_rating()
-            reviewed_user.save()
-            
             return Response({
                 'id': str(review.id),
                 'rating': review.rating,
@@ -1420,12 +1672,12 @@ def create_user_review(request, user_id):
                 'reviewer': {
                     'id': str(request.user.id),
                     'username': request.user.username,
-                    'profile_image_url': request.user.profile_image_url
+                    'profile_image_url': request.user.avatar_url(64)
                 }
             }, status=status.HTTP_201_CREATED)
     
     except Exception as e:
-        print(f"Error in create_user_review: {str(e)}")  # Add logging
+        logger.exception("Error in create_user_review")
         return Response(
             {'error': str(e)}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -1455,10 +1707,8 @@ def manage_user_review(request, review_id):
         else:  # DELETE request
             review.delete()
         
-        # Update user's average rating
-        reviewed_user = review.reviewed_user
-        reviewed_user.rating = reviewed_user.get_average_rating()
-        reviewed_user.save()
+        # The reviewed user's rating totals are updated by Review.save() and
+        # the Review post_delete signal
         
         if request.method == 'PUT':
             return Response({
@@ -1469,7 +1719,7 @@ def manage_user_review(request, review_id):
                 'reviewer': {
                     'id': request.user.id,
                     'username': request.user.username,
-                    'profile_image_url': request.user.profile_image_url
+                    'profile_image_url': request.user.avatar_url(64)
                 }
             })
         else:
@@ -1478,39 +1728,57 @@ def manage_user_review(request, review_id):
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+# Tire size dropdowns are served from the cached facet snapshot (see
+# facets.py) and carry ETag/Last-Modified so clients can revalidate cheaply
+facets_condition = condition(etag_func=facets.facets_etag, last_modified_func=facets.facets_last_modified)
+
+@facets_condition
+@api_view(['GET'])
+def get_tire_size_tree(request):
+    """All active tire sizes as a width -> aspect ratio -> diameters tree"""
+    return Response({
+        'sizes': facets.size_tree(),
+        'speed_ratings': facets.speed_ratings(),
+        'load_indices': facets.load_indices(),
+    })
+
+@facets_condition
 @api_view(['GET'])
 def get_tire_widths(request):
-    widths = TireListing.objects.values_list('width', flat=True).distinct().order_by('width')
-    return Response({'widths': list(widths)})
+    return Response({'widths': facets.widths()})
 
+@facets_condition
 @api_view(['GET'])
 def get_tire_aspect_ratios(request):
     width = request.GET.get('width')
     if not width:
         return Response({'error': 'Width parameter is required.'}, status=400)
-    aspect_ratios = TireListing.objects.filter(width=width).values_list('aspect_ratio', flat=True).distinct().order_by('aspect_ratio')
-    return Response({'aspect_ratios': list(aspect_ratios)})
+    if not width.isdigit():
+        return Response({'error': 'Width must be a number.'}, status=400)
+    return Response({'aspect_ratios': facets.aspect_ratios(int(width))})
 
+@facets_condition
 @api_view(['GET'])
 def get_tire_diameters(request):
     width = request.GET.get('width')
     aspect_ratio = request.GET.get('aspect_ratio')
     if not width or not aspect_ratio:
         return Response({'error': 'Width and aspect_ratio parameters are required.'}, status=400)
-    diameters = TireListing.objects.filter(width=width, aspect_ratio=aspect_ratio).values_list('diameter', flat=True).distinct().order_by('diameter')
-    return Response({'diameters': list(diameters)})
+    if not width.isdigit() or not aspect_ratio.isdigit():
+        return Response({'error': 'Width and aspect_ratio must be numbers.'}, status=400)
+    return Response({'diameters': facets.diameters(int(width), int(aspect_ratio))})
 
+@facets_condition
 @api_view(['GET'])
 def get_speed_ratings(request):
-    """Get all unique speed ratings from the database"""
-    speed_ratings = TireListing.objects.values_list('speed_rating', flat=True).distinct().exclude(speed_rating__isnull=True).exclude(speed_rating__exact='').order_by('speed_rating')
-    return Response({'speed_ratings': list(speed_ratings)})
+    """Get all unique speed ratings of active listings"""
+    return Response({'speed_ratings': facets.speed_ratings()})
 
+@facets_condition
 @api_view(['GET'])
 def get_load_indices(request):
-    """Get all unique load indices from the database"""
-    load_indices = TireListing.objects.values_list('load_index', flat=True).distinct().exclude(load_index__isnull=True).order_by('load_index')
-    return Response({'load_indices': list(load_indices)})
+    """Get all unique load indices of active listings"""
+    return Response({'load_indices': facets.load_indices()})
 
 @api_view(['GET'])
 def get_user_profile(request, user_id):
@@ -1537,8 +1805,7 @@ def get_user_profile(request, user_id):
         }
         
         # Get user review count
-        review_count = Review.objects.filter(reviewed_user=user).count()
-        profile_data['total_reviews'] = review_count
+        profile_data['total_reviews'] = user.rating_count
         
         # If the user is a business, add business profile data
         if user.is_business:
@@ -1656,10 +1923,9 @@ def shops_list(request):
         for profile in business_profiles:
             user = profile.user
             
-            # Calculate average rating and review count
-            reviews = Review.objects.filter(reviewed_user=user)
-            avg_rating = reviews.aggregate(models.Avg('rating'))['rating__avg'] or 0.0
-            review_count = reviews.count()
+            # Average rating and review count are kept on the user row
+            avg_rating = user.get_average_rating()
+            review_count = user.rating_count
             
             # Apply rating filter
             if rating_min and avg_rating < float(rating_min):
@@ -1785,7 +2051,7 @@ def shops_list(request):
                 'review_count': review_count,
                 'services': profile.services if profile.services else [],
                 'operating_hours': profile.business_hours,
-                'image_url': user.profile_image_url,
+                'image_url': user.avatar_url(128),
                 'is_featured': profile.subscription_active  # Use subscription status for featured
             }
             
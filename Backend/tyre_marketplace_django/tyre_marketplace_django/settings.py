@@ -52,6 +52,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',  # CORS middleware should be first
+    'marketplace.instrumentation.RequestInstrumentationMiddleware',  # Wraps everything below it
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -106,6 +107,24 @@ DATABASES = {
 #     }
 # }
 
+# The default in-memory cache is private to each process. When running
+# several worker processes, set CACHE_LOCATION to a directory (e.g.
+# BASE_DIR / 'django_cache', or one on shared storage across hosts) so an
+# invalidated entry, such as the tire size facets, is gone for all of them.
+if os.getenv('CACHE_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.getenv('CACHE_LOCATION'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -147,6 +166,28 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Uploads are filed under hashed subdirectories (see marketplace/storage.py);
+# run `manage.py shard_media` to move files stored before this layout.
+STORAGES = {
+    'default': {
+        'BACKEND': 'marketplace.storage.ShardedFileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+# Hand media file transfers to the web server instead of Python: 'X-Sendfile'
+# (Apache/lighttpd) or 'X-Accel-Redirect' (nginx, with an internal location
+# at MEDIA_ACCEL_REDIRECT_PREFIX aliased to MEDIA_ROOT). See marketplace/media.py.
+MEDIA_SENDFILE_HEADER = os.getenv('MEDIA_SENDFILE_HEADER') or None
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+
+# Limits enforced while image uploads stream in (see marketplace/uploads.py).
+# Requests may carry as many files as the view accepts, plus 1MB of form data.
+IMAGE_UPLOAD_MAX_FILE_SIZE = 5 * 1024 * 1024
+IMAGE_UPLOAD_MAX_PIXELS = 40_000_000
+
 # Ensure media directories exist
 os.makedirs(os.path.join(MEDIA_ROOT, 'profile_images'), exist_ok=True)
 os.makedirs(os.path.join(MEDIA_ROOT, 'listings'), exist_ok=True)
@@ -220,3 +261,51 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
+
+# Logging
+# Debug diagnostics in the marketplace app are only emitted when
+# MARKETPLACE_LOG_LEVEL=DEBUG, so they cost nothing at the default level.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'marketplace': {
+            'handlers': ['console'],
+            'level': os.getenv('MARKETPLACE_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# Fraction of requests (0.0 - 1.0) that log a query count and timing summary
+REQUEST_INSTRUMENTATION_SAMPLE_RATE = float(os.getenv('REQUEST_INSTRUMENTATION_SAMPLE_RATE', '0'))
+
+# Seconds the cached tire size facets live before being rebuilt from the database
+FACETS_CACHE_TIMEOUT = 60 * 60
+
+# Seconds that facet counts for a given listing filter set are cached
+FACET_COUNTS_CACHE_TIMEOUT = 60
+
+# Fans real-time message events out to WebSocket connections. The in-process
+# broker only reaches sockets held by the same ASGI worker.
+MESSAGE_BROKER = 'marketplace.realtime.InProcessBroker'
+
+# Background threads per process that resize listing image uploads once they
+# are committed. Set to 0 when running `manage.py process_images` workers.
+IMAGE_PROCESSING_THREADS = int(os.getenv('IMAGE_PROCESSING_THREADS', '2'))
+
+# Background threads per process that send queued emails (see
+# marketplace/outbox.py) once they are committed. Failed emails are only
+# retried by `manage.py send_emails`; set this to 0 when running that worker.
+EMAIL_OUTBOX_THREADS = int(os.getenv('EMAIL_OUTBOX_THREADS', '1'))
+
+# Responsive copies made of every listing image, widest first in the API.
+# Formats Pillow cannot encode (e.g. 'avif' on older builds) are skipped; keep
+# 'jpeg' last as the fallback for clients without WebP/AVIF support.
+LISTING_IMAGE_VARIANT_WIDTHS = [160, 320, 640, 1200]
+LISTING_IMAGE_VARIANT_FORMATS = ['avif', 'webp', 'jpeg']
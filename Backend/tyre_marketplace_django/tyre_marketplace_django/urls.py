@@ -17,15 +17,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
-from django.views.static import serve
-import os
+from marketplace.media import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('marketplace.urls')),
-    # Serve media files directly in development
-    path('media/<path:path>', serve, {
-        'document_root': os.path.join(settings.BASE_DIR, 'media')
-    }),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    # Uploaded media, with ETag/Cache-Control headers and Range support.
+    # Set MEDIA_SENDFILE_HEADER to let the web server send the files.
+    path(f"{settings.MEDIA_URL.lstrip('/')}<path:path>", serve_media),
+]